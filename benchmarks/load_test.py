@@ -0,0 +1,303 @@
+# benchmarks/load_test.py - Concurrent load test of the running app against stub ttyd/tmux executables
+#
+# Usage:
+#   python benchmarks/load_test.py --files 10000 --concurrency 16 --duration 10
+#   python benchmarks/load_test.py --workload search --workload notes --output results.json
+#   python benchmarks/load_test.py --baseline results.json --max-regression 0.25
+#
+# main.py is started as a subprocess in a temporary directory holding a synthetic playbook
+# corpus, with benchmarks/stubs first on PATH so "ttyd" and "tmux" are the stand-ins (their
+# latency is set with --ttyd-startup-ms / --tmux-latency-ms). Each workload is driven by
+# --concurrency client threads for --duration seconds (all at once with --mixed), and
+# p50/p90/p99 latency and throughput per operation are printed as JSON. With --baseline the
+# run is compared to an earlier result and the exit status is 1 if an operation's p50 or p99
+# got slower by more than --max-regression.
+#
+# The main terminal always uses port 7681, which must be free.
+
+import argparse
+import http.client
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+STUBS_DIR = os.path.join(BENCHMARKS_DIR, 'stubs')
+sys.path.insert(0, BENCHMARKS_DIR)
+from playbook_search_benchmark import DEFAULT_QUERIES, generate_corpus # noqa: E402
+
+WORKLOADS = ('search', 'sendkeys', 'terminal', 'notes')
+SENDKEYS_TARGETS = 4 # Terminals opened up front for the sendkeys workload
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Client:
+    """A keep-alive HTTP connection per worker thread; reconnects once if the server closed it."""
+
+    def __init__(self, port):
+        self.port = port
+        self.conn = None
+
+    def request(self, method, path, body=None):
+        payload = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if payload is not None else {}
+        for attempt in (1, 2):
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection('127.0.0.1', self.port, timeout=30)
+            try:
+                self.conn.request(method, path, payload, headers)
+                response = self.conn.getresponse()
+                data = response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.close()
+                return response.status, data
+            except (http.client.HTTPException, OSError):
+                self.close()
+                if attempt == 2: raise
+
+    def close(self):
+        if self.conn: self.conn.close()
+        self.conn = None
+
+
+def start_app(workdir, port, args):
+    env = dict(os.environ)
+    env['PATH'] = STUBS_DIR + os.pathsep + env.get('PATH', '')
+    env['CW_STUB_TMUX_DIR'] = os.path.join(workdir, 'tmux-stub')
+    env['CW_STUB_TMUX_LATENCY_MS'] = str(args.tmux_latency_ms)
+    env['CW_STUB_TTYD_STARTUP_MS'] = str(args.ttyd_startup_ms)
+    cmd = [sys.executable, os.path.join(REPO_ROOT, 'main.py'), '--port', str(port),
+           '--server', args.server, '--terminal-pool-size', str(args.pool_size)]
+    if args.no_tmux_control_mode: cmd.append('--no-tmux-control-mode')
+    if args.tmux_shards > 1: cmd += ['--tmux-shards', str(args.tmux_shards)]
+    log = open(os.path.join(workdir, 'app.log'), 'wb')
+    return subprocess.Popen(cmd, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def wait_until_ready(client, expected_files, timeout):
+    """Waits for the main terminal and for the playbook index to hold the whole corpus."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            status, body = client.request('GET', '/api/status')
+            if status == 200 and json.loads(body).get('ready'):
+                _, metrics = client.request('GET', '/metrics')
+                for line in metrics.decode('utf-8').splitlines():
+                    if line.startswith('commandwave_playbook_index_files ') and float(line.split()[1]) >= expected_files:
+                        return json.loads(body)['startup']
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise SystemExit(f"App not ready after {timeout}s; see app.log in the work directory.")
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {} # operation -> list of latencies (ms)
+        self.errors = {}
+
+    def record(self, operation, started, ok):
+        elapsed = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self.samples.setdefault(operation, []).append(elapsed)
+            if not ok: self.errors[operation] = self.errors.get(operation, 0) + 1
+
+    def record_failure(self, operation):
+        """Counts a request that got no response at all (connection refused/reset)."""
+        with self._lock:
+            self.samples.setdefault(operation, [])
+            self.errors[operation] = self.errors.get(operation, 0) + 1
+
+
+def op_search(client, recorder, rng, state):
+    query = rng.choice(DEFAULT_QUERIES)
+    started = time.perf_counter()
+    status, _ = client.request('GET', f'/api/playbooks/search?query={query.replace("$", "%24").replace(" ", "+")}')
+    recorder.record('search', started, status == 200)
+
+
+def op_sendkeys(client, recorder, rng, state):
+    started = time.perf_counter()
+    status, _ = client.request('POST', '/api/terminals/sendkeys',
+                               {'port': rng.choice(state['targets']), 'command': f'echo load-test {rng.random()}'})
+    recorder.record('sendkeys', started, status == 200)
+
+
+def op_terminal(client, recorder, rng, state):
+    started = time.perf_counter()
+    status, body = client.request('POST', '/api/terminals/new', {'name': 'load-test'})
+    recorder.record('terminal_new', started, status == 200)
+    if status != 200: return
+    started = time.perf_counter()
+    status, _ = client.request('DELETE', f"/api/terminals/{json.loads(body)['port']}")
+    recorder.record('terminal_delete', started, status == 200)
+
+
+def op_notes(client, recorder, rng, state):
+    text = ' '.join(rng.choice(DEFAULT_QUERIES) for _ in range(rng.randint(50, 400)))
+    started = time.perf_counter()
+    status, _ = client.request('POST', f'/api/notes/tab/term-{90000 + rng.randrange(16)}', {'notes': text})
+    recorder.record('notes_save', started, status == 200)
+
+
+OPERATIONS = {'search': op_search, 'sendkeys': op_sendkeys, 'terminal': op_terminal, 'notes': op_notes}
+
+
+def drive(port, workloads, concurrency, duration, state, seed):
+    """Runs `concurrency` threads cycling through `workloads` for `duration` seconds."""
+    recorder = Recorder()
+    deadline = time.perf_counter() + duration
+
+    def worker(i):
+        client, rng = Client(port), random.Random(seed + i)
+        workload = workloads[i % len(workloads)]
+        try:
+            while time.perf_counter() < deadline:
+                try:
+                    OPERATIONS[workload](client, recorder, rng, state)
+                except (http.client.HTTPException, OSError, ValueError):
+                    recorder.record_failure(workload)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return recorder, time.perf_counter() - start
+
+
+def percentile(sorted_samples, p):
+    return sorted_samples[min(len(sorted_samples) - 1, int(p * len(sorted_samples)))]
+
+
+def summarise(recorder, elapsed):
+    results = {}
+    for operation, samples in sorted(recorder.samples.items()):
+        samples = sorted(samples)
+        if not samples:
+            results[operation] = {'requests': 0, 'errors': recorder.errors.get(operation, 0)}
+            continue
+        results[operation] = {
+            'requests': len(samples), 'errors': recorder.errors.get(operation, 0),
+            'throughput_rps': round(len(samples) / elapsed, 1),
+            'p50_ms': round(percentile(samples, 0.50), 2), 'p90_ms': round(percentile(samples, 0.90), 2),
+            'p99_ms': round(percentile(samples, 0.99), 2), 'max_ms': round(samples[-1], 2),
+        }
+    return results
+
+
+def compare(results, baseline, max_regression):
+    """Returns a message per operation whose p50 or p99 exceeds the baseline by more than max_regression."""
+    regressions = []
+    for run_name, operations in results.items():
+        for operation, row in operations.items():
+            before = baseline.get('runs', {}).get(run_name, {}).get(operation)
+            if not before or not row.get('requests'): continue
+            for key in ('p50_ms', 'p99_ms'):
+                if before.get(key) and row[key] > before[key] * (1 + max_regression):
+                    regressions.append(f"{run_name}/{operation} {key}: {before[key]} -> {row[key]}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True, timeout=5, check=True).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the app with stub ttyd/tmux")
+    parser.add_argument('--files', type=int, default=1000, help="Synthetic playbooks in the corpus (10 to 100000)")
+    parser.add_argument('--lines', type=int, default=50, help="Lines per playbook")
+    parser.add_argument('--workload', action='append', choices=WORKLOADS, help="Workload to run (repeatable, default: all)")
+    parser.add_argument('--mixed', action='store_true', help="Run the workloads at the same time instead of one after another")
+    parser.add_argument('--concurrency', type=int, default=8, help="Client threads per workload run")
+    parser.add_argument('--duration', type=float, default=5.0, help="Seconds per workload run")
+    parser.add_argument('--tmux-latency-ms', type=float, default=2.0, help="Delay the stub tmux adds to every command")
+    parser.add_argument('--ttyd-startup-ms', type=float, default=50.0, help="Delay before the stub ttyd listens")
+    parser.add_argument('--server', choices=['threaded', 'waitress'], default='threaded', help="--server passed to main.py")
+    parser.add_argument('--pool-size', type=int, default=2, help="--terminal-pool-size passed to main.py")
+    parser.add_argument('--no-tmux-control-mode', action='store_true', help="Pass --no-tmux-control-mode to main.py")
+    parser.add_argument('--tmux-shards', type=int, default=1, help="--tmux-shards passed to main.py")
+    parser.add_argument('--seed', type=int, default=1337)
+    parser.add_argument('--output', help="Also write the JSON results to this file")
+    parser.add_argument('--baseline', help="Earlier JSON results to compare against")
+    parser.add_argument('--max-regression', type=float, default=0.25, help="Allowed p50/p99 slowdown vs the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+    workloads = args.workload or list(WORKLOADS)
+
+    with tempfile.TemporaryDirectory(prefix='cw_load_') as workdir:
+        corpus_dir = os.path.join(workdir, 'playbooks')
+        os.makedirs(corpus_dir)
+        start = time.perf_counter()
+        generate_corpus(corpus_dir, args.files, args.lines, args.seed)
+        corpus_ms = (time.perf_counter() - start) * 1000
+
+        port = free_port()
+        app = start_app(workdir, port, args)
+        client = Client(port)
+        try:
+            startup = wait_until_ready(client, args.files, timeout=max(30, args.files / 500))
+            state = {'targets': []}
+            if 'sendkeys' in workloads:
+                for _ in range(SENDKEYS_TARGETS):
+                    status, body = client.request('POST', '/api/terminals/new', {'name': 'sendkeys-target'})
+                    if status != 200: raise SystemExit(f"Could not open a terminal for sendkeys: {body!r}")
+                    state['targets'].append(json.loads(body)['port'])
+            runs = {}
+            if args.mixed:
+                recorder, elapsed = drive(port, workloads, args.concurrency, args.duration, state, args.seed)
+                runs['mixed'] = summarise(recorder, elapsed)
+            else:
+                for workload in workloads:
+                    recorder, elapsed = drive(port, [workload], args.concurrency, args.duration, state, args.seed)
+                    runs[workload] = summarise(recorder, elapsed)
+        finally:
+            client.close()
+            app.send_signal(signal.SIGTERM)
+            try: app.wait(timeout=15)
+            except subprocess.TimeoutExpired: app.kill()
+
+    results = {
+        'commit': git_commit(),
+        'config': {'files': args.files, 'lines_per_file': args.lines, 'concurrency': args.concurrency,
+                   'duration_s': args.duration, 'mixed': args.mixed, 'server': args.server,
+                   'tmux_latency_ms': args.tmux_latency_ms, 'ttyd_startup_ms': args.ttyd_startup_ms,
+                   'pool_size': args.pool_size, 'tmux_control_mode': not args.no_tmux_control_mode,
+                   'tmux_shards': args.tmux_shards},
+        'corpus_generation_ms': round(corpus_ms, 1),
+        'startup': startup,
+        'runs': runs,
+    }
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(runs, json.load(f), args.max_regression)
+        for message in regressions:
+            print(f"REGRESSION {message}", file=sys.stderr)
+        if regressions: sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# benchmarks/playbook_search_benchmark.py - Compares the resident playbook index with the old per-request linear scan
+#
+# Usage:
+#   python benchmarks/playbook_search_benchmark.py --files 2000 --lines 200
+#
+# A synthetic corpus is generated in a temporary directory, so nothing in the
+# real playbooks folder is touched.
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = [
+    'nmap', 'nxc', 'smb', 'ldap', 'kerberos', 'hashcat', 'impacket', 'secretsdump', 'enum4linux',
+    'rpcclient', 'gobuster', 'ffuf', 'wordlist', 'target', 'domain', 'password', 'spray', 'shares',
+    'users', 'groups', 'ports', 'scan', 'service', 'version', 'script', 'output', 'host', 'subnet',
+]
+DEFAULT_QUERIES = ['nmap', 'ip', 'secretsdump', 'kerberos spray', '$TargetIP', 'no-such-term-xyz']
+
+
+def generate_corpus(directory, file_count, lines_per_file, seed=1337):
+    """Writes file_count markdown playbooks of lines_per_file lines each into directory."""
+    rng = random.Random(seed)
+    for i in range(file_count):
+        lines = [f"# Playbook {i}"]
+        for j in range(lines_per_file - 1):
+            if j % 10 == 0:
+                lines.append(f"## {rng.choice(WORDS).title()} {rng.choice(WORDS)}")
+            elif j % 4 == 0:
+                lines.append(f"{rng.choice(WORDS)} -p $Port $TargetIP --{rng.choice(WORDS)} {rng.randint(1, 65535)}")
+            else:
+                lines.append(' '.join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))))
+        with open(os.path.join(directory, f"playbook_{i:05d}.md"), 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+def linear_scan(directory, query):
+    """The search algorithm used before the index: re-read every file on every request."""
+    import glob
+    matches = []
+    query_lower = query.lower()
+    for filepath in glob.glob(os.path.join(directory, '*.md')):
+        filename = os.path.basename(filepath)
+        with open(filepath, 'r', encoding='utf-8') as f:
+            for line_num, line in enumerate(f, 1):
+                line_content = line.strip()
+                if query_lower in line_content.lower():
+                    matches.append({"filename": filename, "line_number": line_num, "line_content": line_content})
+    matches.sort(key=lambda x: (x['filename'], x['line_number']))
+    return matches
+
+
+def time_call(fn, repeat):
+    samples = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark playbook search: index vs linear scan")
+    parser.add_argument('--files', type=int, default=1000, help="Number of synthetic playbooks")
+    parser.add_argument('--lines', type=int, default=200, help="Lines per playbook")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per query (median is reported)")
+    parser.add_argument('--query', action='append', help="Query to run (repeatable)")
+    parser.add_argument('--json', action='store_true', help="Print machine-readable results")
+    args = parser.parse_args()
+    queries = args.query or DEFAULT_QUERIES
+
+    with tempfile.TemporaryDirectory(prefix='cw_bench_') as workdir:
+        corpus_dir = os.path.join(workdir, 'playbooks')
+        os.makedirs(corpus_dir)
+        generate_corpus(corpus_dir, args.files, args.lines)
+
+        # Import the app from inside the temp dir so its data directories land there
+        os.chdir(workdir)
+        sys.path.insert(0, REPO_ROOT)
+        import main as commandwave
+
+        index = commandwave.PlaybookIndex(corpus_dir)
+        start = time.perf_counter()
+        index.refresh()
+        build_ms = (time.perf_counter() - start) * 1000
+
+        results = {'files': args.files, 'lines_per_file': args.lines, 'index_build_ms': round(build_ms, 2),
+                   'index_stats': index.stats(), 'queries': []}
+        for query in queries:
+            scan_ms, scan_matches = time_call(lambda: linear_scan(corpus_dir, query), args.repeat)
+            index_ms, index_matches = time_call(lambda: index.search(query.lower()), args.repeat)
+            if scan_matches != index_matches:
+                raise SystemExit(f"Result mismatch for query {query!r}: {len(scan_matches)} vs {len(index_matches)}")
+            results['queries'].append({
+                'query': query, 'matches': len(index_matches),
+                'linear_scan_ms': round(scan_ms, 3), 'index_ms': round(index_ms, 3),
+                'speedup': round(scan_ms / index_ms, 1) if index_ms else None,
+            })
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print(f"Corpus: {args.files} files x {args.lines} lines, index built in {results['index_build_ms']} ms "
+          f"({results['index_stats']['trigrams']} trigrams)")
+    print(f"{'query':<20} {'matches':>8} {'scan ms':>10} {'index ms':>10} {'speedup':>8}")
+    for row in results['queries']:
+        print(f"{row['query']:<20} {row['matches']:>8} {row['linear_scan_ms']:>10} {row['index_ms']:>10} {row['speedup']:>7}x")
+
+
+if __name__ == '__main__':
+    main()
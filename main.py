@@ -12,28 +12,137 @@ import sys
 import signal
 import shlex
 import argparse # <<< Added for command-line arguments
-import glob # <<< ADDED for playbook search
+import threading
+import gzip
+import selectors
+import select
+import asyncio
+import tempfile
+import time
+import heapq
+import bisect
+import itertools
+import hashlib
+import secrets
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+import stat
+from collections import OrderedDict, deque
 
 # Third-party imports
 from flask import (
     Flask, render_template, request, jsonify, send_file,
-    flash, redirect, url_for, Response
+    flash, redirect, url_for, Response, stream_with_context, g, session
 )
 # NOTE: secure_filename is removed from load_playbook_content but might be used elsewhere if needed.
 # from werkzeug.utils import secure_filename 
 from werkzeug.exceptions import NotFound # <<< ADDED to handle file not found
+from werkzeug.security import safe_join
+try:
+    import brotli # Optional (pip install brotli): adds 'br' response encoding; gzip is used without it
+except ImportError:
+    brotli = None
+
+STARTUP_T0 = time.monotonic() # Reference point for the startup timings reported by /api/status
 
 # --- Configuration ---
 UPLOAD_FOLDER = 'uploads' # Kept for potential future use
 NOTES_DIR = 'notes_data' # Directory for notes files
 PLAYBOOKS_DIR = 'playbooks' # <<< ADDED Directory for local playbooks
 TMUX_CONFIG_FILE = 'commandwave_theme.tmux.conf' # Name of the custom tmux config file
+PLAYBOOK_INDEX_POLL_INTERVAL = 2.0 # Seconds between checks of the playbook roots for changed files
+PLAYBOOK_CATALOG_FILE = 'playbook_catalog.json' # Saved playbook metadata, reused for unchanged files on restart
+SEARCH_DEFAULT_LIMIT = 50 # Matches per page of /api/playbooks/search
+SEARCH_MAX_LIMIT = 500
+SEARCH_RANK_WINDOW = 1000 # Matches (in file order) ranked by relevance; later ones follow unranked
+PLAYBOOK_CACHE_SIZE = 64 # Loaded playbooks kept in memory by /api/playbooks/load
+SEARCH_QUERY_CACHE_SIZE = 256 # Compiled search queries kept across keystrokes and result pages
+SEARCH_FUZZY_MAX_EDITS = 2 # Upper bound on the typos a fuzzy term (word~) tolerates
+SEARCH_MAX_REGEX_LENGTH = 256
+SEARCH_SCAN_TIME_BUDGET = 2.0 # Seconds a regex/fuzzy/field query may spend checking lines before giving up (408)
+SEARCH_CHECK_BATCH_LINES = 2000 # Lines checked between deadline checks, and sent to a regex worker at once
+SEARCH_REGEX_IDLE_WORKERS = 2 # Regex worker processes kept running between searches
+SEARCH_REGEX_SPAN_CACHE = 50000 # Line results a regex term remembers across result pages
+NOTES_FLUSH_INTERVAL = 1.0 # Seconds edits to a notes file are coalesced before it is written
+SESSION_REGISTRY_FILE = 'session_registry.json' # Terminals handed to the UI (see SessionRegistry)
+KEEP_SESSIONS = False # --keep-sessions: leave tmux sessions running at exit and reattach on start
+SUPERVISOR_INTERVAL = 2.0 # Seconds between terminal health checks
+SUPERVISOR_MAX_RESTARTS = 3 # ttyd restarts allowed per terminal within SUPERVISOR_RESTART_WINDOW
+SUPERVISOR_RESTART_WINDOW = 60
+EVENTS_HEARTBEAT_INTERVAL = 15 # Seconds between keep-alive comments on idle /api/events streams
+EVENTS_CLIENT_QUEUE_SIZE = 256 # Undelivered events per client before it is told to resync instead
+EVENTS_HISTORY_SIZE = 512 # Recent events kept to replay to clients reconnecting with Last-Event-ID
+EVENTS_MAX_NOTES_DELTA = 64 * 1024 # Larger notes changes are announced without their text
+EVENTS_MAX_STREAMS = 8 # Open /api/events streams (one per browser tab); each holds a server thread
+EVENTS_STREAM_MAX_SECONDS = 300 # A stream then ends and the browser reconnects, freeing its thread meanwhile
+EVENTS_REFUSED_RETRY_AFTER = 30 # Seconds a browser refused over EVENTS_MAX_STREAMS waits to try again
+# Scrollback capture (--capture-scrollback): terminal output is logged under SCROLLBACK_DIR
+SCROLLBACK_CAPTURE = False
+SCROLLBACK_DIR = 'scrollback'
+SCROLLBACK_SEGMENT_BYTES = 512 * 1024 # Uncompressed size at which a log segment is rotated
+SCROLLBACK_MAX_TERMINAL_BYTES = 16 * 1024 * 1024 # Logged text kept per terminal (all its captures); oldest segments go first
+SCROLLBACK_MAX_TOTAL_BYTES = 64 * 1024 * 1024 # Logged text kept over all terminals
+SCROLLBACK_MAX_AGE = 7 * 24 * 3600 # Seconds; segments last written longer ago are deleted
+SCROLLBACK_RETENTION_INTERVAL = 60 # Seconds between age checks while capturing
+SCROLLBACK_FLUSH_INTERVAL = 2.0 # Seconds between flushes of open segments to disk
+SCROLLBACK_MAX_LINE = 64 * 1024 # Longer unterminated output is logged as its own line
+SCROLLBACK_DEFAULT_LIMIT = 100
+SCROLLBACK_MAX_LIMIT = 1000
+
+# Response compression (see compress_response) and static asset caching (see StaticAssets)
+COMPRESS_RESPONSES = True # --no-compression sends every response as-is
+COMPRESS_MIN_SIZE = 1024 # Smaller bodies are sent uncompressed; the saving wouldn't cover the overhead
+COMPRESS_GZIP_LEVEL = 6 # Dynamic responses; static assets are compressed once, at the highest level
+COMPRESS_BROTLI_QUALITY = 5
+COMPRESS_MIMETYPES = {'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+                      'application/json', 'image/svg+xml'}
+COMPRESS_CACHE_SIZE = 128 # Compressed bodies of ETag-carrying responses (playbook loads, the index page)
+STATIC_MAX_AGE = 365 * 24 * 3600 # Seconds browsers may keep content-hashed static URLs
+INDEX_RENDER_CACHE_SIZE = 16 # Rendered index pages, one per host name and startup state
+
+# Web server defaults (see run_server)
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 5000
+SERVER_THREADS = 16 # Worker threads for --server waitress
 
 # Initial port for the main terminal
 _initial_ttyd_port = 7681
-# Range for dynamically added terminals
-_next_ttyd_port = 7682
-_max_ttyd_port = 7781
+# Range for dynamically added terminals (see --port-range-start/--port-range-end)
+_ttyd_port_range_start = 7682
+_ttyd_port_range_end = 7781
+# Seconds before a port found bound by another program is offered again
+PORT_RETRY_AFTER = 60
+# Single-port mode (--terminal-proxy-port): ttyd listens on Unix sockets and the built-in
+# proxy serves every terminal at http://<host>:<proxy port>/term/<id>/. Terminal "ports"
+# are then plain ids, so the range is no longer limited by free TCP ports.
+TERMINAL_PROXY_PORT = None
+TERMINAL_SOCKET_DIR = os.path.join(tempfile.gettempdir(), f'commandwave-{os.getuid()}')
+TERMINAL_SOCKET_ID_COUNT = 10000 # Default size of the id range in single-port mode
+# Route tmux commands over one persistent `tmux -C` connection (falls back to a subprocess per call)
+USE_TMUX_CONTROL_MODE = True
+TMUX_CONTROL_SESSION = 'cmd_wave_control' # Session the control-mode client attaches to
+# tmux server sharding (--tmux-shards): sessions are spread over several tmux servers, each on
+# its own socket (tmux -L), so one busy or hung server only affects the terminals it holds
+TMUX_SHARDS = 1 # A single shard is the default tmux server
+TMUX_SHARD_POLICY = 'least-loaded' # Placement of new sessions: 'least-loaded' or 'round-robin'
+TMUX_SHARD_SOCKET_PREFIX = 'cmd_wave_shard_' # Shard n listens on socket <prefix><n>
+TMUX_SHARD_AVOID_SECONDS = 30 # A shard whose server timed out gets no new sessions for this long
+# Seconds to wait for a new ttyd to accept connections before trusting it is alive
+TTYD_READY_TIMEOUT = 3.0
+# Pre-started terminals kept ready for /api/terminals/new (0 disables the pool)
+TERMINAL_POOL_SIZE = 2
+# Background refill starts once this many (or fewer) pooled terminals remain
+TERMINAL_POOL_LOW_WATER = 1
+# Terminals started at once at start-up (the initial one plus sessions restored by --keep-sessions)
+BOOTSTRAP_MAX_WORKERS = 8
+# Batch command dispatch (/api/terminals/sendkeys/batch)
+BATCH_MAX_ITEMS = 1000
+BATCH_MAX_WORKERS = 16 # Sessions dispatched to concurrently
+BATCH_MAX_DELAY = 60 # Seconds an item may ask to wait before sending
+BATCH_DEFAULT_PROMPT_TIMEOUT = 30 # Seconds to wait for a shell prompt when wait_for_prompt is set
+BATCH_MAX_PROMPT_TIMEOUT = 300
+BATCH_MAX_TOTAL_SECONDS = 600 # Longest a batch may take if every delay runs and every prompt wait times out
+PROMPT_PATTERN = re.compile(r'[$#>%]\s*$') # Last non-empty pane line looks like a shell prompt
 # External dependencies
 TTYD_COMMAND = 'ttyd'
 TMUX_COMMAND = 'tmux'
@@ -46,9 +155,6 @@ USE_DEFAULT_TMUX_CONFIG_FLAG = False
 app = Flask(__name__)
 app.secret_key = 'your_strong_random_secret_key_here' # <<< MUST CHANGE FOR PRODUCTION!
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(NOTES_DIR, exist_ok=True) # Ensure notes directory exists
-os.makedirs(PLAYBOOKS_DIR, exist_ok=True) # Ensure playbooks directory exists
 
 # Basic logging configuration
 logging.basicConfig(
@@ -56,9 +162,184 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# --- Metrics ---
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0) # Seconds
+METRICS_SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576) # Bytes
+SLOW_REQUEST_THRESHOLD = 1.0 # Requests slower than this (seconds) are logged at WARNING
+# --profile: sampling profiler settings (see SamplingProfiler)
+PROFILER_INTERVAL = 0.01 # Seconds between stack samples
+PROFILER_MAX_STACKS = 10000 # Distinct stacks kept; samples of further new stacks are only counted
+PROFILER_OUTPUT_FILE = 'profile.folded' # Written at exit when profiling is enabled
+
+def _format_metric_labels(labels):
+    """Formats (name, value) pairs as a Prometheus label set, escaping values."""
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class MetricsRegistry:
+    """
+    Minimal Prometheus-style metrics: labelled counters and histograms updated in place
+    by the code being measured, plus collector callbacks that read gauges and counters
+    from the components' own stats() at scrape time. render() returns the text
+    exposition format served by /metrics.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._families = OrderedDict() # name -> {'type', 'help', 'buckets', 'series': {label tuple: value}}
+        self._collectors = []
+
+    def counter(self, name, help_text):
+        self._families[name] = {'type': 'counter', 'help': help_text, 'series': {}}
+
+    def histogram(self, name, help_text, buckets=METRICS_LATENCY_BUCKETS):
+        self._families[name] = {'type': 'histogram', 'help': help_text, 'buckets': buckets, 'series': {}}
+
+    def collector(self, fn):
+        """Registers fn() -> iterable of (name, type, help, labels dict, value), called on every scrape."""
+        self._collectors.append(fn)
+        return fn
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._families[name]['series']
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        family = self._families[name]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            hist = family['series'].get(key)
+            if hist is None:
+                hist = family['series'][key] = {'buckets': [0] * len(family['buckets']), 'sum': 0.0, 'count': 0}
+            i = bisect.bisect_left(family['buckets'], value)
+            if i < len(hist['buckets']): hist['buckets'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def render(self):
+        out = []
+        with self._lock:
+            for name, family in self._families.items():
+                out.append(f"# HELP {name} {family['help']}")
+                out.append(f"# TYPE {name} {family['type']}")
+                for key, value in sorted(family['series'].items()):
+                    if family['type'] != 'histogram':
+                        out.append(f"{name}{_format_metric_labels(key)} {value}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(family['buckets'], value['buckets']):
+                        cumulative += count
+                        out.append(f"{name}_bucket{_format_metric_labels(key + (('le', bound),))} {cumulative}")
+                    out.append(f"{name}_bucket{_format_metric_labels(key + (('le', '+Inf'),))} {value['count']}")
+                    out.append(f"{name}_sum{_format_metric_labels(key)} {round(value['sum'], 6)}")
+                    out.append(f"{name}_count{_format_metric_labels(key)} {value['count']}")
+        # Collectors take the components' own locks, so they run outside ours
+        described = set()
+        for fn in self._collectors:
+            try:
+                samples = list(fn())
+            except Exception as e:
+                app.logger.error(f"Metrics collector {fn.__name__} failed: {e}", exc_info=True)
+                continue
+            for name, metric_type, help_text, labels, value in samples:
+                if name not in described:
+                    described.add(name)
+                    out.append(f"# HELP {name} {help_text}")
+                    out.append(f"# TYPE {name} {metric_type}")
+                out.append(f"{name}{_format_metric_labels(sorted(labels.items()))} {value}")
+        return '\n'.join(out) + '\n'
+
+metrics = MetricsRegistry()
+metrics.counter('commandwave_http_requests_total', "HTTP requests by method, route and status.")
+metrics.histogram('commandwave_http_request_duration_seconds', "Time to produce a response (streams: until the first byte).")
+metrics.counter('commandwave_http_compressed_bytes_total', "Bodies of compressed responses before (original) and after (sent) compression.")
+metrics.histogram('commandwave_subprocess_duration_seconds', "tmux commands (control mode or subprocess) and ttyd spawn/readiness.")
+metrics.histogram('commandwave_playbook_search_duration_seconds', "Time to scan the playbook index for one search page.")
+metrics.counter('commandwave_playbook_search_lines_scanned_total', "Indexed lines examined by playbook searches.")
+metrics.counter('commandwave_playbook_bytes_read_total', "Bytes of playbook files read from disk, by reader.")
+metrics.histogram('commandwave_notes_write_bytes', "Size of notes files written to disk.", METRICS_SIZE_BUCKETS)
+
+class SamplingProfiler:
+    """
+    Statistical wall-clock profiler for --profile. A daemon thread snapshots every other
+    thread's stack with sys._current_frames() each `interval` seconds and counts identical
+    stacks, so the app itself runs unmodified. report() returns the counts in the folded
+    format read by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=PROFILER_INTERVAL, max_stacks=PROFILER_MAX_STACKS):
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self._counts = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self.samples = 0
+        self.dropped = 0 # Stack samples not kept because max_stacks was reached
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running: return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident: continue
+                calls = []
+                while frame is not None:
+                    calls.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                calls.append(thread_names.get(ident, 'thread'))
+                stacks.append(';'.join(reversed(calls)))
+            with self._lock:
+                self.samples += 1
+                for stack in stacks:
+                    if stack in self._counts:
+                        self._counts[stack] += 1
+                    elif len(self._counts) < self.max_stacks:
+                        self._counts[stack] = 1
+                    else:
+                        self.dropped += 1
+
+    def report(self, reset=False):
+        """Returns the folded stacks ("thread;frame;frame count" per line), most frequent first."""
+        with self._lock:
+            counts = sorted(self._counts.items(), key=lambda item: -item[1])
+            if reset: self._counts.clear()
+        return ''.join(f"{stack} {count}\n" for stack, count in counts)
+
+    def stats(self):
+        with self._lock:
+            return {'running': self.running, 'interval': self.interval, 'samples': self.samples,
+                    'stacks': len(self._counts), 'dropped': self.dropped}
+
+profiler = SamplingProfiler()
+
 # --- Terminal Process Management State ---
 _running_ttyd_processes = {}
 _running_tmux_sessions = {}
+_starting_ports = set() # Ports with a start_ttyd_process call in progress
+# Guards the terminal state above. Never held across blocking tmux/ttyd calls.
+_terminal_lock = threading.RLock()
 
 # --- Terminal Helper Functions ---
 def is_port_in_use(port):
@@ -70,17 +351,378 @@ def is_port_in_use(port):
         except OSError:
             return True
 
-def find_available_port(start_port, max_port):
-    """Finds the next available port in a given range."""
-    port = start_port
-    while port <= max_port:
-        if not is_port_in_use(port):
-             app.logger.info(f"Port {port} appears free.")
-             return port
-        app.logger.warning(f"Port {port} seems occupied, trying next.")
-        port += 1
-    app.logger.error(f"No available port found in range {start_port}-{max_port}")
-    return None
+class PortAllocator:
+    """
+    Leases terminal ports from a fixed range in O(1). Free ports wait in a FIFO queue
+    (released ports go to the back, so a just-closed port is not handed out again
+    straight away) and only the chosen candidate is bind-checked. A candidate that turns
+    out to be bound by another program is parked for PORT_RETRY_AFTER seconds.
+    """
+
+    def __init__(self, start, end):
+        self._lock = threading.Lock()
+        self.verify = True
+        self.configure(start, end)
+
+    def configure(self, start, end, verify=True):
+        """
+        (Re)defines the range, keeping leases that fall inside it. verify=False hands out
+        ids without bind-checking them (single-port mode, where they are not TCP ports).
+        """
+        if not 0 < start <= end or (verify and end >= 65536):
+            raise ValueError(f"Invalid port range {start}-{end}")
+        with self._lock:
+            self.start, self.end, self.verify = start, end, verify
+            leased = getattr(self, '_leased', set())
+            self._leased = {p for p in leased if start <= p <= end}
+            self._free = deque(p for p in range(start, end + 1) if p not in self._leased)
+            self._parked = deque() # (retry_at, port) for ports held by other programs
+
+    def _unpark_locked(self):
+        now = time.monotonic()
+        while self._parked and self._parked[0][0] <= now:
+            self._free.append(self._parked.popleft()[1])
+
+    def lease(self):
+        """Returns a free port and marks it leased, or None if the range is exhausted."""
+        with self._lock:
+            self._unpark_locked()
+            while self._free:
+                port = self._free.popleft()
+                if self.verify and is_port_in_use(port):
+                    app.logger.warning(f"Port {port} is bound by another program; skipping it for {PORT_RETRY_AFTER}s.")
+                    self._parked.append((time.monotonic() + PORT_RETRY_AFTER, port))
+                    continue
+                self._leased.add(port)
+                return port
+        app.logger.error(f"No available port found in range {self.start}-{self.end}")
+        return None
+
+    def claim(self, port):
+        """Leases a specific port (restored terminals). False if it is outside the range or already leased."""
+        with self._lock:
+            if not self.start <= port <= self.end or port in self._leased:
+                return False
+            try:
+                self._free.remove(port)
+            except ValueError:
+                self._parked = deque(item for item in self._parked if item[1] != port)
+            self._leased.add(port)
+            return True
+
+    def release(self, port):
+        """Returns a leased port to the back of the free queue (no-op for ports not leased)."""
+        with self._lock:
+            if port in self._leased:
+                self._leased.discard(port)
+                self._free.append(port)
+
+    def stats(self):
+        with self._lock:
+            return {'range': [self.start, self.end], 'leased': len(self._leased),
+                    'free': len(self._free), 'parked': len(self._parked)}
+
+port_allocator = PortAllocator(_ttyd_port_range_start, _ttyd_port_range_end)
+
+# --- tmux Control Mode ---
+class TmuxControlError(Exception):
+    """Raised when the control-mode connection is unavailable or lost a reply."""
+
+class TmuxControlUnavailable(TmuxControlError):
+    """Raised when the commands never reached tmux (could not connect or write), so retrying is safe."""
+
+class TmuxControlTimeout(TmuxControlError):
+    """Raised when the tmux server did not answer in time."""
+
+_TMUX_BARE_ARG_RE = re.compile(r'^[A-Za-z0-9_.:@%=/+,-]+$')
+
+def quote_tmux_arg(arg):
+    """Quotes one argument for tmux's command parser (used on the control-mode pipe)."""
+    if _TMUX_BARE_ARG_RE.match(arg):
+        return arg
+    return '"' + arg.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$') + '"'
+
+def tmux_config_args(use_default_config=None):
+    """Returns ['-f', TMUX_CONFIG_FILE] when the custom config applies (only read when a server starts)."""
+    if use_default_config is None: use_default_config = USE_DEFAULT_TMUX_CONFIG_FLAG
+    if not use_default_config and os.path.exists(TMUX_CONFIG_FILE):
+        return ['-f', TMUX_CONFIG_FILE]
+    return []
+
+class _PendingTmuxCommand:
+    __slots__ = ('done', 'ok', 'lines', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
+        self.lines = []
+        self.error = None
+
+class TmuxControlClient:
+    """
+    A long-lived `tmux -C` connection to one tmux server (shard). Commands are written one
+    per line and tmux answers each with a %begin/%end (or %error) block in the same order,
+    so replies are matched FIFO. A reader thread parses the stream; the connection is
+    (re)opened lazily, and any lost reply drops it so the next call reconnects.
+    """
+
+    def __init__(self, shard=0):
+        self.shard = shard
+        self._lock = threading.Lock() # Serialises writes so the FIFO order matches the pipe
+        self._proc = None
+        self._pending = None
+        self.commands_sent = 0
+        self.connects = 0
+
+    def _connect_locked(self):
+        cmd = [TMUX_COMMAND] + tmux_shards.socket_args(self.shard) + tmux_config_args() + \
+              ['-C', 'new-session', '-A', '-s', TMUX_CONTROL_SESSION]
+        try:
+            proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            raise TmuxControlUnavailable(f"could not start tmux control client: {e}")
+        self._proc, self._pending = proc, deque()
+        self.connects += 1
+        threading.Thread(target=self._read_loop, args=(proc, self._pending),
+                         name=f'tmux-control-reader-{self.shard}', daemon=True).start()
+        app.logger.info(f"Opened tmux control-mode connection to shard {self.shard} (PID: {proc.pid}).")
+
+    def _read_loop(self, proc, pending):
+        block = None
+        try:
+            for raw in proc.stdout:
+                line = raw.decode('utf-8', 'replace').rstrip('\n')
+                if block is None:
+                    # %begin <time> <number> <flags>; flags 1 marks replies to our own commands
+                    # (the attach itself produces an unsolicited block). Other lines are notifications.
+                    if line.startswith('%begin '):
+                        parts = line.split(' ')
+                        block = {'tag': parts[1:3], 'ours': parts[3:4] == ['1'], 'lines': []}
+                    continue
+                if line.startswith(('%end ', '%error ')) and line.split(' ')[1:3] == block['tag']:
+                    if block['ours'] and pending:
+                        item = pending.popleft()
+                        item.ok, item.lines = line.startswith('%end '), block['lines']
+                        item.done.set()
+                    block = None
+                else:
+                    block['lines'].append(line)
+        except Exception as e:
+            app.logger.warning(f"tmux control-mode reader stopped: {e}")
+        finally:
+            while pending:
+                item = pending.popleft()
+                item.error = 'tmux control-mode connection closed'
+                item.done.set()
+
+    def _close_locked(self):
+        proc, self._proc = self._proc, None
+        if proc and proc.poll() is None:
+            try: proc.stdin.close()
+            except OSError: pass
+            proc.kill()
+
+    def run(self, commands, timeout=5):
+        """
+        Sends each command (a list of arguments) over the connection and waits for all
+        replies. Returns a list of (ok, output_lines); raises TmuxControlUnavailable if the
+        commands could not be sent, TmuxControlTimeout if the replies did not arrive in time
+        and TmuxControlError if the connection was lost after sending.
+        """
+        with self._lock:
+            if self._proc is None or self._proc.poll() is not None:
+                self._connect_locked()
+            items = []
+            try:
+                for args in commands:
+                    item = _PendingTmuxCommand()
+                    self._pending.append(item)
+                    items.append(item)
+                    self._proc.stdin.write((' '.join(quote_tmux_arg(a) for a in args) + '\n').encode('utf-8'))
+                self._proc.stdin.flush()
+                self.commands_sent += len(items)
+            except (OSError, ValueError) as e:
+                self._close_locked()
+                raise TmuxControlUnavailable(f"write to tmux control client failed: {e}")
+
+        deadline = time.monotonic() + timeout
+        results = []
+        for item in items:
+            if not item.done.wait(max(0, deadline - time.monotonic())):
+                # FIFO matching is unreliable once a reply goes missing, so start over next time
+                with self._lock: self._close_locked()
+                raise TmuxControlTimeout('timed out waiting for tmux control-mode reply')
+            if item.error:
+                raise TmuxControlError(item.error)
+            results.append((item.ok, item.lines))
+        return results
+
+    def close(self):
+        """Kills the control session and closes the connection."""
+        with self._lock:
+            if self._proc and self._proc.poll() is None:
+                try:
+                    self._proc.stdin.write(f"kill-session -t {TMUX_CONTROL_SESSION}\n".encode('utf-8'))
+                    self._proc.stdin.flush()
+                    self._proc.wait(timeout=1)
+                except (OSError, ValueError, subprocess.TimeoutExpired):
+                    pass
+            elif self.connects:
+                # The connection was dropped earlier, which leaves the session behind
+                subprocess.run([TMUX_COMMAND] + tmux_shards.socket_args(self.shard) +
+                               ['kill-session', '-t', TMUX_CONTROL_SESSION], timeout=2,
+                               check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            self._close_locked()
+
+class TmuxShards:
+    """
+    The tmux servers terminal sessions are spread over. Shard n runs on socket
+    <TMUX_SHARD_SOCKET_PREFIX><n> (a single shard is the default server) and has its own
+    control-mode connection. A new terminal's session is placed round-robin or on the
+    shard with the fewest sessions, passing over shards that recently timed out, and the
+    shard is remembered per terminal so every later command goes to the right server.
+    """
+
+    def __init__(self, count=TMUX_SHARDS, policy=TMUX_SHARD_POLICY):
+        self._lock = threading.Lock()
+        self._assigned = {} # port -> shard holding its session
+        self._next = itertools.count()
+        self.configure(count, policy)
+
+    def configure(self, count, policy=TMUX_SHARD_POLICY):
+        """Sets the number of shards and the placement policy. Call before any terminal starts."""
+        with self._lock:
+            self.count = max(1, count)
+            self.policy = policy
+            self.clients = [TmuxControlClient(shard) for shard in range(self.count)]
+            self._commands = [0] * self.count
+            self._timeouts = [0] * self.count
+            self._avoid_until = [0.0] * self.count
+
+    def socket_args(self, shard):
+        """tmux options that select the shard's server."""
+        return ['-L', f'{TMUX_SHARD_SOCKET_PREFIX}{shard}'] if self.count > 1 else []
+
+    def assign(self, port, shard=None):
+        """
+        Returns the shard holding port's session. A port without one is placed by the
+        policy, or pinned to `shard` (a surviving session found on that server).
+        """
+        with self._lock:
+            if shard is not None and 0 <= shard < self.count:
+                self._assigned[port] = shard
+            elif port not in self._assigned:
+                self._assigned[port] = self._place_locked()
+            return self._assigned[port]
+
+    def _place_locked(self):
+        now = time.monotonic()
+        healthy = [shard for shard in range(self.count) if self._avoid_until[shard] <= now] or list(range(self.count))
+        if self.policy == 'round-robin':
+            return healthy[next(self._next) % len(healthy)]
+        loads = [0] * self.count
+        for shard in self._assigned.values(): loads[shard] += 1
+        return min(healthy, key=lambda shard: loads[shard])
+
+    def shard_of(self, port):
+        with self._lock:
+            return self._assigned.get(port, 0)
+
+    def release(self, port):
+        with self._lock:
+            self._assigned.pop(port, None)
+
+    def record_commands(self, shard, count):
+        with self._lock:
+            self._commands[shard] += count
+
+    def record_timeout(self, shard):
+        """Notes that a shard's server did not answer; new sessions avoid it for a while."""
+        with self._lock:
+            self._timeouts[shard] += 1
+            self._avoid_until[shard] = time.monotonic() + TMUX_SHARD_AVOID_SECONDS
+        app.logger.warning(f"tmux shard {shard} timed out; placing new sessions elsewhere for {TMUX_SHARD_AVOID_SECONDS}s.")
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+
+    def stats(self):
+        """Per-shard load: sessions placed on it, tmux commands sent and timeouts."""
+        now = time.monotonic()
+        with self._lock:
+            sessions = [0] * self.count
+            for shard in self._assigned.values(): sessions[shard] += 1
+            return [{'shard': shard, 'socket': (self.socket_args(shard) or [None, 'default'])[1],
+                     'sessions': sessions[shard], 'commands': self._commands[shard],
+                     'timeouts': self._timeouts[shard], 'avoided': self._avoid_until[shard] > now}
+                    for shard in range(self.count)]
+
+tmux_shards = TmuxShards()
+
+def run_tmux_commands(commands, timeout=5, shard=0):
+    """
+    Runs a sequence of tmux commands (each a list of arguments) on a shard's server and
+    returns a subprocess.CompletedProcess describing the outcome: output of all commands
+    on success, or the first failing command's error in stderr. Uses the control-mode
+    connection when enabled and falls back to one `tmux a ; b ...` subprocess only if the
+    commands never reached it; a control-mode timeout raises subprocess.TimeoutExpired,
+    like the subprocess path, instead of running the commands again.
+    """
+    tmux_shards.record_commands(shard, len(commands))
+    if USE_TMUX_CONTROL_MODE:
+        try:
+            started = time.perf_counter()
+            results = tmux_shards.clients[shard].run(commands, timeout)
+            metrics.observe('commandwave_subprocess_duration_seconds', time.perf_counter() - started,
+                            program='tmux', operation='control')
+            output = []
+            for ok, lines in results:
+                if not ok:
+                    return subprocess.CompletedProcess(commands, 1, '\n'.join(output), '\n'.join(lines))
+                output.extend(lines)
+            return subprocess.CompletedProcess(commands, 0, '\n'.join(output) + ('\n' if output else ''), '')
+        except TmuxControlUnavailable as e:
+            app.logger.warning(f"tmux control mode unavailable ({e}); falling back to subprocess.")
+        except TmuxControlTimeout:
+            # The commands were sent and may still run, so re-sending them could type a line twice
+            tmux_shards.record_timeout(shard)
+            raise subprocess.TimeoutExpired(commands, timeout)
+        except TmuxControlError as e:
+            return subprocess.CompletedProcess(commands, 1, '', f"tmux control-mode reply lost: {e}")
+    cmd = [TMUX_COMMAND] + tmux_shards.socket_args(shard) + tmux_config_args()
+    for i, args in enumerate(commands):
+        if i: cmd.append(';')
+        # tmux treats an argument ending in ';' as a command separator; '\;' keeps it literal
+        cmd.extend(arg[:-1] + '\\;' if arg.endswith(';') else arg for arg in args)
+    started = time.perf_counter()
+    try:
+        return subprocess.run(cmd, check=False, capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        tmux_shards.record_timeout(shard)
+        raise
+    finally:
+        metrics.observe('commandwave_subprocess_duration_seconds', time.perf_counter() - started,
+                        program='tmux', operation='exec')
+
+def run_tmux(args, timeout=5, shard=0):
+    """Runs a single tmux command; see run_tmux_commands."""
+    return run_tmux_commands([args], timeout, shard)
+
+def tmux_send_keys(session_name, command, timeout=5, shard=0):
+    """Types `command` into a tmux session literally, pressing Enter after each line."""
+    lines = command[:-1] if command.endswith('\n') else command
+    commands = []
+    for line in lines.split('\n'):
+        line = line.rstrip('\r')
+        if line: commands.append(['send-keys', '-t', session_name, '-l', '--', line])
+        commands.append(['send-keys', '-t', session_name, 'Enter'])
+    return run_tmux_commands(commands, timeout, shard)
+
+def is_tmux_session_missing(stderr):
+    """True if a tmux error message means the target session (or the whole server) is gone."""
+    stderr_lower = stderr.lower()
+    return any(msg in stderr_lower for msg in ("session not found", "can't find", "no server running"))
 
 # <<< Modified function signature and logic >>>
 def start_ttyd_process(port, initial_terminal=False, use_default_config=False):
@@ -88,67 +730,172 @@ def start_ttyd_process(port, initial_terminal=False, use_default_config=False):
     Starts a ttyd process attached to a new tmux session.
     Uses custom config file unless use_default_config is True.
     """
-    if port in _running_ttyd_processes:
-        app.logger.warning(f"ttyd already tracked for port {port}. Aborting start.")
-        return None
-    if is_port_in_use(port):
+    with _terminal_lock:
+        if port in _running_ttyd_processes or port in _starting_ports:
+            app.logger.warning(f"ttyd already tracked for port {port}. Aborting start.")
+            return None
+        _starting_ports.add(port)
+    try:
+        return _launch_ttyd(port, use_default_config)
+    finally:
+        with _terminal_lock: _starting_ports.discard(port)
+
+def _launch_ttyd(port, use_default_config):
+    """Does the work of start_ttyd_process once the port has been claimed."""
+    if TERMINAL_PROXY_PORT:
+        socket_path = terminal_socket_path(port)
+        try: os.unlink(socket_path) # Stale socket from an earlier run
+        except FileNotFoundError: pass
+    elif is_port_in_use(port):
         app.logger.error(f"Port {port} is already in use. Cannot start ttyd.")
         return None
 
     session_name = f'cmd_wave_term_{port}'
+    shard = tmux_shards.assign(port) # Kept for a restart: the session may still live on that server
 
     # Base command parts for tmux
-    tmux_base_cmd = [TMUX_COMMAND]
+    tmux_base_cmd = [TMUX_COMMAND] + tmux_shards.socket_args(shard)
 
     # Conditionally add the -f flag based on the parameter and file existence
     if not use_default_config and os.path.exists(TMUX_CONFIG_FILE):
-        app.logger.info(f"Using custom tmux config: {TMUX_CONFIG_FILE}")
+        app.logger.debug(f"Using custom tmux config: {TMUX_CONFIG_FILE}")
         tmux_base_cmd.extend(['-f', TMUX_CONFIG_FILE])
     elif not use_default_config:
         app.logger.warning(f"Custom tmux config '{TMUX_CONFIG_FILE}' not found. Using default.")
         # No -f flag needed, tmux uses default
     else:
-         app.logger.info("Using default tmux configuration (command-line option specified).")
+         app.logger.debug("Using default tmux configuration (command-line option specified).")
          # No -f flag needed, tmux uses default
 
+    # Create the tmux session up front (detached) so it exists before any browser connects;
+    # ttyd then attaches to it with `new -A`, which also lets several clients share it.
+    try:
+        result = run_tmux(['new-session', '-d', '-s', session_name], shard=shard)
+        if result.returncode != 0 and 'duplicate session' not in result.stderr.lower():
+            app.logger.error(f"Failed to create tmux session '{session_name}': {result.stderr.strip()}")
+            tmux_shards.release(port)
+            return None
+    except FileNotFoundError:
+        app.logger.error(f"'{TMUX_COMMAND}' not found. Ensure it is installed and in PATH.")
+        tmux_shards.release(port)
+        return None
+    except subprocess.TimeoutExpired:
+        app.logger.error(f"Timeout creating tmux session '{session_name}' on shard {shard}.")
+        tmux_shards.release(port)
+        return None
+    if SCROLLBACK_CAPTURE:
+        scrollback.attach(port, session_name)
+
     # Add the rest of the tmux command
-    tmux_base_cmd.extend(['new', '-s', session_name])
+    tmux_base_cmd.extend(['new', '-A', '-s', session_name])
 
     # Construct the full ttyd command
-    ttyd_cmd = [TTYD_COMMAND, '-p', str(port), '-W'] + tmux_base_cmd
+    if TERMINAL_PROXY_PORT:
+        # Listen on a Unix socket and expect requests under the proxy's /term/<id> prefix
+        listen_args = ['-i', socket_path, '-b', f'/term/{port}']
+    else:
+        listen_args = ['-p', str(port)]
+    ttyd_cmd = [TTYD_COMMAND] + listen_args + ['-W'] + tmux_base_cmd
 
     try:
-        app.logger.info(f"Attempting: {' '.join(shlex.quote(arg) for arg in ttyd_cmd)}")
+        app.logger.debug(f"Attempting: {' '.join(shlex.quote(arg) for arg in ttyd_cmd)}")
+        started = time.perf_counter()
         process = subprocess.Popen(ttyd_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        _running_ttyd_processes[port] = process
-        _running_tmux_sessions[port] = session_name
-        app.logger.info(f"Started ttyd (PID: {process.pid}) <-> tmux '{session_name}' on port {port}")
+        metrics.observe('commandwave_subprocess_duration_seconds', time.perf_counter() - started,
+                        program='ttyd', operation='spawn')
+        with _terminal_lock:
+            _running_ttyd_processes[port] = process
+            _running_tmux_sessions[port] = session_name
+        app.logger.info(f"Started ttyd (PID: {process.pid}) <-> tmux '{session_name}' on port {port}"
+                        + (f" (shard {shard})" if tmux_shards.count > 1 else ''))
         return process
     except FileNotFoundError:
         app.logger.error(f"'{TTYD_COMMAND}' or '{TMUX_COMMAND}' not found. Ensure they are installed and in PATH.")
     except Exception as e:
         app.logger.error(f"Failed to start ttyd process on port {port}: {e}", exc_info=True)
 
-    if port in _running_ttyd_processes: del _running_ttyd_processes[port]
-    if port in _running_tmux_sessions: del _running_tmux_sessions[port]
+    with _terminal_lock:
+        _running_ttyd_processes.pop(port, None)
+        _running_tmux_sessions.pop(port, None)
+    # Don't leave the detached session behind if ttyd could not be started
+    try: run_tmux(['kill-session', '-t', session_name], timeout=2, shard=shard)
+    except Exception as e: app.logger.warning(f"Could not remove tmux session {session_name}: {e}")
+    tmux_shards.release(port)
     return None
 
+def terminal_socket_path(port):
+    """Unix socket ttyd listens on for terminal `port` in single-port mode."""
+    return os.path.join(TERMINAL_SOCKET_DIR, f'term-{port}.sock')
+
+def terminal_url(port, host='localhost'):
+    """URL the browser loads for a terminal: ttyd's own port, or the proxy's /term/<id>/ path."""
+    if TERMINAL_PROXY_PORT:
+        return f'http://{host}:{TERMINAL_PROXY_PORT}/term/{port}/'
+    return f'http://localhost:{port}'
+
+def _connect_to_ttyd(port):
+    """Opens (and returns) a connection to ttyd's listening socket; raises OSError if it isn't listening."""
+    if TERMINAL_PROXY_PORT:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(0.2)
+        try:
+            s.connect(terminal_socket_path(port))
+        except OSError:
+            s.close()
+            raise
+        return s
+    return socket.create_connection(('127.0.0.1', port), timeout=0.2)
+
+def wait_for_ttyd_ready(process, port, timeout=TTYD_READY_TIMEOUT):
+    """
+    Health-checks a freshly started ttyd: returns True as soon as it accepts connections,
+    False if it exits first. If it is still running but silent at the deadline it is trusted.
+    """
+    started = time.perf_counter()
+    try:
+        return _poll_ttyd_ready(process, port, started + timeout, timeout)
+    finally:
+        metrics.observe('commandwave_subprocess_duration_seconds', time.perf_counter() - started,
+                        program='ttyd', operation='ready')
+
+def _poll_ttyd_ready(process, port, deadline, timeout):
+    while True:
+        if process.poll() is not None:
+            return False
+        try:
+            with _connect_to_ttyd(port):
+                return True
+        except OSError:
+            pass
+        if time.perf_counter() >= deadline:
+            app.logger.warning(f"ttyd on port {port} not accepting connections after {timeout}s; assuming it is alive.")
+            return process.poll() is None
+        time.sleep(0.02)
+
 # Modified cleanup_single_terminal to NOT remove notes file
-def cleanup_single_terminal(port):
-    """Cleans up ttyd and tmux processes for a specific port (DOES NOT DELETE NOTES)."""
+def cleanup_single_terminal(port, keep_session=False):
+    """
+    Cleans up ttyd and tmux processes for a specific port (DOES NOT DELETE NOTES).
+    keep_session=True stops only ttyd and leaves the tmux session running for a later restore.
+    """
     cleaned = False
-    session_name = _running_tmux_sessions.pop(port, None)
-    if session_name:
+    # Claim the entries atomically so concurrent deletes don't both act on them
+    with _terminal_lock:
+        session_name = _running_tmux_sessions.pop(port, None)
+        process = _running_ttyd_processes.pop(port, None)
+    shard = tmux_shards.shard_of(port)
+    if session_name and keep_session:
+        app.logger.info(f"Keeping tmux session {session_name} for port {port} alive.")
+        cleaned = True
+    elif session_name:
         try:
              app.logger.info(f"Attempting to kill tmux session: {session_name} for port {port}")
-             kill_cmd = [TMUX_COMMAND, 'kill-session', '-t', session_name]
-             subprocess.run(kill_cmd, timeout=2, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+             run_tmux(['kill-session', '-t', session_name], timeout=2, shard=shard)
              app.logger.info(f"Sent kill command to tmux session: {session_name}")
              cleaned = True
         except Exception as e:
              app.logger.error(f"Error killing tmux session {session_name}: {e}")
 
-    process = _running_ttyd_processes.pop(port, None)
     if process and process.poll() is None:
         try:
              app.logger.info(f"Terminating ttyd process on port {port} (PID: {process.pid})")
@@ -168,6 +915,13 @@ def cleanup_single_terminal(port):
 
     # --- Notes file deletion REMOVED ---
 
+    port_allocator.release(port)
+    tmux_shards.release(port)
+    terminal_pool.drop(port)
+    if not keep_session: session_registry.remove(port)
+    if TERMINAL_PROXY_PORT:
+        try: os.unlink(terminal_socket_path(port))
+        except OSError: pass
     if cleaned: app.logger.info(f"Successfully cleaned up processes for port {port}")
     else: app.logger.warning(f"Could not find active processes to clean up for port {port}")
     return cleaned
@@ -176,20 +930,47 @@ def cleanup_single_terminal(port):
 def cleanup_processes(signal_num=None, frame=None):
     """Cleans up ALL running ttyd and tmux processes on exit or signal (DOES NOT DELETE NOTES)."""
     trigger = f"signal {signal_num}" if signal_num is not None else "atexit"
-    ports_to_clean = set(_running_ttyd_processes.keys()) | set(_running_tmux_sessions.keys())
+    terminal_supervisor.stop() # Don't let it "repair" terminals while they are being shut down
+    with _terminal_lock:
+        ports_to_clean = set(_running_ttyd_processes.keys()) | set(_running_tmux_sessions.keys())
     app.logger.info(f"Cleanup triggered by {trigger}. Cleaning up terminal processes for ports: {list(ports_to_clean)}")
-    for port in ports_to_clean: cleanup_single_terminal(port) # Calls the modified version
+    keep = {port for port, entry in session_registry.entries().items() if not entry.get('pooled')} if KEEP_SESSIONS else set()
+    for port in ports_to_clean: cleanup_single_terminal(port, keep_session=port in keep)
+    tmux_shards.close()
+    regex_workers.close()
+    notes_store.flush()
+    scrollback.stop()
+    if profiler.running:
+        profiler.stop()
+        try:
+            write_file_atomic(PROFILER_OUTPUT_FILE, profiler.report().encode('utf-8'))
+            app.logger.info(f"Profile ({profiler.samples} samples) written to {PROFILER_OUTPUT_FILE}.")
+        except OSError as e:
+            app.logger.error(f"Could not write profile to {PROFILER_OUTPUT_FILE}: {e}")
     if signal_num is not None and not os.environ.get('WERKZEUG_RUN_MAIN'):
         exit_code = 128 + signal_num
         app.logger.info(f"Exiting script with code {exit_code} due to signal {signal_num}.")
         sys.stdout.flush(); sys.stderr.flush(); os._exit(exit_code)
 
-atexit.register(cleanup_processes)
-try:
-    signal.signal(signal.SIGINT, cleanup_processes); signal.signal(signal.SIGTERM, cleanup_processes)
-    app.logger.info("Registered signal handlers for SIGINT and SIGTERM.")
-except (ValueError, AttributeError, OSError) as e:
-    app.logger.warning(f"Could not set signal handlers: {e}. Cleanup might not run on Ctrl+C/kill.")
+_runtime_initialized = False
+
+def init_runtime():
+    """
+    Process-level setup deferred from import time: data directories, exit cleanup and
+    signal handlers. Called once from __main__ (and by anything embedding the app that
+    starts terminals); importing the module stays side-effect free.
+    """
+    global _runtime_initialized
+    if _runtime_initialized: return
+    _runtime_initialized = True
+    for directory in (UPLOAD_FOLDER, NOTES_DIR, PLAYBOOKS_DIR):
+        os.makedirs(directory, exist_ok=True)
+    atexit.register(cleanup_processes)
+    try:
+        signal.signal(signal.SIGINT, cleanup_processes); signal.signal(signal.SIGTERM, cleanup_processes)
+        app.logger.info("Registered signal handlers for SIGINT and SIGTERM.")
+    except (ValueError, AttributeError, OSError) as e:
+        app.logger.warning(f"Could not set signal handlers: {e}. Cleanup might not run on Ctrl+C/kill.")
 
 
 # --- Notes API Endpoints ---
@@ -204,276 +985,2537 @@ def sanitize_terminal_id(terminal_id):
     app.logger.warning(f"Invalid terminal_id format received: {terminal_id}")
     return None # Invalid format
 
-@app.route('/api/notes/global', methods=['GET'])
-def get_global_notes():
-    filepath = os.path.join(NOTES_DIR, "global_notes.txt")
+def write_file_atomic(path, data):
+    """Replaces `path` with `data` (bytes) via a synced temp file and rename, so readers never see a partial file."""
+    directory, filename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{filename}.', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try: os.unlink(tmp_path)
+        except OSError: pass
+        raise
+
+def diff_text(old, new):
+    """Smallest single replacement turning `old` into `new`, as (start, end, inserted text)."""
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]: prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]: suffix += 1
+    return prefix, len(old) - suffix, new[prefix:len(new) - suffix]
+
+class NotesConflictError(Exception):
+    """A patch was based on a version of the notes that is no longer current."""
+    def __init__(self, version):
+        super().__init__(f"Notes changed since version provided (current version {version})")
+        self.version = version
+
+class NotesStore:
+    """
+    In-memory notes documents with write-behind persistence. Saves update memory and bump
+    the document's version; a background flusher writes each changed file at most once per
+    NOTES_FLUSH_INTERVAL, atomically (temp file + fsync + rename), so a crash can never leave
+    a truncated notes file. Clients may send a patch {base_epoch, base_version, start, end, text}
+    instead of the whole text; start/end are code point offsets into the base version.
+    Versions start at 1 when a file is first loaded in this process, so they are only
+    meaningful together with the store's epoch, a random token chosen per process: a
+    patch must name both (base_epoch, base_version), and one from before a restart is
+    a conflict rather than being applied to whatever now has the same version number.
+    """
+
+    def __init__(self, notes_dir, flush_interval=NOTES_FLUSH_INTERVAL):
+        self.notes_dir = notes_dir
+        self.flush_interval = flush_interval
+        self._docs = {} # filename -> {'text', 'version', 'dirty'}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self.epoch = secrets.token_hex(8)
+        self.saves = 0 # Accepted saves that changed the text
+        self.noop_saves = 0 # Saves whose text was already current
+        self.writes = 0 # Files actually written to disk
+        self.bytes_written = 0
+
+    def _doc_locked(self, filename):
+        doc = self._docs.get(filename)
+        if doc is None:
+            filepath = os.path.join(self.notes_dir, filename)
+            try:
+                with open(filepath, 'r', encoding='utf-8') as f:
+                    text = f.read()
+            except FileNotFoundError:
+                text = ""
+            doc = self._docs[filename] = {'text': text, 'version': 1, 'dirty': False}
+        return doc
+
+    def get(self, filename):
+        """Returns (text, version) for a notes file."""
+        with self._lock:
+            doc = self._doc_locked(filename)
+            return doc['text'], doc['version']
+
+    def save(self, filename, text=None, patch=None):
+        """
+        Replaces the text, or applies `patch`, and schedules a flush. Returns (version,
+        applied_patch); applied_patch is None if nothing changed, otherwise the single-range
+        patch from the previous version (computed for full-text saves too). Raises
+        NotesConflictError if the patch's base_epoch/base_version is stale and ValueError if it
+        is malformed.
+        """
+        with self._lock:
+            doc = self._doc_locked(filename)
+            if patch is not None:
+                if patch.get('base_epoch') != self.epoch or patch.get('base_version') != doc['version']:
+                    raise NotesConflictError(doc['version'])
+                start, end, insert = patch.get('start'), patch.get('end'), patch.get('text', '')
+                if not (isinstance(start, int) and isinstance(end, int) and isinstance(insert, str)) \
+                        or not 0 <= start <= end <= len(doc['text']):
+                    raise ValueError("Invalid notes patch")
+                text = doc['text'][:start] + insert + doc['text'][end:]
+            if text == doc['text']:
+                self.noop_saves += 1
+                return doc['version'], None
+            if patch is None:
+                start, end, insert = diff_text(doc['text'], text)
+            applied = {'base_version': doc['version'], 'start': start, 'end': end, 'text': insert}
+            doc['text'] = text
+            doc['version'] += 1
+            doc['dirty'] = True
+            self.saves += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='notes-flusher', daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+            return doc['version'], applied
+
+    def _write_file(self, filename, text):
+        data = text.encode('utf-8')
+        os.makedirs(self.notes_dir, exist_ok=True)
+        write_file_atomic(os.path.join(self.notes_dir, filename), data)
+        return len(data)
+
+    def flush(self):
+        """Writes every changed document now. Failed writes stay dirty and are retried."""
+        with self._lock:
+            pending = [(name, doc['text'], doc['version']) for name, doc in self._docs.items() if doc['dirty']]
+        for filename, text, version in pending:
+            try:
+                size = self._write_file(filename, text)
+            except OSError as e:
+                app.logger.error(f"Error saving notes file {filename}: {e}", exc_info=True)
+                continue
+            with self._lock:
+                doc = self._docs[filename]
+                if doc['version'] == version: doc['dirty'] = False # Otherwise newer edits are still pending
+                self.writes += 1
+                self.bytes_written += size
+            metrics.observe('commandwave_notes_write_bytes', size)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not any(doc['dirty'] for doc in self._docs.values()):
+                    self._wakeup.wait()
+            time.sleep(self.flush_interval) # Let further edits pile up before writing
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            return {'documents': len(self._docs), 'dirty': sum(doc['dirty'] for doc in self._docs.values()),
+                    'saves': self.saves, 'noop_saves': self.noop_saves,
+                    'writes': self.writes, 'bytes_written': self.bytes_written}
+
+notes_store = NotesStore(NOTES_DIR)
+
+def tab_notes_filename(terminal_id):
+    return f"tab_notes_{terminal_id}.txt"
+
+def _save_notes(filename, label, scope):
+    """
+    Shared body of the notes POST endpoints: full text via 'notes' or a delta via 'patch'.
+    Changes are announced on /api/events so other open pages can apply them.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or ('notes' not in data and not isinstance(data.get('patch'), dict)):
+        return jsonify({"success": False, "error": "Invalid request body"}), 400
     try:
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                content = f.read()
-            return jsonify({"success": True, "notes": content})
+        if 'patch' in data:
+            version, applied = notes_store.save(filename, patch=data['patch'])
         else:
-            return jsonify({"success": True, "notes": ""}) # Return empty if not found
+            if not isinstance(data['notes'], str):
+                return jsonify({"success": False, "error": "Invalid request body"}), 400
+            version, applied = notes_store.save(filename, text=data['notes'])
+    except NotesConflictError as e:
+        return jsonify({"success": False, "error": str(e), "conflict": True, "version": e.version,
+                        "epoch": notes_store.epoch}), 409
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    if applied is not None:
+        event = dict(scope, epoch=notes_store.epoch, version=version, base_version=applied['base_version'])
+        if len(applied['text']) <= EVENTS_MAX_NOTES_DELTA:
+            event['patch'] = {'start': applied['start'], 'end': applied['end'], 'text': applied['text']}
+        event_broker.publish('notes_updated', event)
+    return jsonify({"success": True, "message": f"{label} saved", "version": version, "epoch": notes_store.epoch,
+                    "changed": applied is not None})
+
+def _load_notes(filename, label):
+    try:
+        text, version = notes_store.get(filename)
+        return jsonify({"success": True, "notes": text, "version": version, "epoch": notes_store.epoch})
     except Exception as e:
-        app.logger.error(f"Error reading global notes: {e}", exc_info=True)
-        return jsonify({"success": False, "error": "Failed to read global notes"}), 500
+        app.logger.error(f"Error reading {label}: {e}", exc_info=True)
+        return jsonify({"success": False, "error": f"Failed to read {label}"}), 500
+
+@app.route('/api/notes/global', methods=['GET'])
+def get_global_notes():
+    return _load_notes("global_notes.txt", "global notes")
 
 @app.route('/api/notes/global', methods=['POST'])
 def save_global_notes():
-    filepath = os.path.join(NOTES_DIR, "global_notes.txt")
-    data = request.get_json()
-    if data is None or 'notes' not in data:
-        return jsonify({"success": False, "error": "Invalid request body"}), 400
-    try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(data['notes'])
-        return jsonify({"success": True, "message": "Global notes saved"})
-    except Exception as e:
-        app.logger.error(f"Error saving global notes: {e}", exc_info=True)
-        return jsonify({"success": False, "error": "Failed to save global notes"}), 500
+    return _save_notes("global_notes.txt", "Global notes", {'scope': 'global'})
 
 @app.route('/api/notes/tab/<terminal_id>', methods=['GET'])
 def get_tab_notes(terminal_id):
     safe_terminal_id = sanitize_terminal_id(terminal_id)
     if not safe_terminal_id:
         return jsonify({"success": False, "error": "Invalid terminal ID format"}), 400
-
-    filename = f"tab_notes_{safe_terminal_id}.txt"
-    filepath = os.path.join(NOTES_DIR, filename)
-    try:
-        if os.path.exists(filepath):
-            with open(filepath, 'r', encoding='utf-8') as f:
-                content = f.read()
-            return jsonify({"success": True, "notes": content})
-        else:
-             # If file doesn't exist, return empty notes successfully
-            return jsonify({"success": True, "notes": ""})
-    except Exception as e:
-        app.logger.error(f"Error reading notes for {safe_terminal_id}: {e}", exc_info=True)
-        return jsonify({"success": False, "error": f"Failed to read notes for {safe_terminal_id}"}), 500
+    return _load_notes(tab_notes_filename(safe_terminal_id), f"notes for {safe_terminal_id}")
 
 @app.route('/api/notes/tab/<terminal_id>', methods=['POST'])
 def save_tab_notes(terminal_id):
     safe_terminal_id = sanitize_terminal_id(terminal_id)
     if not safe_terminal_id:
         return jsonify({"success": False, "error": "Invalid terminal ID format"}), 400
-
-    data = request.get_json()
-    if data is None or 'notes' not in data:
-        return jsonify({"success": False, "error": "Invalid request body"}), 400
-
-    filename = f"tab_notes_{safe_terminal_id}.txt"
-    filepath = os.path.join(NOTES_DIR, filename)
-    try:
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(data['notes'])
-        return jsonify({"success": True, "message": f"Notes saved for {safe_terminal_id}"})
-    except Exception as e:
-        app.logger.error(f"Error saving notes for {safe_terminal_id}: {e}", exc_info=True)
-        return jsonify({"success": False, "error": f"Failed to save notes for {safe_terminal_id}"}), 500
+    return _save_notes(tab_notes_filename(safe_terminal_id), f"Notes for {safe_terminal_id}",
+                       {'scope': 'tab', 'terminal_id': safe_terminal_id})
 
 # --- END Notes API Endpoints ---
 
 # --- Playbook Search and Load API Endpoints ---
 
-# <<< search_playbooks function including line context >>>
-@app.route('/api/playbooks/search', methods=['GET'])
-def search_playbooks():
-    """API endpoint to search for keywords in local .md playbooks and return matching lines."""
-    query = request.args.get('query', '').strip()
-    if not query or len(query) < 2: # Optional: Add minimum query length
-        return jsonify({"success": True, "matches": []})
-
-    if not os.path.isdir(PLAYBOOKS_DIR):
-         app.logger.error(f"Playbooks directory not found: {PLAYBOOKS_DIR}")
-         return jsonify({"success": False, "error": "Playbooks directory not found on server."}), 500
+# --- Playbook Search Index ---
 
-    matches = []
-    query_lower = query.lower()
-    try:
-        search_pattern = os.path.join(PLAYBOOKS_DIR, '*.md')
-        for filepath in glob.glob(search_pattern):
-            filename = os.path.basename(filepath)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    # Read line by line
-                    for line_num, line in enumerate(f, 1):
-                         line_content = line.strip()
-                         # Check if query is in the line (case-insensitive)
-                         if query_lower in line_content.lower():
-                             # Add filename, line number, and content to matches
-                             matches.append({
-                                 "filename": filename,
-                                 "line_number": line_num,
-                                 "line_content": line_content
-                             })
-                             # Optional: Break after first match in a file to keep results shorter
-                             # break
+def _trigrams(text):
+    """Returns the set of 3-character substrings of an (already lowercased) string."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
 
-            except Exception as e:
-                app.logger.warning(f"Could not read or search file {filename}: {e}")
+def _char_mask(word):
+    """Bit set of the characters in a word (folded onto 64 bits), for the fuzzy search prefilter."""
+    mask = 0
+    for ch in word: mask |= 1 << (ord(ch) & 63)
+    return mask
 
-        # Optional: Sort matches primarily by filename, then by line number
-        matches.sort(key=lambda x: (x['filename'], x['line_number']))
+_index_generations = itertools.count(1) # Unique across PlaybookIndex instances (see SearchQuery)
 
-        # Optional: Limit total number of matches returned
-        # MAX_MATCHES = 50
-        # matches = matches[:MAX_MATCHES]
+def _code_languages(lines):
+    """For each stripped line, the language of the fenced code block it is in, or None (text and fences)."""
+    languages, fence, language = [], None, None
+    for line in lines:
+        if fence is None:
+            m = _FENCE_RE.match(line)
+            if m: fence, language = m.group(1), (m.group(2) or 'plaintext').lower()
+            languages.append(None)
+        elif line.startswith(fence[0] * len(fence)) and not line.strip(fence[0]):
+            fence = None
+            languages.append(None)
+        else:
+            languages.append(language)
+    return languages
 
-        return jsonify({"success": True, "matches": matches})
-    except Exception as e:
-        app.logger.error(f"Error during playbook search for query '{query}': {e}", exc_info=True)
-        return jsonify({"success": False, "error": "Server error during playbook search."}), 500
+_HEADING_RE = re.compile(r'^(#{1,6})\s+(.+?)\s*#*\s*$')
+_TAGS_LINE_RE = re.compile(r'^\s*tags\s*:\s*(.*)$', re.IGNORECASE)
 
-# <<< CORRECTED load_playbook_content function >>>
-@app.route('/api/playbooks/load/<path:filename>', methods=['GET'])
-def load_playbook_content(filename):
-    """API endpoint to get the content of a specific playbook file."""
-    
-    # Basic validation - check for empty name or non-markdown extension after decoding
-    if not filename or not filename.endswith('.md'):
-        app.logger.warning(f"Attempt to load invalid playbook filename (empty or not .md): {filename}")
-        return jsonify({"success": False, "error": "Invalid filename format."}), 400
-        
-    # --- SECURITY CHECK: Prevent Directory Traversal ---
-    # Construct the full path *using the potentially space-containing filename*
-    requested_path = os.path.join(PLAYBOOKS_DIR, filename)
-    
-    # Get the absolute path of the requested file and the allowed directory
-    abs_requested_path = os.path.abspath(requested_path)
-    abs_playbooks_dir = os.path.abspath(PLAYBOOKS_DIR)
-    
-    # Check if the requested path is still within the allowed PLAYBOOKS_DIR
-    # os.path.commonpath is a good way to check this on POSIX/Windows
-    # Important: Ensure PLAYBOOKS_DIR exists for commonpath to work as expected
-    if not os.path.isdir(abs_playbooks_dir):
-        app.logger.error(f"Playbook directory configured but not found at: {abs_playbooks_dir}")
-        return jsonify({"success": False, "error": "Server configuration error: Playbook directory missing."}), 500
+def _split_tags(value):
+    return [t.strip().strip('\'"').lstrip('#') for t in value.strip().strip('[]').split(',') if t.strip().strip('\'"#')]
 
-    if os.path.commonpath([abs_requested_path, abs_playbooks_dir]) != abs_playbooks_dir:
-        app.logger.error(f"Directory traversal attempt detected for playbook: {filename}")
-        return jsonify({"success": False, "error": "Access denied."}), 403
-    # --- END SECURITY CHECK ---
+def parse_playbook_metadata(content, playbook_id):
+    """
+    Catalog metadata for a playbook: title (first level-1 heading, else first heading,
+    else the file name), headings outside code blocks, tags (a `tags:` key in YAML front
+    matter, inline list or "- item" lines, or a "Tags: a, b" line) and fenced command blocks.
+    """
+    lines = content.split('\n')
+    tags = []
+    if lines and lines[0].strip() == '---':
+        in_tags = False
+        for line in lines[1:]:
+            if line.strip() == '---': break
+            m = _TAGS_LINE_RE.match(line)
+            if m:
+                tags.extend(_split_tags(m.group(1)))
+                in_tags = not m.group(1).strip()
+            elif in_tags and line.strip().startswith('- '):
+                tags.extend(_split_tags(line.strip()[2:]))
+            else:
+                in_tags = False
+    headings, commands = [], []
+    for block in extract_playbook_blocks(content):
+        if block['type'] == 'code':
+            commands.append({'language': block['language'], 'content': block['content']})
+            continue
+        for line in block['content'].split('\n'):
+            m = _HEADING_RE.match(line)
+            if m:
+                headings.append({'level': len(m.group(1)), 'text': m.group(2)})
+            elif not tags:
+                m = _TAGS_LINE_RE.match(line)
+                if m: tags.extend(_split_tags(m.group(1)))
+    title = next((h['text'] for h in headings if h['level'] == 1), headings[0]['text'] if headings else None)
+    if title is None:
+        title = os.path.splitext(playbook_id.rsplit('/', 1)[-1])[0]
+    return {'title': title, 'headings': headings, 'tags': sorted(set(tags), key=str.lower), 'commands': commands}
 
-    # Now use the potentially space-containing path for the existence check
-    if not os.path.isfile(abs_requested_path):
-         app.logger.error(f"Playbook file not found at calculated path: {abs_requested_path}")
-         raise NotFound(f"Playbook '{filename}' not found.") # Let Flask handle 404
+class PlaybookIndex:
+    """
+    Resident index of every line in the .md files under one or more playbook roots,
+    searched recursively (hidden entries and symlinked directories are skipped).
 
-    try:
-        # Read the file using the validated absolute path
-        with open(abs_requested_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        # Return the original filename as requested by the client for consistency
-        return jsonify({"success": True, "filename": filename, "content": content}) 
-    except Exception as e:
-        app.logger.error(f"Error reading playbook file {filename} at {abs_requested_path}: {e}", exc_info=True)
-        return jsonify({"success": False, "error": f"Failed to read playbook '{filename}'."}), 500
+    Playbooks are identified by their path relative to their root ('/'-separated),
+    prefixed with the root's label (its directory name) when there are several roots.
+    Lines are kept in memory (original and lowercased) together with a trigram
+    posting list, so substring queries are answered without touching disk.
+    refresh() compares each file's mtime/size with what was indexed and only
+    re-reads files that were added or changed; directories are only re-listed when
+    their own mtime changes. start_polling() runs it periodically.
 
+    Each indexed file also has catalog metadata (see parse_playbook_metadata, plus
+    mtime, size and sha256) that is saved to `catalog_path`, so a restart reuses it
+    for unchanged files instead of parsing them again.
+    """
 
-# --- END Playbook API Endpoints ---
+    def __init__(self, roots, catalog_path=None):
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock() # Held by whichever thread is doing the first build
+        self.catalog_path = catalog_path
+        self.set_roots(roots)
+        self._stop_event = threading.Event()
+        self._poll_thread = None
 
+    def set_roots(self, roots):
+        """(Re)defines the playbook roots (a directory or a list of them) and empties the index."""
+        if isinstance(roots, str): roots = [roots]
+        labels, seen = [], {}
+        for root in roots:
+            base = os.path.basename(os.path.abspath(root)) or 'root'
+            seen[base] = seen.get(base, 0) + 1
+            labels.append(base if seen[base] == 1 else f"{base}-{seen[base]}")
+        with self._lock:
+            self.roots = list(zip(labels, roots)) # [(label, directory)]
+            self._files = {}     # playbook id -> {'path', 'mtime_ns', 'size', 'meta', 'lines': [line tuples in file order]}
+            self._lines = {}     # line_id -> (line_id, playbook id, line_number, line_content, line_lower)
+            self._postings = {}  # trigram -> set of line_ids
+            self._vocab = {}     # word -> number of indexed lines containing it (fuzzy search)
+            self._vocab_by_length = {} # word length -> {word: character mask (see _char_mask)}
+            self._next_line_id = 0
+            self.generation = next(_index_generations) # Changes whenever the indexed content does
+            self._dir_cache = {} # directory -> (mtime_ns, [.md file paths], [subdirectories])
+            self._persisted = None # Catalog entries loaded from catalog_path, used by the first refresh
+            self._built = False
 
-# --- Terminal Management Endpoints ---
-@app.route('/api/terminals/new', methods=['POST'])
-def new_terminal():
-    """API endpoint to start a new ttyd/tmux terminal instance."""
-    global _next_ttyd_port, USE_DEFAULT_TMUX_CONFIG_FLAG # <<< Need global flag here
+    def has_roots(self):
+        return any(os.path.isdir(directory) for _, directory in self.roots)
 
-    found_port = find_available_port(_next_ttyd_port, _max_ttyd_port)
-    if found_port is None:
-        return jsonify({'success': False, 'error': 'No available ports found.'}), 503
+    def _playbook_id(self, label, root, path):
+        rel = os.path.relpath(path, root).replace(os.sep, '/')
+        return f"{label}/{rel}" if len(self.roots) > 1 else rel
 
-    current_start_port = _next_ttyd_port
-    _next_ttyd_port = found_port + 1
-    if _next_ttyd_port > _max_ttyd_port: _next_ttyd_port = 7682 # Wrap around
+    def _scan_roots(self):
+        """Returns {playbook id: (path, os.stat_result)} for the .md files currently under the roots."""
+        found, dir_cache = {}, {}
+        for label, root in self.roots:
+            stack = [root]
+            while stack:
+                directory = stack.pop()
+                try:
+                    dir_mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+                listing = self._dir_cache.get(directory)
+                if listing is None or listing[0] != dir_mtime:
+                    files, subdirs = [], []
+                    try:
+                        with os.scandir(directory) as entries:
+                            for entry in entries:
+                                if entry.name.startswith('.'): continue
+                                try:
+                                    if entry.is_dir(follow_symlinks=False): subdirs.append(entry.path)
+                                    elif entry.name.endswith('.md') and entry.is_file(): files.append(entry.path)
+                                except OSError:
+                                    continue
+                    except OSError:
+                        continue
+                    listing = (dir_mtime, files, subdirs)
+                dir_cache[directory] = listing
+                stack.extend(listing[2])
+                for path in listing[1]:
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        found.setdefault(self._playbook_id(label, root, path), (path, st))
+        self._dir_cache = dir_cache
+        return found
 
-    # <<< Pass the global flag to the start function >>>
-    process = start_ttyd_process(found_port, use_default_config=USE_DEFAULT_TMUX_CONFIG_FLAG)
-    if process:
+    def _read_file(self, playbook_id, path):
+        """Reads a playbook and returns (text with newlines normalised, sha256), or None if unreadable."""
         try:
-            process.wait(timeout=0.5)
-            app.logger.error(f"ttyd process on port {found_port} exited immediately.")
-            if found_port in _running_ttyd_processes: del _running_ttyd_processes[found_port]
-            if found_port in _running_tmux_sessions: del _running_tmux_sessions[found_port]
-            _next_ttyd_port = current_start_port
-            return jsonify({'success': False, 'error': 'Terminal process failed to start properly.'}), 500
-        except subprocess.TimeoutExpired:
-            app.logger.info(f"New terminal OK: PID {process.pid} on port {found_port}.")
-            return jsonify({'success': True, 'port': found_port, 'url': f'http://localhost:{found_port}'}), 200
-    else:
-        _next_ttyd_port = current_start_port
-        return jsonify({'success': False, 'error': 'Failed to start terminal process.'}), 500
+            with open(path, 'rb') as f:
+                data = f.read()
+            metrics.inc('commandwave_playbook_bytes_read_total', len(data), reader='index')
+            text = data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+            return text, hashlib.sha256(data).hexdigest()
+        except Exception as e:
+            app.logger.warning(f"Could not read or index file {playbook_id}: {e}")
+            return None
 
-@app.route('/api/terminals/sendkeys', methods=['POST'])
-def send_keys_to_terminal():
-    """API endpoint to send command/keys to a specific tmux session."""
-    data = request.get_json()
-    if not data: return jsonify({'success': False, 'error': 'Invalid JSON body.'}), 400
+    def _remove_file_locked(self, playbook_id):
+        entry = self._files.pop(playbook_id, None)
+        if not entry:
+            return
+        for line_id, _, _, _, line_lower in entry['lines']:
+            del self._lines[line_id]
+            for gram in _trigrams(line_lower):
+                ids = self._postings.get(gram)
+                if ids is not None:
+                    ids.discard(line_id)
+                    if not ids: del self._postings[gram]
+            for word in set(_WORD_RE.findall(line_lower)):
+                if self._vocab[word] == 1:
+                    del self._vocab[word]
+                    del self._vocab_by_length[len(word)][word]
+                else:
+                    self._vocab[word] -= 1
 
-    port = data.get('port')
-    command = data.get('command')
+    def _add_file_locked(self, playbook_id, path, st, lines, meta):
+        entries = []
+        for line_num, line_content in enumerate(lines, 1):
+            line_id = self._next_line_id
+            self._next_line_id += 1
+            line_lower = line_content.lower()
+            entry = (line_id, playbook_id, line_num, line_content, line_lower)
+            self._lines[line_id] = entry
+            for gram in _trigrams(line_lower):
+                self._postings.setdefault(gram, set()).add(line_id)
+            for word in set(_WORD_RE.findall(line_lower)):
+                count = self._vocab.get(word, 0)
+                if not count: self._vocab_by_length.setdefault(len(word), {})[word] = _char_mask(word)
+                self._vocab[word] = count + 1
+            entries.append(entry)
+        # The per-file list is never mutated after this point; re-indexing swaps in a new one
+        self._files[playbook_id] = {'path': path, 'mtime_ns': st.st_mtime_ns, 'size': st.st_size,
+                                    'meta': meta, 'lines': entries, 'code_langs': _code_languages(lines)}
 
-    if port is None or command is None: return jsonify({'success': False, 'error': 'Missing "port" or "command".'}), 400
-    try: port = int(port)
-    except ValueError: return jsonify({'success': False, 'error': 'Invalid port number.'}), 400
+    def _load_catalog(self):
+        """Catalog entries saved by an earlier run for the same roots ({} if there are none)."""
+        if not self.catalog_path: return {}
+        try:
+            with open(self.catalog_path, 'r', encoding='utf-8') as f:
+                catalog = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            app.logger.warning(f"Ignoring unreadable playbook catalog {self.catalog_path}: {e}")
+            return {}
+        if catalog.get('roots') != [[label, os.path.abspath(d)] for label, d in self.roots]:
+            return {}
+        return catalog.get('playbooks', {})
 
-    session_name = _running_tmux_sessions.get(port)
-    if not session_name:
-        app.logger.error(f"Send keys failed: No active tmux session found for port {port}.")
-        if port in _running_ttyd_processes:
-             proc = _running_ttyd_processes.pop(port, None)
-             if proc and proc.poll() is None: proc.kill()
-        return jsonify({'success': False, 'error': f'No active terminal session for port {port}.'}), 404
+    def _save_catalog(self):
+        if not self.catalog_path: return
+        with self._lock:
+            catalog = {'roots': [[label, os.path.abspath(d)] for label, d in self.roots],
+                       'playbooks': {pid: dict(e['meta'], mtime_ns=e['mtime_ns'], size=e['size'])
+                                     for pid, e in self._files.items()}}
+        try:
+            write_file_atomic(self.catalog_path, json.dumps(catalog).encode('utf-8'))
+        except OSError as e:
+            app.logger.warning(f"Could not save playbook catalog {self.catalog_path}: {e}")
 
-    app.logger.info(f"Sending keys to tmux '{session_name}' (Port: {port})")
-    try:
-        cmd_to_send = command if command.endswith('\n') else command + "\n"
-        send_keys_cmd = [TMUX_COMMAND, 'send-keys', '-t', session_name, cmd_to_send]
-        result = subprocess.run(send_keys_cmd, check=False, capture_output=True, text=True, timeout=5)
+    def refresh(self):
+        """Brings the index in line with the roots. Returns (added, updated, removed) counts."""
+        if self._persisted is None:
+            self._persisted = self._load_catalog()
+        on_disk = self._scan_roots()
+        with self._lock:
+            known = {pid: (e['mtime_ns'], e['size']) for pid, e in self._files.items()}
+        removed = [pid for pid in known if pid not in on_disk]
+        changed = [pid for pid, (_, st) in on_disk.items()
+                   if known.get(pid) != (st.st_mtime_ns, st.st_size)]
 
-        if result.returncode == 0:
-            app.logger.info(f"Keys sent successfully to tmux '{session_name}'.")
-            return jsonify({'success': True, 'message': 'Command sent successfully.'}), 200
-        else:
-            stderr_lower = result.stderr.lower()
-            if "session not found" in stderr_lower or "no server running" in stderr_lower:
-                 app.logger.error(f"Tmux error: Session '{session_name}' not found or server dead.")
-                 if port in _running_tmux_sessions: del _running_tmux_sessions[port]
-                 if port in _running_ttyd_processes:
-                     proc = _running_ttyd_processes.pop(port, None)
-                     if proc and proc.poll() is None: proc.kill()
-                 return jsonify({'success': False, 'error': f'Tmux session "{session_name}" not found.'}), 404
+        # Read changed files outside the lock so searches are not held up by disk I/O
+        loaded = {}
+        for playbook_id in changed:
+            path, st = on_disk[playbook_id]
+            result = self._read_file(playbook_id, path)
+            if result is None: continue
+            text, digest = result
+            lines = text.split('\n')
+            if lines[-1] == '': lines.pop() # Trailing newline, as in iterating over the file
+            lines = [line.strip() for line in lines]
+            saved = self._persisted.get(playbook_id)
+            if saved and saved.get('sha256') == digest:
+                meta = {k: saved[k] for k in ('title', 'headings', 'tags', 'commands')}
             else:
-                app.logger.error(f"Tmux error sending keys. RC: {result.returncode}, Stderr: {result.stderr.strip()}")
-                return jsonify({'success': False, 'error': f'Tmux error: {result.stderr.strip()}'}), 500
+                meta = parse_playbook_metadata(text, playbook_id)
+            meta['sha256'] = digest
+            loaded[playbook_id] = (path, st, lines, meta)
 
-    except FileNotFoundError:
-        app.logger.error(f"'{TMUX_COMMAND}' not found. Cannot send keys.")
-        return jsonify({'success': False, 'error': f"'{TMUX_COMMAND}' command not found."}), 500
-    except subprocess.TimeoutExpired:
-        app.logger.error(f"Timeout sending keys to tmux '{session_name}'.")
-        return jsonify({'success': False, 'error': 'Timeout sending command.'}), 500
-    except Exception as e:
-        app.logger.error(f"Unexpected error sending keys: {e}", exc_info=True)
-        return jsonify({'success': False, 'error': 'Unexpected server error sending keys.'}), 500
+        with self._lock:
+            for playbook_id in removed: self._remove_file_locked(playbook_id)
+            for playbook_id, (path, st, lines, meta) in loaded.items():
+                self._remove_file_locked(playbook_id)
+                self._add_file_locked(playbook_id, path, st, lines, meta)
+            if loaded or removed: self.generation = next(_index_generations)
+            self._built = True
+        self._persisted = {}
 
-# Modified DELETE route to NOT remove notes file implicitly
-@app.route('/api/terminals/<int:port>', methods=['DELETE'])
-def delete_terminal(port):
-    """API endpoint to stop and clean up a specific terminal instance's processes."""
-    app.logger.info(f"Received request to delete terminal processes for port: {port}")
-    if port == _initial_ttyd_port:
-        return jsonify({'success': False, 'error': 'Cannot delete the main terminal.'}), 403
+        added = sum(1 for pid in loaded if pid not in known)
+        updated = len(loaded) - added
+        if added or updated or removed:
+            app.logger.info(f"Playbook index refreshed: {added} added, {updated} updated, {len(removed)} removed.")
+            self._save_catalog()
+        return added, updated, len(removed)
 
-    is_tracked = port in _running_ttyd_processes or port in _running_tmux_sessions
-    if not is_tracked:
-         app.logger.warning(f"Request to delete untracked terminal port: {port}.")
+    def ensure_built(self):
+        """
+        Builds the index on first use if start-up did not already do it. A search that
+        arrives while another thread is building waits for that build instead of
+        starting a second one.
+        """
+        if self._built: return
+        with self._build_lock:
+            if not self._built: self.refresh()
+
+    def resolve(self, playbook_id):
+        """
+        Maps a playbook id to (absolute root, absolute path) without checking that the
+        path stays inside the root (callers do), or returns None if no root matches.
+        Ids not indexed yet are mapped onto their root by label.
+        """
+        with self._lock:
+            entry = self._files.get(playbook_id)
+            roots = list(self.roots)
+        if len(roots) > 1:
+            label, _, rel = playbook_id.partition('/')
+            root = next((d for l, d in roots if l == label), None)
+            if root is None: return None
+        elif roots:
+            root, rel = roots[0][1], playbook_id
+        else:
+            return None
+        abs_root = os.path.abspath(root)
+        return abs_root, os.path.abspath(entry['path'] if entry else os.path.join(abs_root, rel))
+
+    def catalog(self):
+        """Returns [(playbook id, root label, metadata)] for every indexed playbook, ordered by id."""
+        self.ensure_built()
+        with self._lock:
+            items = sorted(self._files.items())
+        return [(pid, pid.partition('/')[0] if len(self.roots) > 1 else self.roots[0][0],
+                 dict(e['meta'], mtime_ns=e['mtime_ns'], size=e['size'])) for pid, e in items]
+
+    def _lines_containing_locked(self, text_lower):
+        """Returns the ids of lines that may contain text_lower, or None if every line may."""
+        if len(text_lower) < 3:
+            return None
+        # Intersect posting lists, smallest first
+        posting_lists = sorted((self._postings.get(g, set()) for g in _trigrams(text_lower)), key=len)
+        candidates = set(posting_lists[0])
+        for ids in posting_lists[1:]:
+            if not candidates: break
+            candidates &= ids
+        return candidates
+
+    def _root_label(self, playbook_id):
+        return playbook_id.partition('/')[0] if len(self.roots) > 1 else self.roots[0][0]
+
+    def iter_matches(self, query):
+        """
+        Lazily yields (line_id, filename, line_number, line_content, line_lower) for lines
+        matching `query` (a SearchQuery, or a lowercased string for a plain substring), in
+        filename/line order. Callers can stop early; only a snapshot of per-file
+        references is taken under the lock. When the trigram index narrows the query,
+        only the candidate lines are visited, so the cost follows the number of
+        candidates rather than the size of the library. Queries other than a plain
+        substring raise SearchTimeoutError once checking lines takes longer than
+        SEARCH_SCAN_TIME_BUDGET.
+        """
+        if isinstance(query, str): query = SearchQuery([SubstringTerm(query)], query)
+        self.ensure_built()
+        deadline = time.perf_counter() + SEARCH_SCAN_TIME_BUDGET
+        query.precompute(self, deadline)
+        with self._lock:
+            candidates = query.candidates_locked(self)
+            accepted = {pid: e['code_langs'] for pid, e in self._files.items()
+                        if not query.file_terms or query.accepts_file(pid, self._root_label(pid), e['meta'])}
+            if candidates is None:
+                files = [(self._files[pid]['lines'], accepted[pid]) for pid in sorted(accepted)]
+            else: # A file's line ids are allocated in line order, so sorted ids group into ordered runs
+                by_file = {}
+                for line_id in sorted(candidates):
+                    entry = self._lines[line_id]
+                    by_file.setdefault(entry[1], []).append(entry)
+                files = [(by_file[pid], accepted[pid]) for pid in sorted(by_file) if pid in accepted]
+        needle = query.substring
+        scanned = 0
+        try:
+            # Trigram intersection can give false positives, so confirm each match
+            if needle is not None:
+                for lines, _ in files:
+                    for entry in lines:
+                        scanned += 1
+                        if needle in entry[4]: yield entry
+                return
+            batch, batch_lines = [], 0
+            for i, (lines, code_langs) in enumerate(files):
+                batch.append((lines, code_langs))
+                batch_lines += len(lines)
+                if batch_lines < SEARCH_CHECK_BATCH_LINES and i < len(files) - 1: continue
+                if time.perf_counter() > deadline: raise SearchTimeoutError()
+                query.prepare([entry for lines, _ in batch for entry in lines], deadline)
+                for lines, code_langs in batch:
+                    scanned += len(lines)
+                    for entry in lines:
+                        if query.matches(entry, code_langs[entry[2] - 1]): yield entry
+                batch, batch_lines = [], 0
+        finally:
+            metrics.inc('commandwave_playbook_search_lines_scanned_total', scanned)
+
+    def search(self, query):
+        """Returns every indexed line matching query (see iter_matches), ordered by filename and line number."""
+        return [{"filename": f, "line_number": n, "line_content": c}
+                for _, f, n, c, _ in self.iter_matches(query)]
+
+    def stats(self):
+        with self._lock:
+            return {'roots': len(self.roots), 'files': len(self._files), 'lines': len(self._lines),
+                    'trigrams': len(self._postings), 'words': len(self._vocab)}
+
+    def _poll_loop(self, interval):
+        try:
+            self.ensure_built()
+            app.logger.info(f"Playbook index ready: {self.stats()}")
+        except Exception as e:
+            app.logger.error(f"Playbook index build failed: {e}", exc_info=True)
+        while not self._stop_event.wait(interval):
+            try:
+                added, updated, removed = self.refresh()
+                if added or updated or removed:
+                    event_broker.publish('playbooks_updated', {'added': added, 'updated': updated, 'removed': removed})
+            except Exception as e:
+                app.logger.error(f"Playbook index refresh failed: {e}", exc_info=True)
+
+    def start_polling(self, interval=PLAYBOOK_INDEX_POLL_INTERVAL):
+        """Starts a daemon thread that builds the index, then re-checks the roots every `interval` seconds."""
+        if self._poll_thread and self._poll_thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._poll_thread = threading.Thread(target=self._poll_loop, args=(interval,),
+                                             name='playbook-index-poller', daemon=True)
+        self._poll_thread.start()
+
+    def stop_polling(self):
+        self._stop_event.set()
+
+playbook_index = PlaybookIndex(PLAYBOOKS_DIR, PLAYBOOK_CATALOG_FILE)
+
+# --- Playbook Query Engine ---
+# Query syntax (terms are ANDed; a query without any of the syntax below is one plain
+# substring, as before, so paths like /usr/share/wordlists/ are plain text):
+#   "kerberos spray"   phrase (substring)           nmpa~  nmap~2   fuzzy word (typos)
+#   re:nxc\s+smb  re:/nxc\s+smb/   regular expression (case-insensitive; /…/ may contain spaces)
+#   tool:nxc  lang:bash  heading:enum   line-level fields (command word, code block language, heading)
+#   title:…  tag:…  file:…  root:…      playbook-level fields (catalog metadata)
+_WORD_RE = re.compile(r'[\w$]+')
+_QUERY_TOKEN_RE = re.compile(r'(?:(\w+):)?("(?:[^"\\]|\\.)*"|(?<=[rR][eE]:)/(?:[^/\\]|\\.)+/|\S+)')
+REGEX_FIELD = 're'
+LINE_FIELDS = ('tool', 'lang', 'heading')
+FILE_FIELDS = ('title', 'tag', 'file', 'root')
+
+class SearchQueryError(ValueError):
+    """An advanced query that cannot be compiled (e.g. an invalid regex)."""
+
+class SearchTimeoutError(SearchQueryError):
+    """A query that ran past SEARCH_SCAN_TIME_BUDGET while checking lines."""
+
+    def __init__(self):
+        super().__init__(f"Search took longer than {SEARCH_SCAN_TIME_BUDGET:g}s; narrow the query.")
+
+def bounded_edit_distance(a, b, limit):
+    """
+    Edit distance between a and b counting an adjacent transposition as one edit
+    (optimal string alignment), or limit + 1 once it is known to exceed limit.
+    """
+    if abs(len(a) - len(b)) > limit: return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb))
+            if i > 1 and j > 1 and ca == b[j - 2] and a[i - 2] == cb:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit: return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+# One escape sequence: hex/unicode/named characters, octal escapes and group references
+# span several characters, none of which are literal text
+_REGEX_ESCAPE_RE = re.compile(r'\\(?:x[0-9a-fA-F]{0,2}|u[0-9a-fA-F]{0,4}|U[0-9a-fA-F]{0,8}|N\{[^}]*\}?'
+                              r'|0[0-7]{0,2}|[1-7][0-7]{2}|[1-9][0-9]?|.)', re.DOTALL)
+_REGEX_REPEAT_RE = re.compile(r'\*|\+|\{\d*(?:,\d*)?\}')
+
+def _regex_class_end(pattern, i):
+    """Index of the ']' closing the character class opened at pattern[i] (a ']' first in the class is literal)."""
+    i += 1
+    if pattern[i:i + 1] == '^': i += 1
+    if pattern[i:i + 1] == ']': i += 1
+    while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+    return min(i, len(pattern))
+
+def _regex_has_nested_repeat(pattern):
+    """
+    True if a repeated group contains a repeat of its own, like (a+)+, (a*b?)* or
+    (.*a){12}: the shapes that make the backtracking engine take exponential time on a
+    near-miss. Other slow patterns are caught by RegexWorkers' deadline.
+    """
+    repeats = [False] # Per open group: whether something inside it repeats
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == '(':
+            repeats.append(False)
+            i += 2 if pattern[i + 1:i + 2] == '?' else 1 # (? starts a group extension, not a quantifier
+            continue
+        if ch == '\\': i += 2
+        elif ch == '[': i = _regex_class_end(pattern, i) + 1
+        else: i += 1
+        inner = repeats.pop() if ch == ')' and len(repeats) > 1 else False
+        m = _REGEX_REPEAT_RE.match(pattern, i)
+        if m:
+            if inner: return True
+            repeats[-1] = True
+            i = m.end()
+        elif inner:
+            repeats[-1] = True
+    return False
+
+def _regex_required_literals(pattern):
+    """
+    Lowercased literal runs every match of `pattern` must contain, for trigram
+    prefiltering. Conservative: returns [] when unsure (top-level alternation, verbose mode).
+    """
+    if re.search(r'\(\?[a-zA-Z]*x', pattern):
+        return []
+    runs, run, i, depth = [], '', 0, 0
+    def cut():
+        nonlocal run
+        if len(run) >= 3: runs.append(run.lower())
+        run = ''
+    while i < len(pattern):
+        ch = pattern[i]
+        if depth:
+            if ch == '\\': i += 1
+            elif ch == '[': i = _regex_class_end(pattern, i)
+            elif ch == '(': depth += 1
+            elif ch == ')': depth -= 1
+        elif ch == '|':
+            return []
+        elif ch == '\\':
+            nxt = pattern[i + 1:i + 2]
+            if nxt and not nxt.isalnum(): # Escaped punctuation is a literal
+                run += nxt
+                i += 1
+            else: # Character class, anchor, or a character given by code
+                cut()
+                m = _REGEX_ESCAPE_RE.match(pattern, i)
+                i = m.end() - 1 if m else len(pattern)
+        elif ch in '*?{':
+            run = run[:-1] # The preceding character is optional/repeated
+            cut()
+            if ch == '{':
+                i = pattern.find('}', i) if '}' in pattern[i:] else len(pattern)
+        elif ch == '+':
+            cut()
+        elif ch == '[':
+            cut()
+            i = _regex_class_end(pattern, i)
+        elif ch == '(':
+            cut()
+            depth = 1
+        elif ch in '.^$)':
+            cut()
+        else:
+            run += ch
+        i += 1
+    cut()
+    return runs
+
+class _SearchTerm:
+    """One query term. candidates_locked() narrows the lines to check (None = no narrowing)."""
+    needle = None # Literal text used for ranking and for the filename boost
+
+    def candidates_locked(self, index):
+        return None
+
+    def precompute(self, index, deadline):
+        """Work against the index done before the scan and outside the index lock (see FuzzyTerm)."""
+
+    def prepare(self, entries, deadline):
+        """Lets the term check a list of entries up front, before matches() is asked about each."""
+
+    def locate(self, line_content, line_lower):
+        """(start, end) of the term's first match in the line, or None."""
+        return None
+
+    def matches(self, entry, code_lang):
+        return self.locate(entry[3], entry[4]) is not None
+
+class SubstringTerm(_SearchTerm):
+    def __init__(self, text):
+        self.needle = text.lower()
+
+    def candidates_locked(self, index):
+        return index._lines_containing_locked(self.needle)
+
+    def locate(self, line_content, line_lower):
+        pos = line_lower.find(self.needle)
+        return (pos, pos + len(self.needle)) if pos != -1 else None
+
+    def matches(self, entry, code_lang):
+        return self.needle in entry[4]
+
+_REGEX_WORKER_SOURCE = r'''
+import json, re, sys
+for request in sys.stdin:
+    pattern, lines = json.loads(request)
+    search = re.compile(pattern, re.IGNORECASE).search
+    found = []
+    for i, line in enumerate(lines):
+        m = search(line)
+        if m: found.append((i, m.start(), m.end()))
+    sys.stdout.write(json.dumps(found) + '\n')
+    sys.stdout.flush()
+'''
+
+class RegexWorkers:
+    """
+    Child Python processes that run regex searches for RegexTerm. The re engine can't
+    be interrupted, and patterns like \\w*\\w*\\w*x backtrack for minutes on a single
+    line; in a child the search is bounded by killing the process at the deadline. Each search gets a worker to itself; a few idle ones are kept for reuse.
+    """
+
+    def __init__(self, max_idle=SEARCH_REGEX_IDLE_WORKERS):
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _take(self):
+        with self._lock:
+            while self._idle:
+                process = self._idle.pop()
+                if process.poll() is None: return process
+        return subprocess.Popen([sys.executable, '-c', _REGEX_WORKER_SOURCE], stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, encoding='utf-8')
+
+    def _discard(self, process):
+        process.kill()
+        process.wait()
+
+    def search(self, pattern, lines, deadline):
+        """
+        {line: (start, end) or None} for re.search(pattern, line, re.IGNORECASE) on each line.
+        Raises SearchTimeoutError if the answer is not back by `deadline` (a perf_counter time).
+        """
+        process = self._take()
+        try:
+            process.stdin.write(json.dumps([pattern, lines]) + '\n')
+            process.stdin.flush()
+            ready, _, _ = select.select([process.stdout], [], [], max(deadline - time.perf_counter(), 0))
+            reply = process.stdout.readline() if ready else None
+        except OSError as e:
+            self._discard(process)
+            raise RuntimeError(f"Regex worker failed: {e}")
+        if not reply:
+            self._discard(process)
+            if reply is None:
+                app.logger.warning(f"Regex /{pattern}/ ran past its deadline; worker killed.")
+                raise SearchTimeoutError()
+            raise RuntimeError("Regex worker exited unexpectedly.")
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(process)
+                process = None
+        if process is not None: self._discard(process)
+        spans = dict.fromkeys(lines)
+        for i, start, end in json.loads(reply): spans[lines[i]] = (start, end)
+        return spans
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for process in idle: self._discard(process)
+
+regex_workers = RegexWorkers()
+
+class RegexTerm(_SearchTerm):
+    """
+    A regular expression, matched by RegexWorkers a batch of lines at a time (see
+    prepare) so a pathological pattern costs at most the scan's time budget. The
+    spans the workers report are remembered by line content.
+    """
+
+    def __init__(self, pattern):
+        if len(pattern) > SEARCH_MAX_REGEX_LENGTH:
+            raise SearchQueryError(f"Regular expression longer than {SEARCH_MAX_REGEX_LENGTH} characters.")
+        try:
+            self.regex = re.compile(pattern, re.IGNORECASE)
+        except re.error as e:
+            raise SearchQueryError(f"Invalid regular expression: {e}")
+        if _regex_has_nested_repeat(pattern):
+            raise SearchQueryError("Regular expression repeats a group that itself repeats, e.g. (a+)+; "
+                                   "these can take exponential time.")
+        self.pattern = pattern
+        self.literals = _regex_required_literals(pattern)
+        self.needle = max(self.literals, key=len) if self.literals else None
+        self._spans = {} # line content -> (start, end) or None
+
+    def prepare(self, entries, deadline):
+        if len(self._spans) > SEARCH_REGEX_SPAN_CACHE: self._spans = {}
+        lines = list({entry[3] for entry in entries if entry[3] not in self._spans})
+        if lines: self._spans.update(regex_workers.search(self.pattern, lines, deadline))
+
+    def candidates_locked(self, index):
+        candidates = None
+        for literal in self.literals:
+            ids = index._lines_containing_locked(literal)
+            candidates = ids if candidates is None else candidates & ids
+        return candidates
+
+    def locate(self, line_content, line_lower):
+        span = self._spans.get(line_content, False)
+        if span is False: # Not prepared, or dropped from the cache by another search since
+            deadline = time.perf_counter() + SEARCH_SCAN_TIME_BUDGET
+            span = regex_workers.search(self.pattern, [line_content], deadline)[line_content]
+        return span
+
+    def matches(self, entry, code_lang):
+        span = self._spans.get(entry[3], False)
+        return bool(span) if span is not False else self.locate(entry[3], entry[4]) is not None
+
+class FuzzyTerm(_SearchTerm):
+    """
+    Words within `max_edits` edits of `word`. The index vocabulary is scanned for close
+    words once per index generation; lines are then found through those words' trigrams.
+    """
+
+    def __init__(self, word, max_edits=None):
+        self.word = word.lower()
+        if max_edits is None: max_edits = 1 if len(self.word) <= 4 else 2
+        self.max_edits = min(max_edits, SEARCH_FUZZY_MAX_EDITS, max(len(self.word) - 2, 0))
+        self.needle = self.word
+        self._words = (None, frozenset(), None) # (index generation, close words, regex finding them)
+
+    def precompute(self, index, deadline):
+        """
+        Finds the vocabulary words close to `word` for the index's current generation.
+        Only words of a possible length are looked at, and a word with more than
+        max_edits characters the query lacks (or the other way round) is skipped
+        before computing its edit distance. Raises SearchTimeoutError at `deadline`.
+        """
+        k, n = self.max_edits, len(self.word)
+        with index._lock:
+            if self._words[0] == index.generation: return
+            generation = index.generation
+            buckets = [list(index._vocab_by_length.get(length, {}).items()) for length in range(n - k, n + k + 1)]
+        query_mask = _char_mask(self.word)
+        words = []
+        for bucket in buckets:
+            for start in range(0, len(bucket), 4096):
+                if time.perf_counter() > deadline: raise SearchTimeoutError()
+                for w, mask in bucket[start:start + 4096]:
+                    if (query_mask & ~mask).bit_count() <= k and (mask & ~query_mask).bit_count() <= k \
+                            and bounded_edit_distance(w, self.word, k) <= k:
+                        words.append(w)
+        # One alternation (longest first) locates a close word faster than testing every word in the line
+        pattern = re.compile(r'(?<![\w$])(?:%s)(?![\w$])' % '|'.join(
+            re.escape(w) for w in sorted(words, key=len, reverse=True))) if words else None
+        self._words = (generation, frozenset(words), pattern)
+
+    def close_words_locked(self, index):
+        if self._words[0] != index.generation: # Re-indexed since precompute(); rare
+            self.precompute(index, time.perf_counter() + SEARCH_SCAN_TIME_BUDGET)
+        return self._words[1]
+
+    def candidates_locked(self, index):
+        candidates = set()
+        for word in self.close_words_locked(index):
+            ids = index._lines_containing_locked(word)
+            if ids is None: return None # Words under 3 characters can't be looked up by trigram
+            candidates |= ids
+        return candidates
+
+    def locate(self, line_content, line_lower):
+        pattern = self._words[2]
+        m = pattern.search(line_lower) if pattern else None
+        return m.span() if m else None
+
+class FieldTerm(_SearchTerm):
+    """tool:/lang:/heading: test the line; title:/tag:/file:/root: test the playbook (see accepts_file)."""
+
+    def __init__(self, field, value):
+        self.field, self.value = field, value.lower()
+        self.needle = self.value if field in ('tool', 'heading') else None
+
+    def candidates_locked(self, index):
+        return index._lines_containing_locked(self.value) if self.needle else None
+
+    def _command_word(self, line_lower):
+        words = line_lower.split()
+        while words and words[0] in ('sudo', '$', '#', '>'): words.pop(0) # Prompts and sudo
+        return words[0].rsplit('/', 1)[-1] if words else ''
+
+    def locate(self, line_content, line_lower):
+        if self.field == 'heading':
+            pos = line_lower.find(self.value) if line_lower.startswith('#') else -1
+            return (pos, pos + len(self.value)) if pos != -1 else None
+        if self.field == 'tool':
+            word = self._command_word(line_lower)
+            if not word.startswith(self.value): return None
+            pos = line_lower.find(word)
+            return pos, pos + len(word)
+        return None
+
+    def matches(self, entry, code_lang):
+        if self.field == 'lang':
+            return code_lang == self.value
+        if self.field == 'tool' and code_lang is None:
+            return False
+        if self.field == 'heading' and code_lang is not None:
+            return False # A '#' line inside a code block is a shell comment
+        return self.locate(entry[3], entry[4]) is not None
+
+    def accepts_file(self, playbook_id, root, meta):
+        if self.field == 'title': return self.value in meta['title'].lower()
+        if self.field == 'tag': return any(t.lower() == self.value for t in meta['tags'])
+        if self.field == 'file': return self.value in playbook_id.lower()
+        return root.lower() == self.value
+
+class SearchQuery:
+    """A compiled search query: line terms (ANDed) and playbook-level filters."""
+
+    def __init__(self, terms, text):
+        self.text = text
+        self.file_terms = [t for t in terms if isinstance(t, FieldTerm) and t.field in FILE_FIELDS]
+        self.line_terms = [t for t in terms if t not in self.file_terms]
+        self.primary = next((t for t in self.line_terms if t.needle), self.line_terms[0] if self.line_terms else None)
+        self.needle = self.primary.needle if self.primary else None
+        # Plain substring queries (the common case) skip the generic matching loop
+        self.substring = self.needle if len(self.line_terms) == 1 and type(self.primary) is SubstringTerm \
+            and not self.file_terms else None
+        self._candidates = (None, None) # (index generation, line ids or None)
+
+    def candidates_locked(self, index):
+        """Line ids that may match (intersection over the terms), cached per index generation."""
+        generation, candidates = self._candidates
+        if generation == index.generation:
+            return candidates
+        candidates = None
+        for term in self.line_terms:
+            ids = term.candidates_locked(index)
+            if ids is not None:
+                candidates = ids if candidates is None else candidates & ids
+        self._candidates = (index.generation, candidates)
+        return candidates
+
+    def accepts_file(self, playbook_id, root, meta):
+        return all(t.accepts_file(playbook_id, root, meta) for t in self.file_terms)
+
+    def precompute(self, index, deadline):
+        for term in self.line_terms: term.precompute(index, deadline)
+
+    def prepare(self, entries, deadline):
+        for term in self.line_terms: term.prepare(entries, deadline)
+
+    def matches(self, entry, code_lang):
+        if self.substring is not None:
+            return self.substring in entry[4]
+        if len(self.line_terms) == 1:
+            return self.line_terms[0].matches(entry, code_lang)
+        return all(t.matches(entry, code_lang) for t in self.line_terms)
+
+    def locate(self, entry):
+        """(start, end) of the primary term's match in the line, for ranking and highlighting."""
+        return self.primary.locate(entry[3], entry[4]) if self.primary else None
+
+def parse_search_query(text, fuzzy=False):
+    """
+    Compiles a query string (syntax above). fuzzy=True makes every bare word a fuzzy
+    term. Raises SearchQueryError for invalid queries.
+    """
+    tokens = _QUERY_TOKEN_RE.findall(text)
+    advanced = fuzzy or any((field and field.lower() in LINE_FIELDS + FILE_FIELDS + (REGEX_FIELD,))
+                            or value.startswith('"') or re.search(r'\w~\d?$', value) for field, value in tokens)
+    if not advanced:
+        return SearchQuery([SubstringTerm(text)], text)
+    terms = []
+    for field, value in tokens:
+        if field and field.lower() == REGEX_FIELD:
+            wrapped = len(value) > 2 and value[0] == value[-1] and value[0] in '/"'
+            terms.append(RegexTerm(value[1:-1] if wrapped else value))
+            continue
+        if value.startswith('"') and value.endswith('"') and len(value) >= 2:
+            value, quoted = re.sub(r'\\(.)', r'\1', value[1:-1]), True
+        else:
+            quoted = False
+        if field and field.lower() in LINE_FIELDS + FILE_FIELDS:
+            term = FieldTerm(field.lower(), value)
+        elif field:
+            term = SubstringTerm(f"{field}:{value}")
+        elif quoted:
+            term = SubstringTerm(value)
+        elif re.search(r'\w~\d?$', value):
+            word, _, edits = value.rpartition('~')
+            term = FuzzyTerm(word, int(edits) if edits else None)
+        elif fuzzy and len(value) >= 3 and _WORD_RE.fullmatch(value):
+            term = FuzzyTerm(value)
+        else:
+            term = SubstringTerm(value)
+        if not (term.needle or isinstance(term, FieldTerm)):
+            continue # Empty phrase
+        terms.append(term)
+    if not terms:
+        raise SearchQueryError("Query has no searchable terms.")
+    return SearchQuery(terms, text)
+
+class SearchQueryCache:
+    """LRU of compiled queries, so repeated keystroke/paging requests skip parsing and prefiltering."""
+
+    def __init__(self, max_entries=SEARCH_QUERY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text, fuzzy=False):
+        key = (text, fuzzy)
+        with self._lock:
+            query = self._entries.get(key)
+            if query is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return query
+            self.misses += 1
+        query = parse_search_query(text, fuzzy) # Raises SearchQueryError; failures are not cached
+        with self._lock:
+            self._entries[key] = query
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return query
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+search_query_cache = SearchQueryCache()
+
+_WORD_CHAR_RE = re.compile(r'\w')
+
+def score_search_match(entry, query):
+    """
+    Relevance score for a line matching `query` (a SearchQuery; higher is better).
+    Whole-word hits beat word-prefix hits beat mid-word hits; headings, hits in the
+    filename, repeated hits and short, focused lines are boosted.
+    """
+    _, filename, _, line_content, line_lower = entry
+    query_lower = query.substring
+    if query_lower is not None: # Plain substring queries skip the term dispatch
+        pos = line_lower.find(query_lower)
+        end = pos + len(query_lower)
+    else:
+        span = query.locate(entry)
+        if span is None: # Only playbook-level filters (or a lang: filter) matched
+            return round(-len(line_content) / 40.0, 2)
+        pos, end = span
+        query_lower = query.needle or line_lower[pos:end]
+    starts_word = pos == 0 or not _WORD_CHAR_RE.match(line_lower[pos - 1])
+    ends_word = end >= len(line_lower) or not _WORD_CHAR_RE.match(line_lower[end])
+    score = 0.0
+    if starts_word and ends_word: score += 30
+    elif starts_word: score += 15
+    if line_content.startswith('#'): score += 20
+    if query_lower and query_lower in filename.lower(): score += 10
+    if pos == 0: score += 5
+    score += 2 * min(line_lower.count(query_lower), 5) if query_lower else 0
+    score -= len(line_content) / 40.0
+    return round(score, 2)
+
+def _parse_search_paging():
+    """Reads limit/cursor from the query string. Returns (limit, offset) or raises ValueError."""
+    limit = int(request.args.get('limit', SEARCH_DEFAULT_LIMIT))
+    offset = int(request.args.get('cursor') or 0)
+    if limit < 1 or offset < 0:
+        raise ValueError("limit must be positive and cursor non-negative")
+    return min(limit, SEARCH_MAX_LIMIT), offset
+
+def _search_match_dict(entry, query, score=None):
+    match = {"filename": entry[1], "line_number": entry[2], "line_content": entry[3]}
+    if score is not None: match["score"] = score
+    span = query.locate(entry)
+    if span is not None: match["highlight"] = list(span) # Code point offsets into line_content
+    return match
+
+def iter_search_page(query, limit, offset, sort='relevance'):
+    """
+    Yields the match dicts of one page of search results for a SearchQuery followed by
+    a trailer {"done": True, "next_cursor": ..., "has_more": ...}. File order is produced
+    lazily and stops scanning once the page is full. Relevance order ranks the first
+    SEARCH_RANK_WINDOW matches and lists any later ones after them in file order, so
+    a page never scans more than SEARCH_RANK_WINDOW + offset + limit matches however
+    large the library is, and every page of a query sees the same order.
+    """
+    started = time.perf_counter()
+    matches = playbook_index.iter_matches(query)
+    if sort == 'file':
+        for entry in itertools.islice(matches, offset, offset + limit):
+            yield _search_match_dict(entry, query)
+        has_more = next(matches, None) is not None
+    else:
+        ranked = sorted(((score_search_match(entry, query), entry)
+                         for entry in itertools.islice(matches, SEARCH_RANK_WINDOW)),
+                        key=lambda se: (-se[0], se[1][1], se[1][2]))
+        page = ranked[offset:offset + limit]
+        for score, entry in page:
+            yield _search_match_dict(entry, query, score)
+        skip = max(offset - len(ranked), 0)
+        for entry in itertools.islice(matches, skip, skip + limit - len(page)):
+            yield _search_match_dict(entry, query, score_search_match(entry, query))
+        has_more = len(ranked) > offset + limit or next(matches, None) is not None
+    metrics.observe('commandwave_playbook_search_duration_seconds', time.perf_counter() - started, sort=sort)
+    yield {"done": True, "next_cursor": str(offset + limit) if has_more else None, "has_more": has_more}
+
+@app.route('/api/playbooks/search', methods=['GET'])
+def search_playbooks():
+    """
+    API endpoint to search for keywords in local .md playbooks and return matching lines.
+    Query params: query (plain text, or the syntax of the Playbook Query Engine section),
+    fuzzy=1 (treat every word as a fuzzy term), limit (default SEARCH_DEFAULT_LIMIT),
+    cursor (from next_cursor), sort ('relevance' or 'file') and format ('json' or
+    'ndjson' for a streamed response). Each match carries a highlight [start, end].
+    Relevance pages rank only the first SEARCH_RANK_WINDOW matches (see iter_search_page).
+    A query that runs past SEARCH_SCAN_TIME_BUDGET answers 408 (or a trailer with
+    "timeout": true when streamed).
+    """
+    query = request.args.get('query', '').strip()
+    if not query or len(query) < 2: # Optional: Add minimum query length
+        return jsonify({"success": True, "matches": [], "next_cursor": None, "has_more": False})
+
+    if not playbook_index.has_roots():
+         app.logger.error(f"No playbook directory found: {[d for _, d in playbook_index.roots]}")
+         return jsonify({"success": False, "error": "Playbooks directory not found on server."}), 500
+
+    try:
+        limit, offset = _parse_search_paging()
+    except ValueError:
+        return jsonify({"success": False, "error": "Invalid limit or cursor."}), 400
+    sort = request.args.get('sort', 'relevance')
+    if sort not in ('relevance', 'file'):
+        return jsonify({"success": False, "error": "Invalid sort, expected 'relevance' or 'file'."}), 400
+    try:
+        compiled = search_query_cache.get(query, fuzzy=request.args.get('fuzzy') == '1')
+    except SearchQueryError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    results = iter_search_page(compiled, limit, offset, sort)
+    if request.args.get('format') == 'ndjson':
+        def generate():
+            try:
+                for item in results:
+                    yield json.dumps(item) + '\n'
+            except SearchTimeoutError as e:
+                yield json.dumps({"done": True, "error": str(e), "timeout": True}) + '\n'
+            except Exception as e:
+                app.logger.error(f"Error streaming playbook search for query '{query}': {e}", exc_info=True)
+                yield json.dumps({"done": True, "error": "Server error during playbook search."}) + '\n'
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+    try:
+        # Answered from the in-memory index; the poller keeps it in sync with the directory
+        *page, trailer = results
+        return jsonify({"success": True, "matches": page,
+                        "next_cursor": trailer["next_cursor"], "has_more": trailer["has_more"]})
+    except SearchTimeoutError as e:
+        return jsonify({"success": False, "error": str(e)}), 408
+    except Exception as e:
+        app.logger.error(f"Error during playbook search for query '{query}': {e}", exc_info=True)
+        return jsonify({"success": False, "error": "Server error during playbook search."}), 500
+
+@app.route('/api/playbooks', methods=['GET'])
+def list_playbooks():
+    """
+    API endpoint listing the playbook catalog: id (the name to pass to /api/playbooks/load),
+    root, title, tags, headings, command block count, mtime and sha256. Optional query
+    params: root and tag filter the list, commands=1 includes the command blocks themselves.
+    """
+    root, tag = request.args.get('root'), request.args.get('tag', '').lower()
+    include_commands = request.args.get('commands') == '1'
+    playbooks = []
+    for playbook_id, label, meta in playbook_index.catalog():
+        if root and label != root: continue
+        if tag and tag not in (t.lower() for t in meta['tags']): continue
+        item = {'id': playbook_id, 'root': label, 'title': meta['title'], 'tags': meta['tags'],
+                'headings': meta['headings'], 'command_count': len(meta['commands']),
+                'mtime': meta['mtime_ns'] / 1e9, 'size': meta['size'], 'sha256': meta['sha256']}
+        if include_commands: item['commands'] = meta['commands']
+        playbooks.append(item)
+    return jsonify({"success": True, "roots": [label for label, _ in playbook_index.roots], "playbooks": playbooks})
+
+# --- Loaded Playbook Cache ---
+
+_FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})\s*([^`\s]*)')
+
+def extract_playbook_blocks(content):
+    """
+    Splits markdown into the block list the frontend renders: runs of markdown text
+    ({'type': 'text', 'content': raw markdown}) and fenced code blocks
+    ({'type': 'code', 'language': ..., 'content': code}).
+    """
+    blocks = []
+    text_lines = []
+    code_lines = None
+    fence = language = None
+
+    def flush_text():
+        text = '\n'.join(text_lines).strip()
+        if text: blocks.append({'type': 'text', 'content': text})
+        text_lines.clear()
+
+    for line in content.splitlines():
+        if code_lines is None:
+            m = _FENCE_RE.match(line)
+            if m:
+                flush_text()
+                fence, language, code_lines = m.group(1), m.group(2) or 'plaintext', []
+            else:
+                text_lines.append(line)
+        elif line.strip().startswith(fence[0] * len(fence)) and not line.strip().strip(fence[0]):
+            blocks.append({'type': 'code', 'language': language, 'content': '\n'.join(code_lines)})
+            code_lines = None
+        else:
+            code_lines.append(line)
+    if code_lines is not None: # Unterminated fence runs to the end of the document
+        blocks.append({'type': 'code', 'language': language, 'content': '\n'.join(code_lines)})
+    flush_text()
+    return blocks
+
+class PlaybookCache:
+    """
+    LRU of loaded playbooks keyed by (absolute path, mtime_ns, size). Each entry holds
+    the file content, a strong ETag derived from it, and lazily built JSON payloads,
+    so re-opening an unchanged playbook costs one stat() call.
+    """
+
+    def __init__(self, max_entries=PLAYBOOK_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, abs_path, st):
+        key = (abs_path, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        with open(abs_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+        metrics.inc('commandwave_playbook_bytes_read_total', st.st_size, reader='load')
+        entry = {'content': content,
+                 'etag': hashlib.sha256(content.encode('utf-8')).hexdigest()[:32],
+                 'payloads': {}}
+        with self._lock:
+            # Drop entries for older versions of the same file before inserting
+            for stale in [k for k in self._entries if k[0] == abs_path]:
+                del self._entries[stale]
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def payload(entry, filename, fmt):
+        """Returns (and memoises) the serialised JSON body for a cache entry in the given format."""
+        cache_key = (filename, fmt)
+        body = entry['payloads'].get(cache_key)
+        if body is None:
+            data = {"success": True, "filename": filename}
+            if fmt == 'blocks':
+                data['blocks'] = extract_playbook_blocks(entry['content'])
+            else:
+                data['content'] = entry['content']
+            body = json.dumps(data).encode('utf-8')
+            entry['payloads'][cache_key] = body
+        return body
+
+playbook_cache = PlaybookCache()
+
+@app.route('/api/playbooks/load/<path:filename>', methods=['GET'])
+def load_playbook_content(filename):
+    """
+    API endpoint to get the content of a specific playbook file.
+    ?format=blocks returns pre-extracted text/code blocks instead of raw content.
+    Responses carry a strong ETag, and If-None-Match requests get a 304.
+    """
+    
+    # Basic validation - check for empty name or non-markdown extension after decoding
+    if not filename or not filename.endswith('.md'):
+        app.logger.warning(f"Attempt to load invalid playbook filename (empty or not .md): {filename}")
+        return jsonify({"success": False, "error": "Invalid filename format."}), 400
+
+    fmt = request.args.get('format', 'content')
+    if fmt not in ('content', 'blocks'):
+        return jsonify({"success": False, "error": "Invalid format, expected 'content' or 'blocks'."}), 400
+        
+    # --- SECURITY CHECK: Prevent Directory Traversal ---
+    # The id is a path relative to its playbook root (prefixed with the root's label when
+    # there are several roots); the resolved file must stay inside that root.
+    if not playbook_index.has_roots():
+        app.logger.error(f"Playbook directories configured but not found: {[d for _, d in playbook_index.roots]}")
+        return jsonify({"success": False, "error": "Server configuration error: Playbook directory missing."}), 500
+
+    resolved = playbook_index.resolve(filename)
+    if resolved is None:
+        raise NotFound(f"Playbook '{filename}' not found.")
+    abs_playbooks_dir, abs_requested_path = resolved
+
+    # Check if the requested path is still within its root
+    # os.path.commonpath is a good way to check this on POSIX/Windows
+    if os.path.commonpath([abs_requested_path, abs_playbooks_dir]) != abs_playbooks_dir:
+        app.logger.error(f"Directory traversal attempt detected for playbook: {filename}")
+        return jsonify({"success": False, "error": "Access denied."}), 403
+    # --- END SECURITY CHECK ---
+
+    # A single stat() both checks existence and provides the cache key
+    try:
+        st = os.stat(abs_requested_path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+         app.logger.error(f"Playbook file not found at calculated path: {abs_requested_path}")
+         raise NotFound(f"Playbook '{filename}' not found.") # Let Flask handle 404
+
+    try:
+        entry = playbook_cache.get(abs_requested_path, st)
+        # Return the original filename as requested by the client for consistency
+        body = PlaybookCache.payload(entry, filename, fmt)
+    except Exception as e:
+        app.logger.error(f"Error reading playbook file {filename} at {abs_requested_path}: {e}", exc_info=True)
+        return jsonify({"success": False, "error": f"Failed to read playbook '{filename}'."}), 500
+
+    response = Response(body, mimetype='application/json')
+    response.set_etag(f"{entry['etag']}-{fmt}")
+    # Always revalidate so edits on disk are picked up, but let unchanged files 304
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+
+# --- END Playbook API Endpoints ---
+
+
+# --- Scrollback Capture ---
+_ANSI_ESCAPE_RE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[()][A-Za-z0-9]|[@-Z\\-_])')
+_CONTROL_CHARS_RE = re.compile(r'[\x00-\x08\x0b-\x1f\x7f]')
+_CAPTURE_DIR_RE = re.compile(r'^(cmd_wave_term_(\d+))-\d{8}T\d{6}(?:-\d+)?$')
+_SEGMENT_RE = re.compile(r'^(\d{9})\.log\.gz$') # Named after the segment's first line number
+
+def clean_terminal_line(raw):
+    """Turns one line of raw pane output into plain text: escapes removed, carriage returns resolved."""
+    text = _ANSI_ESCAPE_RE.sub('', raw)
+    if '\r' in text:
+        # Text after the last carriage return overwrote the line (prompts, progress bars)
+        parts = [part for part in text.split('\r') if part]
+        text = parts[-1] if parts else ''
+    return _CONTROL_CHARS_RE.sub('', text)
+
+def _read_segment_lines(path):
+    """Lines of a gzip log segment. A segment cut short by a crash yields what was flushed."""
+    chunks = []
+    with gzip.open(path, 'rb') as f:
+        try:
+            while True:
+                chunk = f.read(65536)
+                if not chunk: break
+                chunks.append(chunk)
+        except EOFError:
+            pass
+    lines = b''.join(chunks).decode('utf-8', errors='replace').split('\n')
+    if lines and lines[-1] == '': lines.pop()
+    return lines
+
+class ScrollbackCapture:
+    """
+    Records what terminals print. Each tmux session gets `pipe-pane` into a FIFO, and one
+    reader thread multiplexes all FIFOs with a selector. Complete lines are cleaned of
+    escape sequences and appended to gzip segments in <root>/<session>-<timestamp>/.
+    Segments rotate every SCROLLBACK_SEGMENT_BYTES. The oldest sealed segments are deleted
+    once they are older than SCROLLBACK_MAX_AGE or their terminal's captures exceed
+    SCROLLBACK_MAX_TERMINAL_BYTES, and then SCROLLBACK_MAX_TOTAL_BYTES over all terminals;
+    the limits bound both the disk used and the trigram sets (about 1.6x the text) held in
+    memory. Each sealed segment keeps its trigram set, so a search only decompresses
+    segments that can match. The open segment is searched in memory. Segments of captures
+    from earlier runs are indexed one at a time when a search first reaches them, under the
+    capture's lock; until then they count as SCROLLBACK_SEGMENT_BYTES towards the limits.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._captures = {} # capture id -> capture dict (see _new_capture)
+        self._to_register = []
+        self._selector = None
+        self._thread = None
+        self._loaded = False
+        self._stopped = False
+        self.bytes_captured = 0
+        self.segments_deleted = 0
+
+    @staticmethod
+    def _new_capture(capture_id, session_name, port, directory, live):
+        return {'id': capture_id, 'session': session_name, 'port': port, 'dir': directory, 'live': live,
+                'fd': None, 'fifo': None, 'pending': b'', 'gz': None, 'gz_path': None, 'dirty': False,
+                'segment_bytes': 0, 'first_line': 1, 'lines': [], 'segments': [],
+                'lock': threading.Lock()} # Held while indexing segments from an earlier run
+
+    def _ensure_loaded(self):
+        """Lists captures left on disk by earlier runs (once); their segments are read lazily."""
+        with self._lock:
+            if self._loaded: return
+            self._loaded = True
+            try:
+                names = sorted(os.listdir(self.root))
+            except FileNotFoundError:
+                names = []
+            for name in names:
+                match = _CAPTURE_DIR_RE.match(name)
+                directory = os.path.join(self.root, name)
+                if not match or name in self._captures or not os.path.isdir(directory): continue
+                capture = self._new_capture(name, match.group(1), int(match.group(2)), directory, live=False)
+                for filename in sorted(os.listdir(directory)):
+                    path = os.path.join(directory, filename)
+                    segment_match = _SEGMENT_RE.match(filename)
+                    if not segment_match:
+                        if filename == 'pipe.fifo':
+                            try: os.unlink(path) # Left behind by a crash
+                            except OSError: pass
+                        continue
+                    try:
+                        mtime = os.stat(path).st_mtime
+                    except OSError:
+                        continue
+                    capture['segments'].append({'path': path, 'first_line': int(segment_match.group(1)), 'line_count': None,
+                                                'bytes': SCROLLBACK_SEGMENT_BYTES, 'mtime': mtime, 'trigrams': None})
+                self._captures[name] = capture
+            self._enforce_retention_locked()
+
+    @staticmethod
+    def _add_segment(capture, path, lines):
+        capture['segments'].append({'path': path, 'first_line': capture['first_line'], 'line_count': len(lines),
+                                    'bytes': capture['segment_bytes'], 'mtime': time.time(),
+                                    'trigrams': _trigrams('\n'.join(lines).lower())})
+        capture['first_line'] += len(lines)
+
+    @staticmethod
+    def _load_segment(segment):
+        """
+        Reads and indexes a segment left by an earlier run. Call with its capture's lock
+        held. Returns the segment's lines, or None if it can't be read.
+        """
+        try:
+            lines = _read_segment_lines(segment['path'])
+        except OSError as e: # Includes gzip.BadGzipFile
+            app.logger.warning(f"Skipping unreadable scrollback segment {segment['path']}: {e}")
+            segment.update(line_count=0, trigrams=set())
+            return None
+        text = '\n'.join(lines)
+        segment.update(line_count=len(lines), bytes=len(text.encode('utf-8')) + bool(lines),
+                       trigrams=_trigrams(text.lower()))
+        return lines
+
+    def _enforce_retention_locked(self):
+        """Deletes the oldest sealed segments beyond the age, per-terminal and total limits."""
+        segments = sorted(((segment['mtime'], capture, segment) for capture in self._captures.values()
+                           for segment in capture['segments']), key=lambda item: item[0])
+        oldest_kept = time.time() - SCROLLBACK_MAX_AGE
+        terminal_bytes, total_bytes = {}, 0
+        for _, capture, segment in segments:
+            terminal_bytes[capture['port']] = terminal_bytes.get(capture['port'], 0) + segment['bytes']
+            total_bytes += segment['bytes']
+        for mtime, capture, segment in segments:
+            if mtime >= oldest_kept and terminal_bytes[capture['port']] <= SCROLLBACK_MAX_TERMINAL_BYTES \
+                    and total_bytes <= SCROLLBACK_MAX_TOTAL_BYTES:
+                continue
+            capture['segments'].remove(segment)
+            try: os.unlink(segment['path'])
+            except OSError: pass
+            self.segments_deleted += 1
+            terminal_bytes[capture['port']] -= segment['bytes']
+            total_bytes -= segment['bytes']
+            if not capture['live'] and not capture['segments']:
+                try: os.rmdir(capture['dir'])
+                except OSError: pass
+                del self._captures[capture['id']]
+
+    def attach(self, port, session_name):
+        """Starts logging a tmux session's output. Returns True if capture started."""
+        stamp = time.strftime('%Y%m%dT%H%M%S')
+        capture_id, suffix = f"{session_name}-{stamp}", 1
+        while os.path.exists(os.path.join(self.root, capture_id)):
+            suffix += 1
+            capture_id = f"{session_name}-{stamp}-{suffix}"
+        directory = os.path.join(self.root, capture_id)
+        fifo = os.path.join(directory, 'pipe.fifo')
+        try:
+            os.makedirs(directory, mode=0o700)
+            os.mkfifo(fifo, 0o600)
+            # Open our end first (non-blocking) so the writer tmux starts never blocks
+            fd = os.open(fifo, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as e:
+            app.logger.error(f"Could not set up scrollback capture for '{session_name}': {e}")
+            return False
+        try:
+            result = run_tmux(['pipe-pane', '-t', session_name, f'cat > {shlex.quote(os.path.abspath(fifo))}'],
+                              shard=tmux_shards.shard_of(port))
+            failed = result.returncode != 0 and result.stderr.strip()
+        except (FileNotFoundError, subprocess.TimeoutExpired) as e:
+            failed = str(e)
+        if failed:
+            app.logger.error(f"tmux pipe-pane failed for '{session_name}': {failed}")
+            os.close(fd)
+            for path in (fifo, directory):
+                try: os.unlink(path) if path == fifo else os.rmdir(path)
+                except OSError: pass
+            return False
+        capture = self._new_capture(capture_id, session_name, port, directory, live=True)
+        capture['fd'], capture['fifo'] = fd, fifo
+        with self._lock:
+            self._captures[capture_id] = capture
+            self._open_segment_locked(capture)
+            self._to_register.append(capture)
+        self.start()
+        app.logger.info(f"Capturing scrollback of '{session_name}' into {directory}")
+        return True
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None or self._stopped: return
+            self._selector = selectors.DefaultSelector()
+            self._thread = threading.Thread(target=self._run, name='scrollback-capture', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        self._ensure_loaded()
+        last_flush = last_retention = time.monotonic()
+        while not self._stopped:
+            with self._lock:
+                to_register, self._to_register = self._to_register, []
+            for capture in to_register:
+                self._selector.register(capture['fd'], selectors.EVENT_READ, capture)
+            for key, _ in self._selector.select(timeout=0.5):
+                self._read(key.data)
+            if time.monotonic() - last_flush >= SCROLLBACK_FLUSH_INTERVAL:
+                last_flush = time.monotonic()
+                with self._lock:
+                    for capture in self._captures.values():
+                        if capture['dirty'] and capture['gz'] is not None:
+                            capture['gz'].flush()
+                            capture['dirty'] = False
+            if time.monotonic() - last_retention >= SCROLLBACK_RETENTION_INTERVAL:
+                last_retention = time.monotonic()
+                with self._lock: self._enforce_retention_locked()
+
+    def _read(self, capture):
+        try:
+            data = os.read(capture['fd'], 65536)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            app.logger.warning(f"Scrollback read failed for '{capture['session']}': {e}")
+            data = b''
+        with self._lock:
+            if not capture['live']: return # Finished by stop() meanwhile
+            if not data: # Writer exited: the session (or its pane) is gone
+                self._selector.unregister(capture['fd'])
+                self._finish_locked(capture)
+                return
+            self.bytes_captured += len(data)
+            *complete, capture['pending'] = (capture['pending'] + data).split(b'\n')
+            if len(capture['pending']) > SCROLLBACK_MAX_LINE:
+                complete.append(capture['pending'])
+                capture['pending'] = b''
+            self._append_locked(capture, [clean_terminal_line(line.decode('utf-8', errors='replace')) for line in complete])
+
+    def _open_segment_locked(self, capture):
+        capture['gz_path'] = os.path.join(capture['dir'], f"{capture['first_line']:09d}.log.gz")
+        capture['gz'] = gzip.open(capture['gz_path'], 'wb', compresslevel=6)
+        capture['segment_bytes'] = 0
+        capture['lines'] = []
+
+    def _seal_segment_locked(self, capture):
+        """Closes the open segment and moves its lines into the trigram-indexed sealed list."""
+        capture['gz'].close()
+        capture['gz'] = None
+        self._add_segment(capture, capture['gz_path'], capture['lines'])
+        capture['lines'] = []
+        self._enforce_retention_locked()
+
+    def _append_locked(self, capture, lines):
+        for line in lines:
+            data = (line + '\n').encode('utf-8')
+            capture['gz'].write(data)
+            capture['lines'].append(line)
+            capture['segment_bytes'] += len(data)
+            capture['dirty'] = True
+            if capture['segment_bytes'] >= SCROLLBACK_SEGMENT_BYTES:
+                self._seal_segment_locked(capture)
+                self._open_segment_locked(capture)
+
+    def _finish_locked(self, capture):
+        if capture['pending']:
+            self._append_locked(capture, [clean_terminal_line(capture['pending'].decode('utf-8', errors='replace'))])
+            capture['pending'] = b''
+        if capture['gz'] is not None:
+            self._seal_segment_locked(capture)
+        os.close(capture['fd'])
+        try: os.unlink(capture['fifo'])
+        except OSError: pass
+        capture['live'] = False
+        app.logger.info(f"Scrollback capture of '{capture['session']}' finished ({capture['first_line'] - 1} lines).")
+
+    def stop(self):
+        """Seals every open segment so the logs are complete gzip files. Called at exit."""
+        with self._lock:
+            self._stopped = True
+            for capture in self._captures.values():
+                if capture['live']:
+                    try:
+                        if self._selector is not None: self._selector.unregister(capture['fd'])
+                    except (KeyError, ValueError):
+                        pass
+                    self._finish_locked(capture)
+
+    def search(self, query_lower, limit, port=None):
+        """
+        Case-insensitive substring search over all captures, newest capture first and in
+        line order within a capture. Returns (matches, truncated).
+        """
+        self._ensure_loaded()
+        query_grams = _trigrams(query_lower)
+        with self._lock:
+            snapshot = [(dict(capture, segments=list(capture['segments']), lines=list(capture['lines'])))
+                        for capture in self._captures.values() if port is None or capture['port'] == port]
+        snapshot.sort(key=lambda capture: capture['id'].split('-', 1)[1], reverse=True)
+        matches = []
+
+        def scan(capture, lines, first_line):
+            for offset, line in enumerate(lines):
+                if query_lower in line.lower():
+                    matches.append({'capture': capture['id'], 'session': capture['session'], 'port': capture['port'],
+                                    'live': capture['live'], 'line_number': first_line + offset, 'line': line})
+                    if len(matches) > limit: return True
+            return False
+
+        for capture in snapshot:
+            for segment in capture['segments']:
+                lines = None
+                if segment['trigrams'] is None:
+                    with capture['lock']: # Concurrent first searches wait for one reader instead of each decompressing
+                        if segment['trigrams'] is None: lines = self._load_segment(segment)
+                if not query_grams <= segment['trigrams']: continue
+                if lines is None:
+                    try:
+                        lines = _read_segment_lines(segment['path'])
+                    except OSError:
+                        continue # Deleted by retention since the snapshot
+                if scan(capture, lines, segment['first_line']): return matches[:limit], True
+            if scan(capture, capture['lines'], capture['first_line']): return matches[:limit], True
+        return matches, False
+
+    def sessions(self):
+        """Captures, newest first. A capture from an earlier run has its last segment read to count its lines."""
+        self._ensure_loaded()
+        with self._lock:
+            snapshot = [dict(capture, segments=list(capture['segments']), lines=len(capture['lines']))
+                        for capture in sorted(self._captures.values(), key=lambda c: c['id'].split('-', 1)[1], reverse=True)]
+        result = []
+        for capture in snapshot:
+            if capture['gz'] is not None or not capture['segments']:
+                lines = capture['first_line'] - 1 + capture['lines']
+            else:
+                last = capture['segments'][-1]
+                if last['line_count'] is None:
+                    with capture['lock']:
+                        if last['line_count'] is None: self._load_segment(last)
+                lines = last['first_line'] - 1 + last['line_count']
+            result.append({'capture': capture['id'], 'session': capture['session'], 'port': capture['port'],
+                           'live': capture['live'], 'lines': lines,
+                           'segments': len(capture['segments']) + (capture['gz'] is not None)})
+        return result
+
+scrollback = ScrollbackCapture(SCROLLBACK_DIR)
+
+@app.route('/api/scrollback/search', methods=['GET'])
+def search_scrollback():
+    """Searches captured terminal output: ?query=...&limit=...&port=..."""
+    query = request.args.get('query', '').strip()
+    if not query:
+        return jsonify({"success": False, "error": "Query parameter is required"}), 400
+    try:
+        limit = min(int(request.args.get('limit', SCROLLBACK_DEFAULT_LIMIT)), SCROLLBACK_MAX_LIMIT)
+        port = int(request.args['port']) if request.args.get('port') else None
+        if limit < 1: raise ValueError
+    except ValueError:
+        return jsonify({"success": False, "error": "limit and port must be positive integers"}), 400
+    matches, truncated = scrollback.search(query.lower(), limit, port)
+    return jsonify({"success": True, "matches": matches, "truncated": truncated, "capturing": SCROLLBACK_CAPTURE})
+
+@app.route('/api/scrollback/sessions', methods=['GET'])
+def list_scrollback_sessions():
+    return jsonify({"success": True, "sessions": scrollback.sessions(), "capturing": SCROLLBACK_CAPTURE,
+                    "bytes_captured": scrollback.bytes_captured, "segments_deleted": scrollback.segments_deleted})
+
+
+# --- Live Events (Server-Sent Events) ---
+class EventSubscription:
+    """
+    One /api/events client: a bounded queue of pending (id, type, data) events. A client
+    that falls EVENTS_CLIENT_QUEUE_SIZE events behind has its backlog dropped and gets a
+    single 'resync' event instead, telling it to re-fetch full state. A slow browser then
+    costs bounded memory and never delays publishers.
+    """
+
+    def __init__(self, max_pending=EVENTS_CLIENT_QUEUE_SIZE):
+        self.max_pending = max_pending
+        self._events = deque()
+        self._resync_id = None # Set on overflow: id of the newest dropped event
+        self._cond = threading.Condition()
+        self.overflows = 0
+        self.start_id = 0 # Newest event id when it subscribed (set by EventBroker.subscribe)
+
+    def put(self, event):
+        with self._cond:
+            if self._resync_id is not None:
+                self._resync_id = event[0]
+            elif len(self._events) >= self.max_pending:
+                self._events.clear()
+                self._resync_id = event[0]
+                self.overflows += 1
+            else:
+                self._events.append(event)
+            self._cond.notify()
+
+    def request_resync(self, event_id):
+        with self._cond:
+            self._events.clear()
+            self._resync_id = event_id
+            self._cond.notify()
+
+    def get(self, timeout):
+        """Returns all pending events, waiting up to `timeout` seconds for the first one."""
+        with self._cond:
+            if not self._events and self._resync_id is None: self._cond.wait(timeout)
+            if self._resync_id is not None:
+                events = [(self._resync_id, 'resync', {})]
+                self._resync_id = None
+            else:
+                events = list(self._events)
+            self._events.clear()
+            return events
+
+class EventBroker:
+    """
+    Fans server-side state changes out to every /api/events subscriber. Recent events
+    are kept so a client reconnecting with Last-Event-ID gets what it missed. If the gap
+    is larger than the history, the client gets a 'resync' event instead.
+
+    Event ids are '<epoch>-<n>', where the epoch is a random token chosen per process:
+    n starts over at 1 after a restart, so an id from another process says nothing
+    about what the client has seen and also answers with a resync.
+    """
+
+    def __init__(self, history_size=EVENTS_HISTORY_SIZE, max_subscribers=EVENTS_MAX_STREAMS):
+        self.epoch = secrets.token_hex(8)
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._history = deque(maxlen=history_size)
+        self._next_id = 1
+        self.published = 0
+        self.refused = 0
+
+    def subscribe(self, last_event_id=None):
+        """
+        Registers a subscriber; last_event_id is the client's Last-Event-ID header, if any.
+        Returns None when max_subscribers streams are already open. The subscription's
+        start_id is the newest event id at registration, i.e. what a new client has seen.
+        """
+        subscription = EventSubscription()
+        epoch, _, number = (last_event_id or '').rpartition('-')
+        seen = int(number) if epoch == self.epoch and number.isdigit() else None
+        with self._lock: # Replay and registration under one lock, so no event falls in between
+            if len(self._subscribers) >= self.max_subscribers:
+                self.refused += 1
+                return None
+            subscription.start_id = self._next_id - 1
+            if last_event_id and (seen is None or seen >= self._next_id):
+                subscription.request_resync(self._next_id - 1) # An id from another process, or malformed
+            elif seen is not None and seen < self._next_id - 1:
+                oldest = self._history[0][0] if self._history else self._next_id
+                if seen + 1 >= oldest:
+                    for event in self._history:
+                        if event[0] > seen: subscription.put(event)
+                else:
+                    subscription.request_resync(self._next_id - 1)
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock: self._subscribers.discard(subscription)
+
+    def publish(self, event_type, data):
+        with self._lock:
+            event = (self._next_id, event_type, data)
+            self._next_id += 1
+            self.published += 1
+            self._history.append(event)
+            subscribers = list(self._subscribers)
+        for subscription in subscribers:
+            subscription.put(event)
+
+    def subscriber_count(self):
+        with self._lock: return len(self._subscribers)
+
+    def stats(self):
+        with self._lock:
+            return {'subscribers': len(self._subscribers), 'published': self.published, 'refused': self.refused,
+                    'overflows': sum(subscription.overflows for subscription in self._subscribers)}
+
+event_broker = EventBroker()
+
+def format_sse(event_id, event_type, data):
+    return f"id: {event_broker.epoch}-{event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/events', methods=['GET'])
+def stream_events():
+    """
+    Server-Sent Events stream of state changes: terminal_created/deleted/renamed/died/restarted,
+    notes_updated, playbooks_updated, and resync when the client must re-fetch everything.
+    Browsers resume with Last-Event-ID after a dropped connection. Each open stream
+    occupies one server thread, so at most EVENTS_MAX_STREAMS are open at once (more get a
+    503 with Retry-After) and each ends after EVENTS_STREAM_MAX_SECONDS; the browser then
+    reconnects and resumes from its last event id.
+    """
+    last_event_id = request.headers.get('Last-Event-ID')
+    subscription = event_broker.subscribe(last_event_id)
+    if subscription is None:
+        response = jsonify({"success": False, "error": "Too many open event streams"})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(EVENTS_REFUSED_RETRY_AFTER)
+        return response
+
+    def generate():
+        try:
+            yield "retry: 3000\n\n"
+            if not last_event_id:
+                # Gives a new client a Last-Event-ID to reconnect with, so nothing published
+                # while it reconnects is lost
+                yield f"id: {event_broker.epoch}-{subscription.start_id}\n\n"
+            closes_at = time.monotonic() + EVENTS_STREAM_MAX_SECONDS
+            while True:
+                remaining = closes_at - time.monotonic()
+                if remaining <= 0: return
+                events = subscription.get(timeout=min(EVENTS_HEARTBEAT_INTERVAL, remaining))
+                if not events and time.monotonic() >= closes_at: return
+                if not events:
+                    yield ": ping\n\n" # Keeps proxies from closing the idle connection
+                for event in events:
+                    yield format_sse(*event)
+        finally:
+            event_broker.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# --- Session Registry & Restore ---
+class SessionRegistry:
+    """
+    On-disk record of running terminals: port -> tmux session, ttyd PID, tab name and
+    whether it is still an unused pool terminal. The file is rewritten atomically on every change. Changes only happen when
+    terminals are opened, renamed or closed, so a full rewrite is cheap. With --keep-sessions
+    the tmux sessions outlive the app, and restore_sessions() uses this file on the next start.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None # port -> {'session', 'shard', 'ttyd_pid', 'name', 'created'}; loaded lazily
+
+    def _entries_locked(self):
+        if self._entries is None:
+            self._entries = {}
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self._entries = {int(port): entry for port, entry in data.get('terminals', {}).items()}
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, AttributeError) as e:
+                app.logger.error(f"Ignoring unreadable session registry {self.path}: {e}")
+        return self._entries
+
+    def _save_locked(self):
+        data = json.dumps({'terminals': {str(port): entry for port, entry in sorted(self._entries.items())}}, indent=2)
+        try:
+            write_file_atomic(self.path, data.encode('utf-8'))
+        except OSError as e:
+            app.logger.error(f"Could not write session registry {self.path}: {e}")
+
+    def add(self, port, session_name, ttyd_pid, name=None, pooled=None, shard=0):
+        """Records (or refreshes) a terminal; an existing name/pool flag is kept unless given."""
+        with self._lock:
+            entries = self._entries_locked()
+            previous = entries.get(port, {})
+            entries[port] = {'session': session_name, 'shard': shard, 'ttyd_pid': ttyd_pid,
+                             'name': name if name is not None else previous.get('name'),
+                             'pooled': bool(previous.get('pooled')) if pooled is None else pooled, 'created': previous.get('created', time.time())}
+            self._save_locked()
+
+    def rename(self, port, name):
+        with self._lock:
+            entry = self._entries_locked().get(port)
+            if entry is None: return False
+            entry['name'] = name
+            self._save_locked()
+            return True
+
+    def remove(self, port):
+        with self._lock:
+            if self._entries_locked().pop(port, None) is not None:
+                self._save_locked()
+
+    def entries(self):
+        with self._lock:
+            return {port: dict(entry) for port, entry in self._entries_locked().items()}
+
+session_registry = SessionRegistry(SESSION_REGISTRY_FILE)
+
+def register_terminal(port, name=None, pooled=None):
+    """Records a running terminal (its session and current ttyd PID) in the session registry."""
+    with _terminal_lock:
+        process = _running_ttyd_processes.get(port)
+        session_name = _running_tmux_sessions.get(port)
+    if process is not None and session_name:
+        session_registry.add(port, session_name, process.pid, name, pooled, shard=tmux_shards.shard_of(port))
+
+def list_tmux_sessions():
+    """
+    Live tmux sessions on every shard, from one list-sessions call per shard. Returns
+    ({session name: shard}, unreachable shards); a shard whose server did not answer in
+    time is unreachable, and its sessions are unknown rather than gone.
+    """
+    sessions, unreachable = {}, set()
+    for shard in range(tmux_shards.count):
+        try:
+            result = run_tmux(['list-sessions', '-F', '#{session_name}'], shard=shard)
+        except subprocess.TimeoutExpired as e:
+            app.logger.error(f"Could not list tmux sessions on shard {shard}: {e}")
+            unreachable.add(shard)
+            continue
+        except FileNotFoundError as e:
+            app.logger.error(f"Could not list tmux sessions: {e}")
+            break
+        if result.returncode == 0: # Otherwise no server runs on that socket
+            sessions.update(dict.fromkeys(result.stdout.split(), shard))
+    return sessions, unreachable
+
+def kill_orphaned_ttyd(pid, port):
+    """
+    Stops a ttyd left running by a previous (crashed) run so its port or socket can be reused.
+    The PID is only trusted if /proc shows it is still a ttyd serving that terminal.
+    """
+    if not pid: return
+    try:
+        with open(f'/proc/{pid}/cmdline', 'rb') as f:
+            argv = f.read().split(b'\0')
+    except OSError:
+        return # Gone (or no /proc to verify it with)
+    # argv[0] may be an interpreter when ttyd is a wrapper script
+    if os.path.basename(TTYD_COMMAND).encode() not in {os.path.basename(arg) for arg in argv[:2]} \
+            or f'cmd_wave_term_{port}'.encode() not in argv:
+        return
+    app.logger.info(f"Stopping orphaned ttyd (PID: {pid}) from a previous run on port {port}.")
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except OSError as e:
+        app.logger.warning(f"Could not stop orphaned ttyd {pid}: {e}")
+        return
+    deadline = time.monotonic() + 1.0 # Give it a moment to release its port
+    while time.monotonic() < deadline:
+        try:
+            with open(f'/proc/{pid}/stat', 'rb') as f:
+                if f.read().rsplit(b')', 1)[1].split()[0] == b'Z': break # Exited, awaiting reaping
+        except OSError:
+            break
+        time.sleep(0.02)
+
+_SESSION_NAME_RE = re.compile(r'^cmd_wave_term_(\d+)$')
+
+def restore_sessions(keep_sessions=False):
+    """
+    Reconciles the session registry left by the previous run before terminals start.
+    Orphaned ttyd processes recorded there are stopped. With keep_sessions, terminals
+    whose tmux session is still alive are returned for bootstrap_terminals() to reattach
+    fresh ttyd front-ends to, and surviving cmd_wave_term_* sessions missing from the
+    registry are adopted. Unused pool terminals, and every terminal when sessions are not
+    kept (e.g. after a crash), are removed.
+    """
+    registered = session_registry.entries()
+    if not registered and not keep_sessions:
+        return [] # Clean previous shutdown: nothing to reconcile, skip the tmux call
+    live_sessions, unreachable = list_tmux_sessions()
+    if keep_sessions:
+        for name, shard in live_sessions.items():
+            match = _SESSION_NAME_RE.match(name)
+            if match and int(match.group(1)) not in registered:
+                registered[int(match.group(1))] = {'session': name, 'shard': shard, 'ttyd_pid': None}
+    restored = []
+    for port, entry in sorted(registered.items()):
+        kill_orphaned_ttyd(entry.get('ttyd_pid'), port)
+        shard = live_sessions.get(entry['session'])
+        if port == _initial_ttyd_port:
+            # Always started (and re-registered) by bootstrap_terminals, on the shard its session survives on
+            if shard is not None: tmux_shards.assign(port, shard)
+            continue
+        if shard is None:
+            if entry.get('shard', 0) not in unreachable: # Leave it for the next start if its server is hung
+                session_registry.remove(port)
+        elif not keep_sessions or entry.get('pooled'):
+            session_registry.remove(port)
+            try: run_tmux(['kill-session', '-t', entry['session']], timeout=2, shard=shard)
+            except Exception as e: app.logger.warning(f"Could not remove leftover session {entry['session']}: {e}")
+        elif not port_allocator.claim(port):
+            session_registry.remove(port)
+            app.logger.warning(f"Not restoring '{entry['session']}': port {port} is outside the terminal port range.")
+        else:
+            tmux_shards.assign(port, shard) # Reattach on the server the session lives on
+            restored.append(port) # Its entry (and tab name) is refreshed with the new ttyd PID once running
+    if keep_sessions:
+        app.logger.info(f"Restoring {len(restored)} terminal(s) with surviving tmux sessions: {restored}")
+    return restored
+
+# --- Terminal Spawning & Pool ---
+def discard_terminal(port):
+    """Forgets a terminal that failed its health check and stops whatever is left of it."""
+    cleanup_single_terminal(port)
+
+def spawn_terminal(use_default_config=False):
+    """
+    Starts a new ttyd/tmux terminal and waits until it is healthy.
+    Returns (port, None) on success or (None, error message) on failure.
+    """
+    found_port = port_allocator.lease()
+    if found_port is None:
+        return None, 'No available ports found.'
+
+    start = time.monotonic()
+    process = start_ttyd_process(found_port, use_default_config=use_default_config)
+    if not process:
+        port_allocator.release(found_port)
+        terminal_pool.record_spawn(None)
+        return None, 'Failed to start terminal process.'
+    if not wait_for_ttyd_ready(process, found_port):
+        app.logger.error(f"ttyd process on port {found_port} exited immediately.")
+        discard_terminal(found_port)
+        terminal_pool.record_spawn(None)
+        return None, 'Terminal process failed to start properly.'
+    terminal_pool.record_spawn(time.monotonic() - start)
+    return found_port, None
+
+class TerminalPool:
+    """
+    Keeps up to `size` ttyd/tmux terminals started and health-checked ahead of time so
+    /api/terminals/new can hand one out immediately. A background thread refills the
+    pool once it drops to `low_water` ready terminals. Pooled terminals are tracked in
+    _running_ttyd_processes/_running_tmux_sessions like any other, so exit cleanup covers them.
+    """
+
+    def __init__(self, size=TERMINAL_POOL_SIZE, low_water=TERMINAL_POOL_LOW_WATER):
+        self.size = size
+        self.low_water = low_water
+        self.use_default_config = False
+        self._ready = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+        self.spawned = 0
+        self.spawn_failures = 0
+        self.discarded = 0
+        self._spawn_latencies = deque(maxlen=200) # Seconds, most recent spawns
+
+    def configure(self, size, low_water, use_default_config=False):
+        self.size = max(0, size)
+        self.low_water = max(0, min(low_water, self.size))
+        self.use_default_config = use_default_config
+
+    def record_spawn(self, latency):
+        """Records one spawn attempt; latency is None for a failed spawn."""
+        with self._lock:
+            if latency is None:
+                self.spawn_failures += 1
+            else:
+                self.spawned += 1
+                self._spawn_latencies.append(latency)
+
+    def _is_healthy(self, port):
+        with _terminal_lock:
+            process = _running_ttyd_processes.get(port)
+            has_session = port in _running_tmux_sessions
+        return process is not None and process.poll() is None and has_session
+
+    def acquire(self):
+        """Returns the port of a ready pooled terminal, or None if the pool is empty."""
+        port = None
+        while True:
+            with self._lock:
+                if not self._ready: break
+                candidate = self._ready.popleft()
+            if self._is_healthy(candidate):
+                port = candidate
+                break
+            app.logger.warning(f"Pooled terminal on port {candidate} died while idle; discarding.")
+            discard_terminal(candidate)
+            with self._lock: self.discarded += 1
+        with self._lock:
+            if port is None: self.misses += 1
+            else: self.hits += 1
+            needs_refill = len(self._ready) <= self.low_water
+        if needs_refill: self._wakeup.set()
+        return port
+
+    def drop(self, port):
+        """Removes a terminal that died or was cleaned up from the ready queue."""
+        with self._lock:
+            try: self._ready.remove(port)
+            except ValueError: pass
+
+    def _refill(self):
+        failures = 0
+        while failures < 3: # Back off after repeated failures until the next wakeup/poll
+            with self._lock:
+                missing = self.size - len(self._ready)
+            if missing <= 0: return
+            # Start all missing terminals at once; each spawn mostly waits on ttyd/tmux
+            with ThreadPoolExecutor(max_workers=missing, thread_name_prefix='pool-spawn') as executor:
+                results = list(executor.map(lambda _: spawn_terminal(self.use_default_config), range(missing)))
+            for port, error in results:
+                if port is None:
+                    failures += 1
+                    app.logger.warning(f"Terminal pool refill failed ({error}).")
+                    continue
+                register_terminal(port, pooled=True) # Before it can be acquired and registered as a tab
+                with self._lock: self._ready.append(port)
+                app.logger.info(f"Terminal pool: port {port} ready ({len(self._ready)}/{self.size}).")
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(timeout=30)
+            self._wakeup.clear()
+            try:
+                self._refill()
+            except Exception as e:
+                app.logger.error(f"Terminal pool refill error: {e}", exc_info=True)
+
+    def start(self):
+        """Starts the background refiller and fills the pool."""
+        if self.size <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._run, name='terminal-pool', daemon=True)
+        self._thread.start()
+        self._wakeup.set()
+
+    def metrics(self):
+        with self._lock:
+            latencies = sorted(self._spawn_latencies)
+            ready = list(self._ready)
+            counters = {'hits': self.hits, 'misses': self.misses, 'spawned': self.spawned,
+                        'spawn_failures': self.spawn_failures, 'discarded': self.discarded}
+        def pct(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 1) if latencies else None
+        return {
+            'size': self.size, 'low_water': self.low_water, 'ready': len(ready), 'ready_ports': ready,
+            **counters,
+            'spawn_latency_ms': {
+                'count': len(latencies), 'p50': pct(0.5), 'p95': pct(0.95),
+                'max': round(latencies[-1] * 1000, 1) if latencies else None,
+                'avg': round(sum(latencies) / len(latencies) * 1000, 1) if latencies else None,
+            },
+        }
+
+terminal_pool = TerminalPool()
+
+# --- Terminal Management Endpoints ---
+@app.route('/api/terminals/new', methods=['POST'])
+def new_terminal():
+    """API endpoint to start a new ttyd/tmux terminal instance (served from the pool when possible)."""
+    found_port = terminal_pool.acquire() if terminal_pool.size > 0 else None
+    if found_port is not None:
+        app.logger.info(f"New terminal served from pool on port {found_port}.")
+    else:
+        found_port, error = spawn_terminal(use_default_config=USE_DEFAULT_TMUX_CONFIG_FLAG)
+        if found_port is None:
+            status = 503 if error == 'No available ports found.' else 500
+            return jsonify({'success': False, 'error': error}), status
+        app.logger.info(f"New terminal OK on port {found_port}.")
+    data = request.get_json(silent=True)
+    name = data.get('name') if isinstance(data, dict) and isinstance(data.get('name'), str) else None
+    register_terminal(found_port, name, pooled=False)
+    url = terminal_url(found_port, request.host.rsplit(':', 1)[0])
+    event_broker.publish('terminal_created', {'port': found_port, 'name': name, 'url': url})
+    return jsonify({'success': True, 'port': found_port, 'url': url}), 200
+
+@app.route('/api/terminals/pool', methods=['GET'])
+def terminal_pool_status():
+    """API endpoint reporting terminal pool occupancy, hit/miss counters and spawn latency."""
+    return jsonify({'success': True, 'pool': terminal_pool.metrics(), 'ports': port_allocator.stats()})
+
+@app.route('/api/tmux/shards', methods=['GET'])
+def tmux_shard_status():
+    """API endpoint reporting the load on each tmux shard (see TmuxShards)."""
+    return jsonify({'success': True, 'policy': tmux_shards.policy, 'shards': tmux_shards.stats()})
+
+def forget_dead_terminal(port, reason='session_missing'):
+    """Drops tracking for a terminal whose tmux session is gone and kills its ttyd if still running."""
+    with _terminal_lock:
+        session_name = _running_tmux_sessions.pop(port, None)
+        proc = _running_ttyd_processes.pop(port, None)
+    if proc and proc.poll() is None: proc.kill()
+    port_allocator.release(port)
+    tmux_shards.release(port)
+    session_registry.remove(port)
+    terminal_pool.drop(port)
+    if session_name or proc:
+        event_broker.publish('terminal_died', {'port': port, 'reason': reason})
+
+def send_keys_to_port(port, command):
+    """Sends a command to the tmux session for `port`. Returns (response dict, HTTP status)."""
+    session_name = _running_tmux_sessions.get(port)
+    if not session_name:
+        app.logger.error(f"Send keys failed: No active tmux session found for port {port}.")
+        forget_dead_terminal(port)
+        return {'success': False, 'error': f'No active terminal session for port {port}.'}, 404
+
+    app.logger.info(f"Sending keys to tmux '{session_name}' (Port: {port})")
+    try:
+        result = tmux_send_keys(session_name, command, timeout=5, shard=tmux_shards.shard_of(port))
+
+        if result.returncode == 0:
+            app.logger.info(f"Keys sent successfully to tmux '{session_name}'.")
+            return {'success': True, 'message': 'Command sent successfully.'}, 200
+        else:
+            if is_tmux_session_missing(result.stderr):
+                 app.logger.error(f"Tmux error: Session '{session_name}' not found or server dead.")
+                 forget_dead_terminal(port)
+                 return {'success': False, 'error': f'Tmux session "{session_name}" not found.'}, 404
+            else:
+                app.logger.error(f"Tmux error sending keys. RC: {result.returncode}, Stderr: {result.stderr.strip()}")
+                return {'success': False, 'error': f'Tmux error: {result.stderr.strip()}'}, 500
+
+    except FileNotFoundError:
+        app.logger.error(f"'{TMUX_COMMAND}' not found. Cannot send keys.")
+        return {'success': False, 'error': f"'{TMUX_COMMAND}' command not found."}, 500
+    except subprocess.TimeoutExpired:
+        app.logger.error(f"Timeout sending keys to tmux '{session_name}'.")
+        return {'success': False, 'error': 'Timeout sending command.'}, 500
+    except Exception as e:
+        app.logger.error(f"Unexpected error sending keys: {e}", exc_info=True)
+        return {'success': False, 'error': 'Unexpected server error sending keys.'}, 500
+
+@app.route('/api/terminals/sendkeys', methods=['POST'])
+def send_keys_to_terminal():
+    """API endpoint to send command/keys to a specific tmux session."""
+    data = request.get_json()
+    if not data: return jsonify({'success': False, 'error': 'Invalid JSON body.'}), 400
+
+    port = data.get('port')
+    command = data.get('command')
+
+    if port is None or command is None: return jsonify({'success': False, 'error': 'Missing "port" or "command".'}), 400
+    try: port = int(port)
+    except ValueError: return jsonify({'success': False, 'error': 'Invalid port number.'}), 400
+
+    payload, status = send_keys_to_port(port, command)
+    return jsonify(payload), status
+
+def wait_for_shell_prompt(port, timeout):
+    """Polls the pane for `port` until its last non-empty line looks like a prompt. Returns True on success."""
+    deadline = time.monotonic() + timeout
+    time.sleep(0.2) # Give the shell a moment to start echoing the command
+    while time.monotonic() < deadline:
+        session_name = _running_tmux_sessions.get(port)
+        if not session_name:
+            return False
+        result = run_tmux(['capture-pane', '-p', '-t', session_name], shard=tmux_shards.shard_of(port))
+        if result.returncode == 0:
+            lines = [line for line in result.stdout.splitlines() if line.strip()]
+            if lines and PROMPT_PATTERN.search(lines[-1]):
+                return True
+        time.sleep(0.25)
+    return False
+
+def _parse_batch_item(index, item):
+    """Validates one batch item. Returns a normalised dict or raises ValueError."""
+    if not isinstance(item, dict):
+        raise ValueError(f'Item {index} must be an object.')
+    port, command = item.get('port'), item.get('command')
+    if port is None or not isinstance(command, str):
+        raise ValueError(f'Item {index} is missing "port" or "command".')
+    try:
+        port = int(port)
+        delay = float(item.get('delay', 0))
+        prompt_timeout = float(item.get('timeout', BATCH_DEFAULT_PROMPT_TIMEOUT))
+    except (TypeError, ValueError):
+        raise ValueError(f'Item {index} has an invalid port, delay or timeout.')
+    if not 0 <= delay <= BATCH_MAX_DELAY or not 0 < prompt_timeout <= BATCH_MAX_PROMPT_TIMEOUT:
+        raise ValueError(f'Item {index} delay or timeout is out of range.')
+    return {'index': index, 'port': port, 'command': command, 'delay': delay,
+            'wait_for_prompt': bool(item.get('wait_for_prompt', False)), 'timeout': prompt_timeout}
+
+def _run_session_items(items):
+    """Runs one session's items in order. Stops at the first item whose session is gone."""
+    results = []
+    session_gone = False
+    for item in items:
+        result = {'index': item['index'], 'port': item['port']}
+        if session_gone:
+            result.update({'success': False, 'status': 404, 'error': 'Skipped: terminal session is gone.'})
+            results.append(result)
+            continue
+        if item['delay']: time.sleep(item['delay'])
+        payload, status = send_keys_to_port(item['port'], item['command'])
+        result.update(payload, status=status)
+        if status == 404:
+            session_gone = True
+        elif payload['success'] and item['wait_for_prompt']:
+            result['prompt_seen'] = wait_for_shell_prompt(item['port'], item['timeout'])
+        results.append(result)
+    return results
+
+def _batch_worst_case_seconds(by_port):
+    """
+    How long a batch can take if every delay runs and every prompt wait times out: each
+    session's total, scheduled in order onto BATCH_MAX_WORKERS workers like the executor does.
+    """
+    finish = [0.0] * min(len(by_port), BATCH_MAX_WORKERS) # When each worker becomes free
+    for items in by_port.values():
+        seconds = sum(item['delay'] + (item['timeout'] if item['wait_for_prompt'] else 0) for item in items)
+        heapq.heapreplace(finish, finish[0] + seconds)
+    return max(finish)
+
+@app.route('/api/terminals/sendkeys/batch', methods=['POST'])
+def send_keys_batch():
+    """
+    API endpoint to send many commands in one request.
+    Body: {"items": [{"port", "command", "delay"?, "wait_for_prompt"?, "timeout"?}, ...]}.
+    Sessions are driven concurrently; items for the same port run in the given order.
+    Batches whose delays and prompt timeouts could add up to more than
+    BATCH_MAX_TOTAL_SECONDS are rejected. Returns per-item results in request order.
+    """
+    data = request.get_json(silent=True)
+    items = data.get('items') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'Body must contain a non-empty "items" list.'}), 400
+    if len(items) > BATCH_MAX_ITEMS:
+        return jsonify({'success': False, 'error': f'Too many items (max {BATCH_MAX_ITEMS}).'}), 400
+    try:
+        parsed = [_parse_batch_item(i, item) for i, item in enumerate(items)]
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+
+    by_port = {}
+    for item in parsed: by_port.setdefault(item['port'], []).append(item)
+    worst_case = _batch_worst_case_seconds(by_port)
+    if worst_case > BATCH_MAX_TOTAL_SECONDS:
+        return jsonify({'success': False, 'error': f'Delays and prompt timeouts add up to {worst_case:g}s '
+                        f'(max {BATCH_MAX_TOTAL_SECONDS}s); split the batch.'}), 400
+    app.logger.info(f"Batch dispatch: {len(parsed)} commands across {len(by_port)} terminals.")
+
+    results = [None] * len(parsed)
+    with ThreadPoolExecutor(max_workers=min(len(by_port), BATCH_MAX_WORKERS)) as executor:
+        for session_results in executor.map(_run_session_items, by_port.values()):
+            for result in session_results: results[result['index']] = result
+
+    return jsonify({'success': all(r['success'] for r in results), 'results': results}), 200
+
+@app.route('/api/terminals', methods=['GET'])
+def list_terminals():
+    """Lists the terminals the UI should show (besides the main one), e.g. to restore tabs after a restart."""
+    host = request.host.rsplit(':', 1)[0]
+    terminals = []
+    for port, entry in sorted(session_registry.entries().items()):
+        if port == _initial_ttyd_port or entry.get('pooled'): continue
+        with _terminal_lock:
+            process = _running_ttyd_processes.get(port)
+        terminals.append({'port': port, 'url': terminal_url(port, host), 'name': entry.get('name'),
+                          'session': entry['session'], 'ready': process is not None and process.poll() is None})
+    return jsonify({'success': True, 'terminals': terminals, 'keep_sessions': KEEP_SESSIONS})
+
+@app.route('/api/terminals/<int:port>', methods=['PATCH'])
+def rename_terminal(port):
+    """Stores a tab's display name so it survives reloads and restores."""
+    data = request.get_json(silent=True)
+    name = data.get('name') if isinstance(data, dict) else None
+    if not isinstance(name, str) or not name.strip():
+        return jsonify({'success': False, 'error': 'A non-empty name is required.'}), 400
+    if not session_registry.rename(port, name.strip()[:200]):
+        return jsonify({'success': False, 'error': f'Terminal on port {port} is not registered.'}), 404
+    event_broker.publish('terminal_renamed', {'port': port, 'name': name.strip()[:200]})
+    return jsonify({'success': True})
+
+# Modified DELETE route to NOT remove notes file implicitly
+@app.route('/api/terminals/<int:port>', methods=['DELETE'])
+def delete_terminal(port):
+    """API endpoint to stop and clean up a specific terminal instance's processes."""
+    app.logger.info(f"Received request to delete terminal processes for port: {port}")
+    if port == _initial_ttyd_port:
+        return jsonify({'success': False, 'error': 'Cannot delete the main terminal.'}), 403
+
+    with _terminal_lock:
+        is_tracked = port in _running_ttyd_processes or port in _running_tmux_sessions
+    if not is_tracked:
+         app.logger.warning(f"Request to delete untracked terminal port: {port}.")
+         session_registry.remove(port)
          # Notes file is intentionally NOT deleted here for orphaned case
          return jsonify({'success': True, 'message': f'Terminal on port {port} was not actively tracked.'}), 200
 
     # If tracked, cleanup_single_terminal handles process removal
     cleaned_up = cleanup_single_terminal(port) # This no longer deletes notes
+    event_broker.publish('terminal_deleted', {'port': port})
 
     if cleaned_up:
         return jsonify({'success': True, 'message': f'Terminal processes on port {port} stopped and cleaned up.'}), 200
@@ -481,35 +3523,637 @@ def delete_terminal(port):
         return jsonify({'success': False, 'error': f'Failed to fully clean up terminal processes on port {port}.'}), 500
 
 
-# --- Main Route (Unchanged) ---
+# --- Main Route ---
 @app.route('/')
 def index():
-    """Serves the main HTML page."""
-    return render_template('index.html', _initial_ttyd_port=_initial_ttyd_port)
+    """
+    Serves the main HTML page. The page only depends on the host name, whether the
+    initial terminal is ready and the static asset hashes, so renders are cached on
+    those; browsers revalidate with the ETag.
+    """
+    host = request.host.rsplit(':', 1)[0]
+    ready = startup.initial_terminal == 'ready'
+    context = {'_initial_ttyd_port': _initial_ttyd_port, 'initial_terminal_ready': ready,
+               'initial_terminal_url': terminal_url(_initial_ttyd_port, host)}
+    if '_flashes' in session: # Pending flash messages are rendered into the page, so it can't be shared
+        return render_template('index.html', **context)
+    page = index_page_cache.get((host, _initial_ttyd_port, ready, static_assets.fingerprint()))
+    if page is None:
+        body = render_template('index.html', **context).encode('utf-8')
+        # Rendering may have hashed static files for the first time, so key on the fingerprint after it
+        page = (body, hashlib.sha256(body).hexdigest()[:32])
+        index_page_cache.put((host, _initial_ttyd_port, ready, static_assets.fingerprint()), page)
+    response = Response(page[0], mimetype='text/html')
+    response.set_etag(page[1])
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 # --- Initial Terminal Startup ---
 # <<< Modified function signature >>>
-def start_initial_ttyd(use_default_config=False):
+class StartupTracker:
     """
-    Starts the initial ttyd instance on the predefined port.
-    Passes config flag to start_ttyd_process.
+    Startup progress and timings, all in ms since STARTUP_T0: when the web server
+    started listening, when the first terminal became usable and when the initial
+    terminal (and any other bootstrap terminals) finished starting.
     """
-    if not os.environ.get('WERKZEUG_RUN_MAIN'):
-        app.logger.info(f"Attempting to start initial ttyd on port {_initial_ttyd_port}...")
-        # <<< Pass the flag here >>>
-        process = start_ttyd_process(_initial_ttyd_port, initial_terminal=True, use_default_config=use_default_config)
-        if not process:
-            app.logger.critical(f"CRITICAL: Failed start initial ttyd on port {_initial_ttyd_port}.")
-        else:
-             try:
-                process.wait(timeout=0.5)
-                app.logger.critical(f"CRITICAL: Initial ttyd process PID {process.pid} exited immediately.")
-                if _initial_ttyd_port in _running_ttyd_processes: del _running_ttyd_processes[_initial_ttyd_port]
-                if _initial_ttyd_port in _running_tmux_sessions: del _running_tmux_sessions[_initial_ttyd_port]
-             except subprocess.TimeoutExpired:
-                app.logger.info(f"Initial ttyd process {process.pid} running OK.")
-    else:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.initial_terminal = 'pending' # pending -> starting -> ready | failed
+        self.timings = {'time_to_listen_ms': None, 'time_to_first_terminal_ms': None,
+                        'time_to_initial_terminal_ms': None, 'bootstrap_ms': None}
+
+    def mark(self, name, only_first=False):
+        with self._lock:
+            if only_first and self.timings.get(name) is not None: return
+            self.timings[name] = round((time.monotonic() - STARTUP_T0) * 1000, 1)
+
+    def set_initial_terminal(self, state):
+        with self._lock:
+            self.initial_terminal = state
+
+    def snapshot(self):
+        with self._lock:
+            return {'initial_terminal': self.initial_terminal, **self.timings}
+
+startup = StartupTracker()
+
+def _start_bootstrap_terminal(port, use_default_config, initial_terminal=False):
+    """Starts one terminal on a fixed port and waits until it answers. Returns True on success."""
+    app.logger.info(f"Attempting to start ttyd on port {port}...")
+    process = start_ttyd_process(port, initial_terminal=initial_terminal, use_default_config=use_default_config)
+    if not process:
+        app.logger.critical(f"CRITICAL: Failed start ttyd on port {port}.")
+        return False
+    if not wait_for_ttyd_ready(process, port):
+        app.logger.critical(f"CRITICAL: ttyd process PID {process.pid} on port {port} exited immediately.")
+        forget_dead_terminal(port)
+        return False
+    app.logger.info(f"ttyd process {process.pid} on port {port} running OK.")
+    register_terminal(port)
+    startup.mark('time_to_first_terminal_ms', only_first=True)
+    return True
+
+def bootstrap_terminals(use_default_config=False, extra_ports=()):
+    """
+    Starts the initial terminal and any `extra_ports` (e.g. restored sessions) in
+    parallel, then the terminal pool. Runs in the background by default so the UI is
+    served right away; the page polls /api/status until the initial terminal is ready.
+    """
+    if os.environ.get('WERKZEUG_RUN_MAIN'):
         app.logger.info("Skipping initial ttyd start in Werkzeug reloader process.")
+        return
+    startup.set_initial_terminal('starting')
+    extra_ports = list(extra_ports) + restore_sessions(KEEP_SESSIONS)
+    ports = [_initial_ttyd_port] + [port for port in extra_ports if port != _initial_ttyd_port]
+    with ThreadPoolExecutor(max_workers=min(len(ports), BOOTSTRAP_MAX_WORKERS), thread_name_prefix='bootstrap') as executor:
+        futures = {port: executor.submit(_start_bootstrap_terminal, port, use_default_config, port == _initial_ttyd_port)
+                   for port in ports}
+        initial_ok = futures[_initial_ttyd_port].result()
+        startup.set_initial_terminal('ready' if initial_ok else 'failed')
+        startup.mark('time_to_initial_terminal_ms')
+        started = 0
+        for port, future in futures.items():
+            if future.result(): started += 1
+            elif port != _initial_ttyd_port:
+                session_registry.remove(port) # Could not reattach; forget it rather than retry forever
+    startup.mark('bootstrap_ms')
+    app.logger.info(f"Terminal bootstrap finished: {started}/{len(ports)} started, timings {startup.snapshot()}")
+    terminal_pool.start()
+    terminal_supervisor.start()
+
+@app.route('/api/status', methods=['GET'])
+def get_status():
+    """Readiness of the app for the UI: initial terminal state and startup timings."""
+    snapshot = startup.snapshot()
+    return jsonify({"success": True, "ready": snapshot['initial_terminal'] == 'ready',
+                    "initial_terminal_url": terminal_url(_initial_ttyd_port, request.host.rsplit(':', 1)[0]),
+                    "startup": snapshot, "supervisor": terminal_supervisor.stats(), "events": event_broker.stats()})
+
+# --- Metrics & Request Timing ---
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    """Records latency per route (not per URL, to bound the label set) and reports it in Server-Timing."""
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.inc('commandwave_http_requests_total', method=request.method, route=route, status=response.status_code)
+    metrics.observe('commandwave_http_request_duration_seconds', elapsed, method=request.method, route=route)
+    response.headers['Server-Timing'] = f'app;dur={elapsed * 1000:.1f}'
+    if elapsed >= SLOW_REQUEST_THRESHOLD:
+        app.logger.warning(f"Slow request: {request.method} {request.path} -> {response.status_code} in {elapsed * 1000:.0f} ms")
+    return response
+
+@metrics.collector
+def collect_component_stats():
+    """Live terminal counts and the counters each component already keeps in stats()."""
+    with _terminal_lock:
+        running, starting = len(_running_ttyd_processes), len(_starting_ports)
+    pool, events, notes = terminal_pool.metrics(), event_broker.stats(), notes_store.stats()
+    supervisor, index = terminal_supervisor.stats(), playbook_index.stats()
+    yield 'commandwave_terminals', 'gauge', "Terminals by state.", {'state': 'running'}, running
+    yield 'commandwave_terminals', 'gauge', "Terminals by state.", {'state': 'starting'}, starting
+    yield 'commandwave_terminals', 'gauge', "Terminals by state.", {'state': 'pooled'}, pool['ready']
+    yield 'commandwave_terminal_pool_requests_total', 'counter', "New tabs served from the pool (hit) or spawned on demand (miss).", {'result': 'hit'}, pool['hits']
+    yield 'commandwave_terminal_pool_requests_total', 'counter', "New tabs served from the pool (hit) or spawned on demand (miss).", {'result': 'miss'}, pool['misses']
+    yield 'commandwave_supervisor_restarts_total', 'counter', "ttyd processes restarted by the supervisor.", {}, supervisor['restarts']
+    yield 'commandwave_supervisor_deaths_total', 'counter', "Terminals removed because their shell exited.", {}, supervisor['deaths']
+    yield 'commandwave_event_subscribers', 'gauge', "Connected /api/events clients.", {}, events['subscribers']
+    yield 'commandwave_events_published_total', 'counter', "Events published to /api/events clients.", {}, events['published']
+    yield 'commandwave_event_overflows_total', 'counter', "Clients told to resync after falling behind.", {}, events['overflows']
+    yield 'commandwave_event_streams_refused_total', 'counter', "/api/events streams refused over the limit.", {}, events['refused']
+    yield 'commandwave_notes_saves_total', 'counter', "Notes saves that changed the text.", {}, notes['saves']
+    yield 'commandwave_notes_dirty_documents', 'gauge', "Notes files with edits not yet written.", {}, notes['dirty']
+    yield 'commandwave_playbook_index_lines', 'gauge', "Lines held in the playbook search index.", {}, index['lines']
+    yield 'commandwave_playbook_index_files', 'gauge', "Playbooks held in the playbook search index.", {}, index['files']
+    queries = search_query_cache.stats()
+    yield 'commandwave_search_query_cache_total', 'counter', "Search query compilations served from the cache (hit) or parsed (miss).", {'result': 'hit'}, queries['hits']
+    yield 'commandwave_search_query_cache_total', 'counter', "Search query compilations served from the cache (hit) or parsed (miss).", {'result': 'miss'}, queries['misses']
+    shards = tmux_shards.stats()
+    for name, kind, help_text, key in (
+            ('commandwave_tmux_shard_sessions', 'gauge', "Terminal sessions placed on each tmux shard.", 'sessions'),
+            ('commandwave_tmux_shard_commands_total', 'counter', "tmux commands sent to each shard.", 'commands'),
+            ('commandwave_tmux_shard_timeouts_total', 'counter', "tmux commands a shard did not answer in time.", 'timeouts')):
+        for shard in shards:
+            yield name, kind, help_text, {'shard': shard['shard']}, shard[key]
+    for cache_name, cache in (('compressed_body', compressed_body_cache), ('index_page', index_page_cache)):
+        cached = cache.stats()
+        yield 'commandwave_response_cache_total', 'counter', "Response bodies served from a cache (hit) or built (miss).", {'cache': cache_name, 'result': 'hit'}, cached['hits']
+        yield 'commandwave_response_cache_total', 'counter', "Response bodies served from a cache (hit) or built (miss).", {'cache': cache_name, 'result': 'miss'}, cached['misses']
+    if profiler.running:
+        yield 'commandwave_profiler_samples_total', 'counter', "Stack samples taken by --profile.", {}, profiler.samples
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of the metrics above."""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/profile', methods=['GET'])
+def get_profile():
+    """Folded stacks collected by --profile (?reset=1 clears them after reading)."""
+    if not profiler.running:
+        return jsonify({"success": False, "error": "Profiler not enabled; start with --profile."}), 404
+    return Response(profiler.report(reset=request.args.get('reset') == '1'), mimetype='text/plain')
+
+
+# --- Response Compression & Static Assets ---
+class ResponseCache:
+    """LRU of response bodies (compressed bodies, rendered pages) keyed by tuples."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+compressed_body_cache = ResponseCache(COMPRESS_CACHE_SIZE)
+index_page_cache = ResponseCache(INDEX_RENDER_CACHE_SIZE)
+
+def negotiate_encoding(mimetype, size):
+    """'br' or 'gzip' if this response should be compressed for the current request, else None."""
+    if not COMPRESS_RESPONSES or size < COMPRESS_MIN_SIZE or mimetype not in COMPRESS_MIMETYPES:
+        return None
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    return 'gzip' if accepted['gzip'] else None
+
+def compress_bytes(data, encoding, best=False):
+    """Compresses data as 'br' or 'gzip'. best=True spends more CPU for a smaller result (used for static assets)."""
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if best else COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=9 if best else COMPRESS_GZIP_LEVEL, mtime=0)
+
+class StaticAssets:
+    """
+    Files under static/, addressed by content hash. url_for('static', filename='js/script.js')
+    produces js/script.<hash>.js, which is served with a year-long immutable Cache-Control;
+    each version's gzip/brotli bodies are built once and kept. A file is re-hashed when its
+    mtime or size changes, so edits are picked up by the next page render.
+    """
+    _HASHED_NAME_RE = re.compile(r'^(.+)\.([0-9a-f]{12})(\.[^./]+)$')
+
+    def __init__(self, folder):
+        self.folder = folder
+        self._assets = {} # filename -> current version (see get)
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        """Current version of a static file ({'body', 'hash', 'etag', 'mimetype', 'encoded'}), or None."""
+        path = safe_join(self.folder, filename)
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode):
+            return None
+        key = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            asset = self._assets.get(filename)
+        if asset is not None and asset['key'] == key:
+            return asset
+        with open(path, 'rb') as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()
+        asset = {'key': key, 'body': body, 'hash': digest[:12], 'etag': digest[:32],
+                 'mimetype': mimetypes.guess_type(filename)[0] or 'application/octet-stream', 'encoded': {}}
+        with self._lock:
+            self._assets[filename] = asset
+        return asset
+
+    def hashed_name(self, filename):
+        asset = self.get(filename)
+        if asset is None:
+            return filename # Let the request 404 rather than failing the page render
+        root, ext = os.path.splitext(filename)
+        return f"{root}.{asset['hash']}{ext}"
+
+    def resolve(self, requested):
+        """
+        Maps a requested name to (asset, immutable). A hashed name that no longer matches the
+        file's content (a page rendered before an edit) gets the current version, but uncached.
+        """
+        m = self._HASHED_NAME_RE.match(requested)
+        if m:
+            asset = self.get(m.group(1) + m.group(3))
+            if asset is not None:
+                return asset, asset['hash'] == m.group(2)
+        return self.get(requested), False
+
+    def encoded(self, asset, encoding):
+        body = asset['encoded'].get(encoding)
+        if body is None:
+            body = asset['encoded'][encoding] = compress_bytes(asset['body'], encoding, best=True)
+        return body
+
+    def fingerprint(self):
+        """Hashes of the assets handed out so far; changes when any of them is edited."""
+        with self._lock:
+            names = sorted(self._assets)
+        return tuple((self.get(name) or {}).get('hash') for name in names)
+
+    def precompress(self):
+        """Hashes and compresses every static file up front, so the first page load doesn't wait for it."""
+        encodings = ['gzip'] + (['br'] if brotli is not None else [])
+        count = 0
+        for dirpath, dirnames, filenames in os.walk(self.folder):
+            for name in filenames:
+                asset = self.get(os.path.relpath(os.path.join(dirpath, name), self.folder).replace(os.sep, '/'))
+                if asset and asset['mimetype'] in COMPRESS_MIMETYPES and len(asset['body']) >= COMPRESS_MIN_SIZE:
+                    for encoding in encodings:
+                        self.encoded(asset, encoding)
+                    count += 1
+        app.logger.info(f"Precompressed {count} static assets ({', '.join(encodings)}).")
+
+static_assets = StaticAssets(app.static_folder)
+
+@app.url_defaults
+def hashed_static_urls(endpoint, values):
+    """Makes url_for('static', ...) emit content-hashed names (see StaticAssets)."""
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.hashed_name(values['filename'])
+
+def serve_static(filename):
+    """Replaces Flask's static view: precompressed bodies, immutable caching for hashed names."""
+    asset, immutable = static_assets.resolve(filename)
+    if asset is None:
+        raise NotFound()
+    encoding = negotiate_encoding(asset['mimetype'], len(asset['body']))
+    response = Response(static_assets.encoded(asset, encoding) if encoding else asset['body'], mimetype=asset['mimetype'])
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    if asset['mimetype'] in COMPRESS_MIMETYPES:
+        response.vary.add('Accept-Encoding')
+    response.set_etag(asset['etag'], weak=bool(encoding))
+    response.headers['Cache-Control'] = f'public, max-age={STATIC_MAX_AGE}, immutable' if immutable else 'no-cache'
+    return response.make_conditional(request)
+
+app.view_functions['static'] = serve_static
+
+@app.after_request
+def compress_response(response):
+    """
+    gzip/brotli-compresses text responses above COMPRESS_MIN_SIZE. Streams (the event
+    stream), file downloads and already-encoded bodies pass through untouched. Bodies of
+    responses with a strong ETag are cached compressed, so re-sending an unchanged playbook
+    or page costs no CPU; their ETag becomes weak, which If-None-Match still matches.
+    """
+    if (response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers
+            or response.status_code in (204, 206, 304) or response.mimetype not in COMPRESS_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    size = response.calculate_content_length()
+    encoding = negotiate_encoding(response.mimetype, size or 0)
+    if encoding is None:
+        return response
+    etag, weak = response.get_etag()
+    cache_key = (request.path, etag, encoding) if etag and not weak else None
+    body = compressed_body_cache.get(cache_key) if cache_key else None
+    if body is None:
+        body = compress_bytes(response.get_data(), encoding)
+        if cache_key:
+            compressed_body_cache.put(cache_key, body)
+    metrics.inc('commandwave_http_compressed_bytes_total', size, encoding=encoding, stage='original')
+    metrics.inc('commandwave_http_compressed_bytes_total', len(body), encoding=encoding, stage='sent')
+    response.set_data(body)
+    response.headers['Content-Encoding'] = encoding
+    if etag:
+        response.set_etag(etag, weak=True) # Same resource, different bytes
+    return response
+
+
+# --- Terminal Supervisor ---
+class TerminalSupervisor:
+    """
+    Watches every tracked terminal from a background thread. Each pass reaps exited ttyd
+    processes with a non-blocking poll(), checks all tmux sessions with a single
+    list-sessions call and probes each ttyd's socket. A ttyd that crashed (or stopped
+    answering) while its tmux session lives is restarted onto that session. A terminal
+    whose session is gone is forgotten, except the main terminal, which is recreated.
+    Changes are published on /api/events so the UI need not find out from failed requests.
+    """
+
+    def __init__(self, interval=SUPERVISOR_INTERVAL):
+        self.interval = interval
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._restarts = {} # port -> deque of restart times
+        self._unresponsive = {} # port -> consecutive failed socket probes
+        self.checks = 0
+        self.restarts = 0
+        self.deaths = 0
+
+    def _snapshot(self):
+        with _terminal_lock:
+            return {port: (process, _running_tmux_sessions.get(port))
+                    for port, process in _running_ttyd_processes.items() if port not in _starting_ports}
+
+    @staticmethod
+    def _still_tracked(port, process):
+        """False if the terminal was deleted or replaced since the snapshot (so it is not ours to fix)."""
+        with _terminal_lock:
+            return _running_ttyd_processes.get(port) is process
+
+    def check(self):
+        """Runs one supervision pass."""
+        self.checks += 1
+        tracked = self._snapshot()
+        if not tracked: return
+        live_sessions, unreachable = list_tmux_sessions()
+        for port, (process, session_name) in tracked.items():
+            if session_name not in live_sessions:
+                if tmux_shards.shard_of(port) in unreachable: continue # Its server is hung; don't count the session as gone
+                if not self._still_tracked(port, process): continue
+                if port == _initial_ttyd_port:
+                    self._restart(port, process, 'main session exited', recreate=True)
+                else:
+                    app.logger.warning(f"Supervisor: tmux session '{session_name}' for port {port} is gone.")
+                    self.deaths += 1
+                    forget_dead_terminal(port, reason='session_exited')
+                continue
+            if process.poll() is not None: # Reaps the exited child without blocking
+                if self._still_tracked(port, process):
+                    self._restart(port, process, f'ttyd exited with code {process.returncode}')
+                continue
+            try:
+                with _connect_to_ttyd(port): pass
+                self._unresponsive.pop(port, None)
+            except OSError:
+                # Two misses in a row before acting, so a busy ttyd is not restarted needlessly
+                self._unresponsive[port] = self._unresponsive.get(port, 0) + 1
+                if self._unresponsive[port] >= 2 and self._still_tracked(port, process):
+                    self._restart(port, process, 'ttyd not accepting connections')
+        for port in list(self._unresponsive):
+            if port not in tracked: del self._unresponsive[port]
+
+    def _restart(self, port, process, reason, recreate=False):
+        """Replaces a terminal's ttyd (recreate=True also replaces its lost tmux session)."""
+        self._unresponsive.pop(port, None)
+        now = time.monotonic()
+        history = self._restarts.setdefault(port, deque())
+        while history and history[0] < now - SUPERVISOR_RESTART_WINDOW: history.popleft()
+        if len(history) >= SUPERVISOR_MAX_RESTARTS:
+            app.logger.error(f"Supervisor: port {port} restarted {len(history)} times in {SUPERVISOR_RESTART_WINDOW}s; giving up ({reason}).")
+            self.deaths += 1
+            if port == _initial_ttyd_port:
+                startup.set_initial_terminal('failed')
+            cleanup_single_terminal(port)
+            event_broker.publish('terminal_died', {'port': port, 'reason': 'restart_limit'})
+            return
+        history.append(now)
+        app.logger.warning(f"Supervisor: restarting ttyd for port {port} ({reason}).")
+        with _terminal_lock:
+            if _running_ttyd_processes.get(port) is not process: return
+            del _running_ttyd_processes[port]
+            _running_tmux_sessions.pop(port, None)
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        new_process = start_ttyd_process(port, initial_terminal=port == _initial_ttyd_port,
+                                          use_default_config=USE_DEFAULT_TMUX_CONFIG_FLAG)
+        if not new_process or not wait_for_ttyd_ready(new_process, port):
+            app.logger.error(f"Supervisor: could not restart ttyd for port {port}.")
+            self.deaths += 1
+            if port == _initial_ttyd_port:
+                startup.set_initial_terminal('failed')
+                forget_dead_terminal(port, reason='restart_failed')
+            else:
+                cleanup_single_terminal(port)
+                event_broker.publish('terminal_died', {'port': port, 'reason': 'restart_failed'})
+            return
+        self.restarts += 1
+        register_terminal(port)
+        event_broker.publish('terminal_restarted', {'port': port, 'reason': reason, 'session_recreated': recreate})
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                app.logger.error(f"Terminal supervisor error: {e}", exc_info=True)
+
+    def start(self):
+        if self._thread and self._thread.is_alive(): return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='terminal-supervisor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stats(self):
+        return {'interval': self.interval, 'checks': self.checks, 'restarts': self.restarts, 'deaths': self.deaths}
+
+terminal_supervisor = TerminalSupervisor()
+
+# --- Single-Port Terminal Proxy ---
+_TERM_PATH_RE = re.compile(r'^/term/(\d+)(/[^?]*)?(\?.*)?$')
+_HOP_BY_HOP_HEADERS = (b'connection', b'keep-alive')
+
+class TerminalProxy:
+    """
+    Minimal asyncio reverse proxy that serves every terminal under one port. The request
+    head is read to route /term/<id>/... to that terminal's ttyd Unix socket, then bytes
+    are piped both ways, so WebSocket upgrades pass straight through. Plain HTTP requests
+    are forwarded with `Connection: close` because each connection is bound to one
+    backend; WebSocket connections stay open for the life of the terminal.
+    """
+
+    def __init__(self):
+        self.loop = None
+        self._thread = None
+        self.active_connections = 0
+        self.total_connections = 0
+
+    def start(self, host, port):
+        """Starts the proxy on a background event loop. Returns True once it is listening."""
+        ready = threading.Event()
+        errors = []
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(asyncio.start_server(self._handle, host, port))
+            except OSError as e:
+                errors.append(e)
+                ready.set()
+                return
+            ready.set()
+            self.loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='terminal-proxy', daemon=True)
+        self._thread.start()
+        ready.wait(timeout=5)
+        if errors:
+            app.logger.critical(f"CRITICAL: Terminal proxy could not listen on {host}:{port}: {errors[0]}")
+            return False
+        app.logger.info(f"Terminal proxy listening on http://{host}:{port}/term/<id>/ (sockets in {TERMINAL_SOCKET_DIR}).")
+        return True
+
+    @staticmethod
+    async def _respond(writer, status, reason, headers=()):
+        lines = [f'HTTP/1.1 {status} {reason}', 'Content-Length: 0', 'Connection: close', *headers]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+        writer.close()
+
+    @staticmethod
+    async def _pipe(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data: break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            try:
+                if writer.can_write_eof(): writer.write_eof()
+            except (OSError, RuntimeError):
+                pass
+
+    async def _handle(self, reader, writer):
+        self.active_connections += 1
+        self.total_connections += 1
+        backend_writer = None
+        try:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout=30)
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+                writer.close()
+                return
+            request_line, *header_lines = head[:-4].split(b'\r\n')
+            parts = request_line.decode('latin-1').split(' ')
+            match = _TERM_PATH_RE.match(parts[1]) if len(parts) == 3 else None
+            if not match:
+                await self._respond(writer, 404, 'Not Found')
+                return
+            term_id = int(match.group(1))
+            if match.group(2) is None: # ttyd expects the trailing slash of its base path
+                await self._respond(writer, 301, 'Moved Permanently',
+                                    [f'Location: /term/{term_id}/{match.group(3) or ""}'])
+                return
+            with _terminal_lock:
+                tracked = term_id in _running_ttyd_processes
+            try:
+                if not tracked: raise OSError('terminal not tracked')
+                backend_reader, backend_writer = await asyncio.open_unix_connection(terminal_socket_path(term_id))
+            except OSError:
+                await self._respond(writer, 502, 'Bad Gateway')
+                return
+
+            is_upgrade = any(line.lower().startswith(b'upgrade:') for line in header_lines)
+            if not is_upgrade:
+                header_lines = [line for line in header_lines
+                                if line.split(b':', 1)[0].strip().lower() not in _HOP_BY_HOP_HEADERS]
+                header_lines.append(b'Connection: close')
+            backend_writer.write(b'\r\n'.join([request_line, *header_lines]) + b'\r\n\r\n')
+            await asyncio.gather(self._pipe(reader, backend_writer), self._pipe(backend_reader, writer))
+        except Exception as e:
+            app.logger.warning(f"Terminal proxy connection error: {e}")
+        finally:
+            self.active_connections -= 1
+            for w in (backend_writer, writer):
+                if w is not None: w.close()
+
+terminal_proxy = TerminalProxy()
+
+# --- Web Server ---
+def run_server(server='threaded', host=SERVER_HOST, port=SERVER_PORT, threads=SERVER_THREADS):
+    """
+    Serves the app. 'threaded' is Werkzeug with a thread per request; 'waitress' is the
+    production WSGI server with a fixed pool of `threads` workers (in requirements.txt).
+    Either way slow tmux/ttyd calls only tie up their own request. Werkzeug stays the
+    default because it has no pool for event streams and long batches to use up.
+    """
+    if server == 'waitress':
+        try:
+            from waitress import create_server
+        except ImportError:
+            app.logger.error("waitress is not installed (pip install -r requirements.txt); falling back to the threaded Werkzeug server.")
+        else:
+            wsgi_server = create_server(app, host=host, port=port, threads=threads)
+            startup.mark('time_to_listen_ms')
+            app.logger.info(f"Serving with waitress on http://{host}:{port} ({threads} worker threads), "
+                            f"listening after {startup.timings['time_to_listen_ms']} ms.")
+            wsgi_server.run()
+            return
+    from werkzeug.serving import make_server
+    wsgi_server = make_server(host, port, app, threaded=True)
+    startup.mark('time_to_listen_ms')
+    app.logger.info(f"Serving with threaded Werkzeug server on http://{host}:{port}, "
+                    f"listening after {startup.timings['time_to_listen_ms']} ms.")
+    wsgi_server.serve_forever()
 
 
 # --- Run Application ---
@@ -521,22 +4165,172 @@ if __name__ == '__main__':
         action='store_true',
         help="Ignore the local commandwave_theme.tmux.conf and use tmux's default configuration."
     )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help=f"Sample all threads' stacks every {PROFILER_INTERVAL * 1000:.0f} ms; read them at /api/profile "
+             f"(folded format for flame graphs), written to '{PROFILER_OUTPUT_FILE}' at exit."
+    )
+    parser.add_argument(
+        '--playbooks-dir',
+        action='append', dest='playbooks_dirs', metavar='DIR',
+        help=f"Playbook library root, searched recursively (repeatable; default: '{PLAYBOOKS_DIR}'). "
+             "With several roots, playbook ids are prefixed with the root's directory name."
+    )
+    parser.add_argument(
+        '--terminal-pool-size',
+        type=int, default=TERMINAL_POOL_SIZE,
+        help=f"Number of pre-started terminals kept ready for new tabs (0 disables the pool, default: {TERMINAL_POOL_SIZE})."
+    )
+    parser.add_argument(
+        '--terminal-pool-low-water',
+        type=int, default=TERMINAL_POOL_LOW_WATER,
+        help=f"Refill the terminal pool once this many ready terminals remain (default: {TERMINAL_POOL_LOW_WATER})."
+    )
+    parser.add_argument(
+        '--no-tmux-control-mode',
+        action='store_true',
+        help="Run every tmux command as its own subprocess instead of over a persistent 'tmux -C' connection."
+    )
+    parser.add_argument(
+        '--tmux-shards',
+        type=int, default=TMUX_SHARDS,
+        help="Spread terminal sessions over this many tmux servers (sockets "
+             f"'{TMUX_SHARD_SOCKET_PREFIX}<n>'), so one busy or hung server only affects its share "
+             f"(default: {TMUX_SHARDS}, the default tmux server)."
+    )
+    parser.add_argument(
+        '--tmux-shard-policy',
+        choices=['least-loaded', 'round-robin'], default=TMUX_SHARD_POLICY,
+        help=f"How new sessions are placed on tmux shards (default: {TMUX_SHARD_POLICY})."
+    )
+    parser.add_argument(
+        '--server',
+        choices=['threaded', 'waitress'], default='threaded',
+        help="Web server: 'threaded' (Werkzeug, thread per request) or 'waitress' (production WSGI worker pool, requires waitress)."
+    )
+    parser.add_argument(
+        '--threads',
+        type=int, default=SERVER_THREADS,
+        help=f"Worker threads for --server waitress (default: {SERVER_THREADS}). Every open browser "
+             "tab holds one of them for its /api/events stream, so keep this above --max-event-streams."
+    )
+    parser.add_argument(
+        '--max-event-streams',
+        type=int, default=EVENTS_MAX_STREAMS,
+        help=f"Open /api/events streams (one per browser tab) allowed at once; further tabs retry "
+             f"later and miss live updates meanwhile (default: {EVENTS_MAX_STREAMS})."
+    )
+    parser.add_argument(
+        '--port-range-start',
+        type=int, default=_ttyd_port_range_start,
+        help=f"First port used for additional terminals (default: {_ttyd_port_range_start})."
+    )
+    parser.add_argument(
+        '--port-range-end',
+        type=int, default=None,
+        help=f"Last port used for additional terminals (default: {_ttyd_port_range_end}, or "
+             f"{TERMINAL_SOCKET_ID_COUNT} ids in single-port mode)."
+    )
+    parser.add_argument(
+        '--capture-scrollback',
+        action='store_true',
+        help=f"Log terminal output to gzip files under '{SCROLLBACK_DIR}/' and make it searchable "
+             "via /api/scrollback/search."
+    )
+    parser.add_argument(
+        '--terminal-proxy-port',
+        type=int, default=None,
+        help="Serve all terminals through one port at /term/<id>/ with ttyd on Unix sockets "
+             "(removes the per-terminal TCP port limit)."
+    )
+    parser.add_argument(
+        '--keep-sessions',
+        action='store_true',
+        help="Leave terminal tmux sessions running when the app exits and reattach to them "
+             f"(tracked in '{SESSION_REGISTRY_FILE}') on the next start."
+    )
+    parser.add_argument(
+        '--blocking-startup',
+        action='store_true',
+        help="Start the initial terminal before the web server listens (default: serve the UI "
+             "immediately and start terminals in the background)."
+    )
+    parser.add_argument(
+        '--no-compression',
+        action='store_true',
+        help="Send responses uncompressed (default: gzip, or brotli when installed, above "
+             f"{COMPRESS_MIN_SIZE} bytes)."
+    )
+    parser.add_argument('--host', default=SERVER_HOST, help=f"Address to listen on (default: {SERVER_HOST}).")
+    parser.add_argument('--port', type=int, default=SERVER_PORT, help=f"Port to listen on (default: {SERVER_PORT}).")
     args = parser.parse_args()
+    init_runtime()
 
     # <<< Store parsed argument in global variable >>>
     USE_DEFAULT_TMUX_CONFIG_FLAG = args.use_default_tmux_config
 
     if USE_DEFAULT_TMUX_CONFIG_FLAG:
         app.logger.info("Command-line option --use-default-tmux-config detected.")
+    if args.profile:
+        profiler.start()
+        app.logger.info(f"Sampling profiler enabled ({PROFILER_INTERVAL * 1000:.0f} ms interval).")
+    if args.no_tmux_control_mode:
+        USE_TMUX_CONTROL_MODE = False
+        app.logger.info("tmux control mode disabled; using one subprocess per tmux command.")
+    if args.tmux_shards < 1:
+        parser.error("--tmux-shards must be at least 1.")
+    tmux_shards.configure(args.tmux_shards, args.tmux_shard_policy)
+    if args.tmux_shards > 1:
+        app.logger.info(f"Spreading terminal sessions over {args.tmux_shards} tmux servers ({args.tmux_shard_policy}).")
+
+    event_broker.max_subscribers = args.max_event_streams
+    if args.server == 'waitress' and args.max_event_streams >= args.threads:
+        app.logger.warning(f"--max-event-streams {args.max_event_streams} leaves no waitress worker threads "
+                           f"(--threads {args.threads}) for other requests once that many tabs are open.")
+
+    if args.no_compression:
+        COMPRESS_RESPONSES = False
+        app.logger.info("Response compression disabled.")
 
-    # <<< Pass the flag to the initial start function >>>
-    start_initial_ttyd(use_default_config=USE_DEFAULT_TMUX_CONFIG_FLAG)
+    SCROLLBACK_CAPTURE = args.capture_scrollback
+    KEEP_SESSIONS = args.keep_sessions
+    if args.terminal_proxy_port:
+        TERMINAL_PROXY_PORT = args.terminal_proxy_port
+        os.makedirs(TERMINAL_SOCKET_DIR, mode=0o700, exist_ok=True)
+    port_range_end = args.port_range_end
+    if port_range_end is None:
+        port_range_end = (args.port_range_start + TERMINAL_SOCKET_ID_COUNT - 1) if TERMINAL_PROXY_PORT else _ttyd_port_range_end
+    if args.port_range_start <= _initial_ttyd_port <= port_range_end:
+        parser.error(f"The terminal port range must not include the main terminal port {_initial_ttyd_port}.")
+    try:
+        port_allocator.configure(args.port_range_start, port_range_end, verify=not TERMINAL_PROXY_PORT)
+    except ValueError as e:
+        parser.error(str(e))
+    if TERMINAL_PROXY_PORT and not terminal_proxy.start(args.host, TERMINAL_PROXY_PORT):
+        sys.exit(1)
+
+    # Build the playbook search index in the background and keep it in sync with the roots
+    if args.playbooks_dirs:
+        for directory in args.playbooks_dirs:
+            if not os.path.isdir(directory):
+                app.logger.warning(f"Playbook directory '{directory}' does not exist (yet).")
+        playbook_index.set_roots(args.playbooks_dirs)
+    playbook_index.start_polling()
+    static_assets.precompress() # Hash and compress static files now rather than on the first page load
+
+    # Start the initial terminal, then pre-start pooled terminals so new tabs open instantly
+    terminal_pool.configure(args.terminal_pool_size, args.terminal_pool_low_water, USE_DEFAULT_TMUX_CONFIG_FLAG)
+    if args.blocking_startup:
+        bootstrap_terminals(USE_DEFAULT_TMUX_CONFIG_FLAG)
+    else:
+        threading.Thread(target=bootstrap_terminals, args=(USE_DEFAULT_TMUX_CONFIG_FLAG,),
+                         name='terminal-bootstrap', daemon=True).start()
 
     app.logger.info("Starting Flask application server...")
     try:
         # WARNING: Running on 0.0.0.0 makes the app accessible from your network.
-        # use_reloader=False is strongly recommended. debug=False for production.
-        app.run(debug=False, host='127.0.0.1', port=5000, use_reloader=False)
+        run_server(args.server, args.host, args.port, args.threads)
     except Exception as e:
          app.logger.error(f"Flask app run failed: {e}", exc_info=True)
          cleanup_processes() # Attempt cleanup on failure
@@ -38,7 +38,13 @@ document.addEventListener('DOMContentLoaded', async () => {
     // Debounce timer IDs
     let globalNotesSaveTimeout = null;
     let tabNotesSaveTimeout = null;
+    const notesSyncState = {}; // notes URL -> { text, version, epoch } last acknowledged by the server
+    let eventStreamOpen = false; // True while /api/events is connected (cached state is then current)
     let searchDebounceTimeout = null; // For search debounce
+    const SEARCH_PAGE_SIZE = 50; // Matches requested per page from /api/playbooks/search
+    const EVENT_STREAM_RETRY_MS = 30000; // Wait before reopening /api/events after the server refused it
+    const NOTES_SAVE_ATTEMPTS = 3; // Conflicting saves retried (after merging) before giving up
+    const playbookBlockCache = new Map(); // ETag -> parsed blocks, so unchanged playbooks are not re-parsed
 
     // --- DOM Element References ---
     const searchInput = document.getElementById('searchInput');
@@ -123,6 +129,156 @@ document.addEventListener('DOMContentLoaded', async () => {
          }
      }
 
+    // The page is served before the main terminal is up; poll /api/status and load it once ready
+    async function waitForInitialTerminal(iframe, delay = 200) {
+        try {
+            const response = await fetch('/api/status');
+            const data = await response.json();
+            if (data.ready) {
+                iframe.src = data.initial_terminal_url || iframe.dataset.pendingSrc;
+                delete iframe.dataset.pendingSrc;
+                return;
+            }
+            if (data.startup?.initial_terminal === 'failed') {
+                showIoMessage('Main terminal failed to start. Check the server log.', 'error', 15000);
+                return;
+            }
+        } catch (error) { console.warn("Status poll failed:", error); }
+        setTimeout(() => waitForInitialTerminal(iframe, Math.min(delay * 1.5, 2000)), delay);
+    }
+
+    // --- Live Server Events ---
+    function handleTerminalDied(data) {
+        const terminalId = data.port === initialTerminalPort ? 'term-main' : `term-${data.port}`;
+        const tab = terminalTabsContainer?.querySelector(`.terminal-tab[data-terminal-id="${terminalId}"]`);
+        if (!tab) return;
+        tab.classList.add('dead');
+        tab.title = `${tab.title.replace(/ \[exited\]$/, '')} [exited]`;
+        showIoMessage(`Terminal "${tab.querySelector('.tab-text')?.textContent || data.port}" has exited (${data.reason}).`, 'warning', 8000);
+    }
+
+    function handleTerminalRestarted(data) {
+        const terminalId = data.port === initialTerminalPort ? 'term-main' : `term-${data.port}`;
+        const iframe = terminalIframesContainer?.querySelector(`#${terminalId}`);
+        const tab = terminalTabsContainer?.querySelector(`.terminal-tab[data-terminal-id="${terminalId}"]`);
+        tab?.classList.remove('dead');
+        if (iframe && iframe.src !== 'about:blank') { iframe.src = iframe.src; } // Reconnect to the new ttyd
+    }
+
+    // Terminal URLs behind the single-port proxy carry the creating browser's host name; use ours
+    function localizeTerminalUrl(url) {
+        try {
+            const parsed = new URL(url);
+            if (parsed.pathname.startsWith('/term/')) { parsed.hostname = window.location.hostname; }
+            return parsed.toString();
+        } catch (e) { return url; }
+    }
+
+    function handleTerminalCreated(data) {
+        if (terminalTabsContainer?.querySelector(`.terminal-tab[data-terminal-id="term-${data.port}"]`)) return;
+        createTerminalTab(data.port, localizeTerminalUrl(data.url), escapeHtml(data.name || `Terminal ${data.port}`));
+    }
+
+    function handleTerminalRenamed(data) {
+        const tab = terminalTabsContainer?.querySelector(`.terminal-tab[data-terminal-id="term-${data.port}"]`);
+        const textSpan = tab?.querySelector('.tab-text');
+        if (!textSpan) return;
+        const sanitizedName = escapeHtml(data.name);
+        textSpan.textContent = sanitizedName;
+        tab.title = `Terminal: ${sanitizedName} (Port ${data.port}). Double-click rename.`;
+        if (`term-${data.port}` === activeTerminalId && tabNotesPanelLabel) { tabNotesPanelLabel.textContent = sanitizedName; }
+    }
+
+    // UTF-16 index of a code point offset (the server counts code points)
+    function utf16Index(text, codePointOffset) {
+        let index = 0;
+        for (let i = 0; i < codePointOffset && index < text.length; i++) {
+            const code = text.charCodeAt(index);
+            index += (code >= 0xD800 && code <= 0xDBFF && index + 1 < text.length) ? 2 : 1;
+        }
+        return index;
+    }
+
+    function notesAreaFor(url) {
+        if (url === '/api/notes/global') return globalNotesArea;
+        return activeTerminalId && url === notesUrlFor(activeTerminalId) ? tabNotesArea : null;
+    }
+
+    async function reloadNotes(url) {
+        delete notesSyncState[url];
+        const area = notesAreaFor(url);
+        if (!area) return; // Re-fetched on next use
+        try {
+            const data = await (await fetch(url)).json();
+            if (data.success && notesAreaFor(url) === area) { area.value = data.notes || ""; rememberSavedNotes(url, area.value, data); }
+        } catch (error) { console.warn("Could not reload notes:", error); }
+    }
+
+    // Applies notes edits made in other browsers, unless this page has unsaved edits of its own
+    function handleNotesUpdated(data) {
+        const url = data.scope === 'global' ? '/api/notes/global' : notesUrlFor(data.terminal_id);
+        const synced = notesSyncState[url];
+        if (!synced) return; // Not loaded here
+        // Versions restart with each server process, so they only compare within one epoch
+        const sameEpoch = data.epoch === synced.epoch;
+        if (sameEpoch && data.version <= synced.version) return; // Our own save
+        const area = notesAreaFor(url);
+        if (area && area.value !== synced.text) return; // Our pending save will conflict and be resolved there
+        if (!sameEpoch || !data.patch || data.base_version !== synced.version) { reloadNotes(url); return; }
+        const start = utf16Index(synced.text, data.patch.start);
+        const end = start + utf16Index(synced.text.slice(start), data.patch.end - data.patch.start);
+        const text = synced.text.slice(0, start) + data.patch.text + synced.text.slice(end);
+        rememberSavedNotes(url, text, data);
+        if (area) {
+            const shift = (pos) => pos <= start ? pos : Math.max(start + data.patch.text.length, pos + data.patch.text.length - (end - start));
+            const [selStart, selEnd] = [shift(area.selectionStart), shift(area.selectionEnd)];
+            area.value = text;
+            if (document.activeElement === area) { area.setSelectionRange(selStart, selEnd); }
+        }
+    }
+
+    function handlePlaybooksUpdated() {
+        const searchTerm = searchInput?.value.trim();
+        if (searchTerm && searchTerm.length >= 2 && searchResultsContainer?.style.display !== 'none') { fetchSearchPage(searchTerm, null); }
+    }
+
+    // Sent when this page missed events (fell behind or reconnected too late): re-fetch everything
+    function handleResync() {
+        for (const url of Object.keys(notesSyncState)) {
+            const area = notesAreaFor(url);
+            if (!area || area.value === notesSyncState[url]?.text) { reloadNotes(url); }
+        }
+        restoreTerminalTabs();
+        handlePlaybooksUpdated();
+    }
+
+    // The browser reconnects by itself after a dropped or expired stream, resuming from the last
+    // event id. A refused stream (the server's stream limit, HTTP 503) is closed for good, so
+    // a new one is opened later; it starts without an event id and so re-fetches everything.
+    function connectEventStream(resync = false) {
+        if (!window.EventSource) return;
+        const source = new EventSource('/api/events');
+        source.addEventListener('open', () => {
+            eventStreamOpen = true;
+            if (resync) { resync = false; handleResync(); }
+        });
+        source.addEventListener('error', () => {
+            eventStreamOpen = false;
+            if (source.readyState === EventSource.CLOSED) {
+                setTimeout(() => connectEventStream(true), EVENT_STREAM_RETRY_MS * (1 + Math.random()));
+            }
+        });
+        const handlers = {
+            terminal_died: handleTerminalDied, terminal_restarted: handleTerminalRestarted,
+            terminal_created: handleTerminalCreated, terminal_renamed: handleTerminalRenamed,
+            terminal_deleted: (data) => removeTerminalTab(`term-${data.port}`),
+            notes_updated: handleNotesUpdated, playbooks_updated: handlePlaybooksUpdated, resync: handleResync,
+        };
+        for (const [type, handler] of Object.entries(handlers)) {
+            source.addEventListener(type, (event) => handler(JSON.parse(event.data)));
+        }
+    }
+
     async function initializeApp() {
         console.log("Initializing App...");
         try {
@@ -136,11 +292,15 @@ document.addEventListener('DOMContentLoaded', async () => {
                 mainTerminalTab.title = `Main Terminal (Port ${initialTerminalPort}). Double-click rename.`;
              }
 
+            if (mainTermElem?.dataset.pendingSrc) { waitForInitialTerminal(mainTermElem); } // Server still starting it
+
             activeTerminalId = 'term-main';
             ensureTerminalState(activeTerminalId);
             updateVariableInputsUI(activeTerminalId);
 
             await loadInitialNotes();
+            restoreTerminalTabs();
+            connectEventStream();
 
             setupEventListeners();
             console.log("App Init OK.");
@@ -340,7 +500,10 @@ document.addEventListener('DOMContentLoaded', async () => {
                 copyBtn.addEventListener('click', () => handleCopyCommand(copyBtn));
                 const executeBtn = document.createElement('button'); executeBtn.type = 'button'; executeBtn.className = 'execute-btn'; executeBtn.title = 'Execute Code'; executeBtn.textContent = 'Execute'; executeBtn.dataset.commandSubstituted = substitutedText;
                 executeBtn.addEventListener('click', () => handleExecuteCommand(executeBtn));
-                buttonContainer.appendChild(copyBtn); buttonContainer.appendChild(executeBtn); codeContainer.appendChild(buttonContainer);
+                // Runs the block in every open tab, substituting each tab's own variables
+                const executeAllBtn = document.createElement('button'); executeAllBtn.type = 'button'; executeAllBtn.className = 'execute-btn execute-all-btn'; executeAllBtn.title = 'Execute in all terminal tabs'; executeAllBtn.textContent = 'All Tabs'; executeAllBtn.dataset.commandRaw = currentContent;
+                executeAllBtn.addEventListener('click', () => handleExecuteAllCommand(executeAllBtn));
+                buttonContainer.appendChild(copyBtn); buttonContainer.appendChild(executeBtn); buttonContainer.appendChild(executeAllBtn); codeContainer.appendChild(buttonContainer);
 
                  // --- Add Double-Click Listener to <pre> for Editing ---
                  pre.addEventListener('dblclick', (event) => {
@@ -499,47 +662,72 @@ document.addEventListener('DOMContentLoaded', async () => {
             console.log(`Searching local playbooks for: ${searchTerm}`);
             if (searchResultsList) searchResultsList.innerHTML = '<li><i>Searching...</i></li>';
             if (searchResultsContainer) searchResultsContainer.style.display = 'block';
-            try {
-                const response = await fetch(`/api/playbooks/search?query=${encodeURIComponent(searchTerm)}`);
-                if (!response.ok) {
-                     let errorMsg = `HTTP error! status: ${response.status}`;
-                     try { const errorData = await response.json(); errorMsg = errorData.error || errorMsg; } catch (jsonError) { /* Ignore */ }
-                     throw new Error(errorMsg);
-                }
-                const results = await response.json();
-                if (results.success && searchResultsList) {
-                    displaySearchResults(results.matches || []);
-                } else if (!results.success) {
-                    console.error("Search API Error:", results.error);
-                    if(searchResultsList) searchResultsList.innerHTML = `<li><i>Error: ${escapeHtml(results.error || 'Unknown search error')}</i></li>`;
-                }
-            } catch (error) {
-                console.error("Fetch error during search:", error);
-                if(searchResultsList) searchResultsList.innerHTML = `<li><i>Error fetching search results: ${escapeHtml(error.message)}</i></li>`;
-            }
+            await fetchSearchPage(searchTerm, null);
         }, 300);
     }
 
-    function displaySearchResults(matches) {
+    // Fetches one page of ranked results; a null cursor starts a fresh result list
+    async function fetchSearchPage(searchTerm, cursor) {
+        try {
+            let url = `/api/playbooks/search?query=${encodeURIComponent(searchTerm)}&limit=${SEARCH_PAGE_SIZE}`;
+            if (cursor) url += `&cursor=${encodeURIComponent(cursor)}`;
+            const response = await fetch(url);
+            if (!response.ok) {
+                 let errorMsg = `HTTP error! status: ${response.status}`;
+                 try { const errorData = await response.json(); errorMsg = errorData.error || errorMsg; } catch (jsonError) { /* Ignore */ }
+                 throw new Error(errorMsg);
+            }
+            const results = await response.json();
+            // Ignore stale pages if the search box changed while this request was in flight
+            if (searchInput && searchInput.value.trim() !== searchTerm) return;
+            if (results.success && searchResultsList) {
+                displaySearchResults(results.matches || [], { append: Boolean(cursor), nextCursor: results.next_cursor, searchTerm });
+            } else if (!results.success) {
+                console.error("Search API Error:", results.error);
+                if(searchResultsList) searchResultsList.innerHTML = `<li><i>Error: ${escapeHtml(results.error || 'Unknown search error')}</i></li>`;
+            }
+        } catch (error) {
+            console.error("Fetch error during search:", error);
+            if(searchResultsList) searchResultsList.innerHTML = `<li><i>Error fetching search results: ${escapeHtml(error.message)}</i></li>`;
+        }
+    }
+
+    // Marks the [start, end] span (code point offsets) the server reports for a match
+    function highlightSearchMatch(line, span) {
+        if (!Array.isArray(span)) { return escapeHtml(line); }
+        const [start, end] = [utf16Index(line, span[0]), utf16Index(line, span[1])];
+        return escapeHtml(line.slice(0, start)) + '<mark>' + escapeHtml(line.slice(start, end)) + '</mark>' + escapeHtml(line.slice(end));
+    }
+
+    function displaySearchResults(matches, { append = false, nextCursor = null, searchTerm = '' } = {}) {
         if (!searchResultsList || !searchResultsContainer) return;
-        searchResultsList.innerHTML = '';
-        if (matches.length === 0) {
+        if (append) { searchResultsList.querySelector('.search-load-more')?.remove(); }
+        else { searchResultsList.innerHTML = ''; }
+        if (matches.length === 0 && !append) {
             searchResultsList.innerHTML = '<li><i>No matching lines found in local playbooks.</i></li>';
         } else {
-            const searchTermRegex = new RegExp(`(${escapeHtml(searchInput.value.trim())})`, 'gi');
             matches.forEach(match => {
                 const li = document.createElement('li'); li.classList.add('search-result-item');
                 const infoDiv = document.createElement('div'); infoDiv.className = 'search-result-info';
                 const fileSpan = document.createElement('span'); fileSpan.className = 'search-result-filename'; fileSpan.textContent = match.filename;
                 const lineNumSpan = document.createElement('span'); lineNumSpan.className = 'search-result-linenum'; lineNumSpan.textContent = ` (Line: ${match.line_number})`;
                 const lineContentSpan = document.createElement('code'); lineContentSpan.className = 'search-result-linecontent';
-                const highlightedContent = escapeHtml(match.line_content).replace(searchTermRegex, '<mark>$1</mark>');
-                lineContentSpan.innerHTML = highlightedContent;
+                lineContentSpan.innerHTML = highlightSearchMatch(match.line_content, match.highlight);
                 infoDiv.appendChild(fileSpan); infoDiv.appendChild(lineNumSpan); infoDiv.appendChild(lineContentSpan);
                 const importBtn = document.createElement('button'); importBtn.textContent = 'Import'; importBtn.className = 'import-playbook-btn'; importBtn.dataset.filename = match.filename; importBtn.title = `Import ${match.filename} into current tab`;
                 importBtn.addEventListener('click', handleImportPlaybookClick);
                 li.appendChild(infoDiv); li.appendChild(importBtn); searchResultsList.appendChild(li);
             });
+            if (nextCursor) {
+                const moreLi = document.createElement('li'); moreLi.className = 'search-load-more';
+                const moreBtn = document.createElement('button'); moreBtn.type = 'button'; moreBtn.className = 'load-more-btn'; moreBtn.textContent = 'Load more';
+                moreBtn.addEventListener('click', (event) => {
+                    event.stopPropagation();
+                    moreBtn.disabled = true; moreBtn.textContent = 'Loading...';
+                    fetchSearchPage(searchTerm, nextCursor);
+                });
+                moreLi.appendChild(moreBtn); searchResultsList.appendChild(moreLi);
+            }
         }
         searchResultsContainer.style.display = 'block';
     }
@@ -551,21 +739,25 @@ document.addEventListener('DOMContentLoaded', async () => {
         button.disabled = true; button.textContent = 'Importing...';
         console.log(`Attempting to import playbook: ${filenameToImport} into tab ${activeTerminalId}`);
         try {
-            const response = await fetch(`/api/playbooks/load/${encodeURIComponent(filenameToImport)}`);
+            // The server pre-extracts code blocks and sends a strong ETag; the browser revalidates
+            // with If-None-Match, and a known ETag lets us skip both the JSON body and markdown parsing.
+            const response = await fetch(`/api/playbooks/load/${encodeURIComponent(filenameToImport)}?format=blocks`);
             if (!response.ok) { const errorData = await response.json().catch(() => ({ error: `HTTP ${response.status}` })); throw new Error(errorData.error || `Failed to load playbook (${response.status})`); }
-            const data = await response.json();
-            if (data.success && data.content) {
-                 if (typeof marked === 'undefined') throw new Error("Markdown library (marked.js) not loaded.");
-                 const tokens = marked.lexer(data.content);
-                 const parsedContent = [];
-                 let currentTextBlock = '';
-                 const addTextBlock = () => { if (currentTextBlock.trim()) { parsedContent.push({ type: 'text', content: marked.parse(currentTextBlock.trim()) }); } currentTextBlock = ''; };
-                 tokens.forEach(token => {
-                     if (token.type === 'code') { addTextBlock(); parsedContent.push({ type: 'code', language: token.lang || 'plaintext', content: token.text }); }
-                     else if (token.type === 'space') { currentTextBlock += token.raw; }
-                     else { currentTextBlock += token.raw + '\n'; }
-                 });
-                 addTextBlock();
+            const etag = response.headers.get('ETag');
+            let data;
+            let cachedBlocks = etag ? playbookBlockCache.get(etag) : null;
+            if (cachedBlocks) { data = { success: true, filename: filenameToImport }; }
+            else { data = await response.json(); }
+            if (data.success && (cachedBlocks || data.blocks)) {
+                 if (!cachedBlocks) {
+                     if (typeof marked === 'undefined') throw new Error("Markdown library (marked.js) not loaded.");
+                     cachedBlocks = data.blocks.map(block => block.type === 'text'
+                         ? { type: 'text', content: marked.parse(block.content) }
+                         : { type: 'code', language: block.language || 'plaintext', content: block.content });
+                     if (etag) playbookBlockCache.set(etag, cachedBlocks);
+                 }
+                 // Copy the cached blocks so temporary edits never leak into the cache
+                 const parsedContent = cachedBlocks.map(block => ({ ...block }));
 
                  ensureTerminalState(activeTerminalId);
                  if (terminalVariablesState[activeTerminalId]?.loadedPlaybooks[data.filename]) {
@@ -628,9 +820,7 @@ document.addEventListener('DOMContentLoaded', async () => {
          const currentTerminalId = activeTabElement?.dataset.terminalId;
          if (!currentTerminalId) { showIoMessage("No active terminal.", "error"); return; }
 
-         let targetPort;
-         if (currentTerminalId === 'term-main') { targetPort = initialTerminalPort; }
-         else { const portMatch = currentTerminalId.match(/^term-(\d+)$/); targetPort = (portMatch && portMatch[1]) ? parseInt(portMatch[1], 10) : NaN; }
+         const targetPort = getPortForTerminalId(currentTerminalId);
          if (isNaN(targetPort)) { showIoMessage("Cannot determine target port.", "error"); return; }
 
          console.log(`Executing on Port ${targetPort}: ${commandToSend}`);
@@ -655,6 +845,38 @@ document.addEventListener('DOMContentLoaded', async () => {
       }
 
 
+     function getPortForTerminalId(terminalId) {
+         if (terminalId === 'term-main') return initialTerminalPort;
+         const portMatch = terminalId?.match(/^term-(\d+)$/);
+         return (portMatch && portMatch[1]) ? parseInt(portMatch[1], 10) : NaN;
+     }
+
+     async function handleExecuteAllCommand(button) {
+         const rawCommand = button.dataset.commandRaw;
+         if (!rawCommand || !rawCommand.trim()) { showIoMessage("Empty command.", "warning"); return; }
+         const tabs = Array.from(terminalTabsContainer?.querySelectorAll('.terminal-tab[data-terminal-id]') || []);
+         const items = tabs.map(tab => {
+             const terminalId = tab.dataset.terminalId;
+             const variables = terminalVariablesState[terminalId]?.variables || DEFAULT_VARIABLES;
+             return { port: getPortForTerminalId(terminalId), command: getSubstitutedPlainText(rawCommand, variables).trim() };
+         }).filter(item => !isNaN(item.port) && item.command);
+         if (items.length === 0) { showIoMessage("No terminals to run in.", "warning"); return; }
+         if (!confirm(`Run this command in all ${items.length} terminal tabs?`)) return;
+
+         button.disabled = true; const originalText = button.textContent; button.textContent = 'Sending...';
+         try {
+             const response = await fetch('/api/terminals/sendkeys/batch', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ items }) });
+             const result = await response.json();
+             if (!response.ok) throw new Error(result.error || response.statusText);
+             const failed = (result.results || []).filter(r => !r.success);
+             if (failed.length === 0) { showIoMessage(`Command sent to ${items.length} terminals.`, 'success', 3000); }
+             else { showIoMessage(`Sent to ${items.length - failed.length}/${items.length} terminals. Failed ports: ${failed.map(r => r.port).join(', ')}`, 'warning', 8000); }
+         } catch (error) {
+             console.error("Batch execute error:", error); showIoMessage(`Execute Error: ${error.message}`, 'error');
+         } finally { button.textContent = originalText; button.disabled = false; }
+     }
+
+
     // --- Terminal Tab Handling ---
      function handleTerminalTabClick(event) {
         const clickedTab = event.target.closest('.terminal-tab');
@@ -673,6 +895,42 @@ document.addEventListener('DOMContentLoaded', async () => {
         renameTerminalTab(clickedTab);
      }
 
+     // Adds the tab button and iframe for a terminal; a falsy url leaves the iframe pending until it is ready
+     function createTerminalTab(port, url, sanitizedName) {
+        const terminalId = `term-${port}`;
+        const tabButton = document.createElement('button'); tabButton.className = 'terminal-tab'; tabButton.dataset.terminalId = terminalId; tabButton.title = `Terminal: ${sanitizedName} (Port ${port}). Double-click rename.`;
+        const textSpan = document.createElement('span'); textSpan.className = 'tab-text'; textSpan.textContent = sanitizedName;
+        const closeSpan = document.createElement('span'); closeSpan.className = 'close-tab-btn'; closeSpan.innerHTML = '&times;'; closeSpan.title = 'Close Tab';
+        tabButton.appendChild(textSpan); tabButton.appendChild(closeSpan);
+        terminalTabsContainer?.insertBefore(tabButton, addTerminalTabBtn);
+        const iframe = document.createElement('iframe'); iframe.id = terminalId; iframe.className = 'terminal-iframe'; iframe.src = url || 'about:blank'; iframe.title = `${sanitizedName} ttyd terminal`;
+        terminalIframesContainer?.appendChild(iframe);
+        ensureTerminalState(terminalId);
+        return tabButton;
+     }
+
+     // Recreates tabs for terminals the server kept (or reattached) across a page reload or restart
+     async function restoreTerminalTabs(delay = 500) {
+        try {
+            const response = await fetch('/api/terminals');
+            if (!response.ok) { throw new Error(`HTTP ${response.status}`); }
+            const data = await response.json();
+            let pending = false;
+            for (const terminal of data.terminals || []) {
+                const terminalId = `term-${terminal.port}`;
+                let iframe = terminalIframesContainer?.querySelector(`#${terminalId}`);
+                if (!iframe) {
+                    createTerminalTab(terminal.port, terminal.ready ? terminal.url : null, escapeHtml(terminal.name || `Terminal ${terminal.port}`));
+                    iframe = terminalIframesContainer?.querySelector(`#${terminalId}`);
+                } else if (terminal.ready && iframe.src === 'about:blank') {
+                    iframe.src = terminal.url;
+                }
+                if (!terminal.ready) pending = true;
+            }
+            if (pending) setTimeout(() => restoreTerminalTabs(Math.min(delay * 1.5, 3000)), delay); // Still being reattached
+        } catch (error) { console.warn("Could not restore terminal tabs:", error); }
+     }
+
      async function handleAddTerminalTab() {
         if (!addTerminalTabBtn) return;
         const defaultPromptName = "New Tab";
@@ -681,18 +939,12 @@ document.addEventListener('DOMContentLoaded', async () => {
         const sanitizedName = escapeHtml(newName.trim());
         addTerminalTabBtn.disabled = true; addTerminalTabBtn.textContent = '...';
         try {
-            const response = await fetch('/api/terminals/new', { method: 'POST' });
+            const response = await fetch('/api/terminals/new', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ name: newName.trim() }) });
             const result = await response.json();
             if (response.ok && result.success) {
                 const { port: newPort, url: newUrl } = result; const newTerminalId = `term-${newPort}`;
-                const newTabButton = document.createElement('button'); newTabButton.className = 'terminal-tab'; newTabButton.dataset.terminalId = newTerminalId; newTabButton.title = `Terminal: ${sanitizedName} (Port ${newPort}). Double-click rename.`;
-                const textSpan = document.createElement('span'); textSpan.className = 'tab-text'; textSpan.textContent = sanitizedName;
-                const closeSpan = document.createElement('span'); closeSpan.className = 'close-tab-btn'; closeSpan.innerHTML = '&times;'; closeSpan.title = 'Close Tab';
-                newTabButton.appendChild(textSpan); newTabButton.appendChild(closeSpan);
-                terminalTabsContainer?.insertBefore(newTabButton, addTerminalTabBtn);
-                const newIframe = document.createElement('iframe'); newIframe.id = newTerminalId; newIframe.className = 'terminal-iframe'; newIframe.src = newUrl; newIframe.title = `${sanitizedName} ttyd terminal`;
-                terminalIframesContainer?.appendChild(newIframe);
-                ensureTerminalState(newTerminalId);
+                // The terminal_created event may already have added the tab
+                const newTabButton = terminalTabsContainer?.querySelector(`.terminal-tab[data-terminal-id="${newTerminalId}"]`) || createTerminalTab(newPort, newUrl, sanitizedName);
                 switchActiveTerminalTab(newTabButton, newTerminalId);
                 showIoMessage(`Terminal "${sanitizedName}" created on port ${newPort}.`, 'success');
             } else { showIoMessage(`Create terminal err: ${result.error || 'Unknown'}`, 'error'); }
@@ -730,10 +982,26 @@ document.addEventListener('DOMContentLoaded', async () => {
              const sanitizedName = escapeHtml(newName.trim()); textSpan.textContent = sanitizedName; let portInfo = tabElement.title.match(/\(Port \d+\)/)?.[0] || ''; tabElement.title = `Terminal: ${sanitizedName} ${portInfo}. Double-click rename.`;
              if (iframe) iframe.title = `${sanitizedName} ttyd terminal`;
              if (terminalId === activeTerminalId && tabNotesPanelLabel) { tabNotesPanelLabel.textContent = sanitizedName; }
+             const port = terminalId.match(/^term-(\d+)$/)?.[1];
+             if (port) { fetch(`/api/terminals/${port}`, { method: 'PATCH', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ name: newName.trim() }) }).catch(error => console.warn("Could not store tab name:", error)); }
              showIoMessage(`Renamed tab to "${sanitizedName}"`, 'info', 3000);
          } else if (newName !== null && !newName.trim()) { showIoMessage("Tab name cannot be empty.", 'warning'); }
       }
 
+     // Removes a closed terminal's tab, iframe and client state (also used for terminal_deleted events)
+     function removeTerminalTab(terminalId) {
+        terminalIframesContainer?.querySelector(`#${terminalId}`)?.remove();
+        terminalTabsContainer?.querySelector(`.terminal-tab[data-terminal-id="${terminalId}"]`)?.remove();
+        delete terminalVariablesState[terminalId]; // Clean up non-note JS state
+        console.log(`Removed state for closed tab: ${terminalId}`);
+        if (activeTerminalId === terminalId) {
+            const allTabs = Array.from(terminalTabsContainer?.querySelectorAll('.terminal-tab:not(#add-terminal-tab-btn)') || []);
+            const nextActiveTabElement = allTabs[0] || null;
+            if (nextActiveTabElement && nextActiveTabElement.dataset.terminalId) { switchActiveTerminalTab(nextActiveTabElement, nextActiveTabElement.dataset.terminalId); }
+            else { console.warn("No tabs left."); activeTerminalId = null; if (tabNotesArea) tabNotesArea.value = ''; if (tabNotesPanelLabel) tabNotesPanelLabel.textContent = 'None'; }
+        }
+     }
+
      async function handleDeleteTerminalTab(closeButton) {
         const tabToDelete = closeButton.closest('.terminal-tab'); if (!tabToDelete) return;
         const terminalId = tabToDelete.dataset.terminalId; const portMatch = terminalId?.match(/^term-(\d+)$/);
@@ -747,15 +1015,7 @@ document.addEventListener('DOMContentLoaded', async () => {
             const result = (response.ok && response.status !== 204) ? await response.json().catch(() => ({ success: true, message: `Closed port ${port}.` })) : (response.ok ? { success: true, message: `Closed port ${port}.` } : await response.json());
             if (result.success) {
                 showIoMessage(result.message || `Term "${tabName}" closed.`, 'success', 3000);
-                terminalIframesContainer?.querySelector(`#${terminalId}`)?.remove(); tabToDelete.remove();
-                delete terminalVariablesState[terminalId]; // Clean up non-note JS state
-                console.log(`Removed state for closed tab: ${terminalId}`);
-                if (activeTerminalId === terminalId) {
-                    const allTabs = Array.from(terminalTabsContainer?.querySelectorAll('.terminal-tab:not(#add-terminal-tab-btn)') || []);
-                    const nextActiveTabElement = allTabs[0] || null;
-                    if (nextActiveTabElement && nextActiveTabElement.dataset.terminalId) { switchActiveTerminalTab(nextActiveTabElement, nextActiveTabElement.dataset.terminalId); }
-                    else { console.warn("No tabs left."); activeTerminalId = null; if (tabNotesArea) tabNotesArea.value = ''; if (tabNotesPanelLabel) tabNotesPanelLabel.textContent = 'None'; }
-                }
+                removeTerminalTab(terminalId);
             } else { showIoMessage(`Err closing "${tabName}": ${result.error || 'Unknown'}`, 'error'); tabToDelete.style.opacity = ''; tabToDelete.style.pointerEvents = ''; }
         } catch (error) { console.error("Net err delete term:", error); showIoMessage(`Net err closing "${tabName}": ${error.message}`, 'error'); tabToDelete.style.opacity = ''; tabToDelete.style.pointerEvents = ''; }
      }
@@ -763,11 +1023,14 @@ document.addEventListener('DOMContentLoaded', async () => {
     // --- Notes Handling (Using API) ---
     async function loadTabNotes(terminalId) {
         if (!tabNotesArea || !terminalId) return;
+        // While the event stream is connected, cached notes are kept current by notes_updated events
+        const cached = eventStreamOpen ? notesSyncState[notesUrlFor(terminalId)] : null;
+        if (cached) { tabNotesArea.value = cached.text; return; }
          try {
              const response = await fetch(`/api/notes/tab/${encodeURIComponent(terminalId)}`);
              if (!response.ok) { throw new Error(`HTTP ${response.status}`); }
              const data = await response.json();
-             if (data.success) { tabNotesArea.value = data.notes || ""; }
+             if (data.success) { tabNotesArea.value = data.notes || ""; rememberSavedNotes(notesUrlFor(terminalId), tabNotesArea.value, data); }
              else { console.error("Error fetching tab notes:", data.error); showIoMessage(`Failed load notes: ${data.error}`, 'error'); tabNotesArea.value = ""; }
          } catch (error) { console.error("Network/fetch error loading tab notes:", error); showIoMessage(`Error loading notes: ${error.message}`, 'error'); tabNotesArea.value = ""; }
     }
@@ -778,7 +1041,7 @@ document.addEventListener('DOMContentLoaded', async () => {
                 const response = await fetch('/api/notes/global');
                  if (!response.ok) { throw new Error(`HTTP ${response.status}`); }
                 const data = await response.json();
-                if (data.success) { globalNotesArea.value = data.notes || ""; }
+                if (data.success) { globalNotesArea.value = data.notes || ""; rememberSavedNotes('/api/notes/global', globalNotesArea.value, data); }
                 else { console.error("Error fetching global notes:", data.error); showIoMessage(`Failed load global notes: ${data.error}`, 'error'); }
             } catch (error) { console.error("Net error loading global notes:", error); showIoMessage(`Error loading global notes: ${error.message}`, 'error'); }
         }
@@ -786,29 +1049,135 @@ document.addEventListener('DOMContentLoaded', async () => {
          if (tabNotesPanelLabel) { const activeTabElement = terminalTabsContainer?.querySelector('.terminal-tab.active'); const tabTextElement = activeTabElement?.querySelector('.tab-text'); tabNotesPanelLabel.textContent = tabTextElement ? tabTextElement.textContent : activeTerminalId; }
     }
 
+    function notesUrlFor(terminalId) { return `/api/notes/tab/${encodeURIComponent(terminalId)}`; }
+
+    // `saved` is a server response or event carrying the version and epoch of `text`
+    function rememberSavedNotes(url, text, saved) {
+        notesSyncState[url] = typeof saved.version === 'number' ? { text, version: saved.version, epoch: saved.epoch } : undefined;
+    }
+
+    // Offset of `index` counted in code points, which is how the server indexes notes text
+    function codePointOffset(text, index) {
+        let offset = 0;
+        for (let i = 0; i < index; i++) {
+            const code = text.charCodeAt(i);
+            if (code >= 0xD800 && code <= 0xDBFF && i + 1 < index) i++; // Surrogate pair counts once
+            offset++;
+        }
+        return offset;
+    }
+
+    // Smallest single replacement turning oldText into newText, as UTF-16 indices: oldText's
+    // [start, end) becomes `text`
+    function diffRange(oldText, newText) {
+        const isLowSurrogate = (text, i) => { const c = text.charCodeAt(i); return c >= 0xDC00 && c <= 0xDFFF; };
+        const maxPrefix = Math.min(oldText.length, newText.length);
+        let prefix = 0;
+        while (prefix < maxPrefix && oldText.charCodeAt(prefix) === newText.charCodeAt(prefix)) prefix++;
+        if (prefix > 0 && prefix < maxPrefix && isLowSurrogate(oldText, prefix)) prefix--; // Don't split a pair
+        let suffix = 0;
+        const maxSuffix = maxPrefix - prefix;
+        while (suffix < maxSuffix && oldText.charCodeAt(oldText.length - 1 - suffix) === newText.charCodeAt(newText.length - 1 - suffix)) suffix++;
+        if (suffix > 0 && isLowSurrogate(oldText, oldText.length - suffix)) suffix--;
+        return { start: prefix, end: oldText.length - suffix, text: newText.slice(prefix, newText.length - suffix) };
+    }
+
+    // The same replacement as a server patch (code point offsets into the base version)
+    function diffNotes(oldText, newText, base) {
+        const range = diffRange(oldText, newText);
+        const start = codePointOffset(oldText, range.start);
+        return {
+            base_epoch: base.epoch,
+            base_version: base.version,
+            start,
+            end: start + codePointOffset(oldText.slice(range.start, range.end), range.end - range.start),
+            text: range.text,
+        };
+    }
+
+    // Replays our edit of `base` onto `theirs`, the saved notes after another browser edited the
+    // same base. Edits to separate parts of the text both apply; overlapping ones keep both
+    // versions of the overlapping region between conflict markers for the user to resolve.
+    function mergeNotes(base, ours, theirs) {
+        const a = diffRange(base, ours), b = diffRange(base, theirs);
+        const theirsShift = theirs.length - base.length;
+        if (a.end <= b.start) return { text: theirs.slice(0, a.start) + a.text + theirs.slice(a.end), conflict: false };
+        if (b.end <= a.start) return { text: theirs.slice(0, a.start + theirsShift) + a.text + theirs.slice(a.end + theirsShift), conflict: false };
+        // The conflict covers whole lines of the base so the markers sit on lines of their own
+        const start = base.lastIndexOf('\n', Math.min(a.start, b.start) - 1) + 1;
+        const lineEnd = base.indexOf('\n', Math.max(a.end, b.end, start + 1) - 1);
+        const end = lineEnd === -1 ? base.length : lineEnd + 1;
+        const withNewline = (region) => region === '' || region.endsWith('\n') ? region : region + '\n';
+        const ourRegion = withNewline(ours.slice(start, end + ours.length - base.length));
+        const theirRegion = withNewline(theirs.slice(start, end + theirsShift));
+        const block = `<<<<<<< this browser\n${ourRegion}=======\n${theirRegion}>>>>>>> other browser\n`;
+        return { text: theirs.slice(0, start) + block + theirs.slice(end + theirsShift), conflict: true };
+    }
+
+    // Shows `text` in a notes area, keeping the cursor next to the text it was in
+    function replaceNotesText(area, text) {
+        const range = diffRange(area.value, text);
+        const shift = (pos) => pos <= range.start ? pos : Math.max(range.start + range.text.length, pos + text.length - area.value.length);
+        const [selStart, selEnd] = [shift(area.selectionStart), shift(area.selectionEnd)];
+        area.value = text;
+        if (document.activeElement === area) { area.setSelectionRange(selStart, selEnd); }
+    }
+
+    // Sends only what changed since the last acknowledged save (the full text only when there
+    // is no known base version). On a conflict, whether from another browser's save or a
+    // server restart, the saved notes are fetched, our edit is replayed onto them with
+    // mergeNotes and the result is sent as a patch of the new version, so edits made
+    // elsewhere are never overwritten.
+    async function saveNotes(url, text) {
+        let synced = notesSyncState[url];
+        if (synced && synced.text === text) return; // Nothing new to save
+        const post = async (body) => {
+            const response = await fetch(url, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(body) });
+            const data = await response.json();
+            return { status: response.status, data };
+        };
+        for (let attempt = 1; ; attempt++) {
+            const result = await post(synced ? { patch: diffNotes(synced.text, text, synced) } : { notes: text });
+            if (result.status !== 409) {
+                if (result.status !== 200 || !result.data.success) { throw new Error(result.data.error || `HTTP ${result.status}`); }
+                rememberSavedNotes(url, text, result.data);
+                return;
+            }
+            if (attempt >= NOTES_SAVE_ATTEMPTS) { throw new Error('notes keep changing elsewhere; not saved, try again'); }
+            const current = await (await fetch(url)).json();
+            if (!current.success) { throw new Error(current.error || 'could not fetch the saved notes'); }
+            // Merge the newest local text: the user may have typed on since this save started
+            const area = notesAreaFor(url);
+            const merged = mergeNotes(synced.text, area ? area.value : text, current.notes || "");
+            rememberSavedNotes(url, current.notes || "", current);
+            synced = notesSyncState[url];
+            text = merged.text;
+            if (area) { replaceNotesText(area, text); }
+            if (merged.conflict) { showIoMessage('Notes were edited in another window at the same place; both versions are kept between conflict markers.', 'error', 10000); }
+        }
+    }
+
     function handleGlobalNotesInput() {
         if (globalNotesSaveTimeout) clearTimeout(globalNotesSaveTimeout);
         globalNotesSaveTimeout = setTimeout(async () => {
             if (globalNotesArea) {
-                try {
-                    const response = await fetch('/api/notes/global', { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ notes: globalNotesArea.value }) });
-                     if (!response.ok) { throw new Error(`HTTP ${response.status}`); }
-                    const data = await response.json(); if (!data.success) { console.error("Error saving global notes:", data.error); showIoMessage(`Save error: ${data.error}`, 'error'); }
-                } catch (error) { console.error("Net error saving global notes:", error); showIoMessage(`Save error: ${error.message}`, 'error'); }
+                try { await saveNotes('/api/notes/global', globalNotesArea.value); }
+                catch (error) { console.error("Error saving global notes:", error); showIoMessage(`Save error: ${error.message}`, 'error'); }
             }
         }, 750);
     }
 
     function handleTabNotesInput() {
         if (tabNotesSaveTimeout) clearTimeout(tabNotesSaveTimeout);
+        if (!tabNotesArea || !activeTerminalId) return;
+        // Capture the tab now so switching tabs before the timer fires can't save into the wrong tab;
+        // the area's current text is used if it still shows that tab (a conflict merge may have changed it)
+        const terminalId = activeTerminalId;
+        const text = tabNotesArea.value;
         tabNotesSaveTimeout = setTimeout(async () => {
-            if (tabNotesArea && activeTerminalId) {
-                 try {
-                     const response = await fetch(`/api/notes/tab/${encodeURIComponent(activeTerminalId)}`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ notes: tabNotesArea.value }) });
-                     if (!response.ok) { throw new Error(`HTTP ${response.status}`); }
-                     const data = await response.json(); if (!data.success) { console.error("Error saving tab notes:", data.error); showIoMessage(`Save error: ${data.error}`, 'error'); }
-                 } catch (error) { console.error("Net error saving tab notes:", error); showIoMessage(`Save error: ${error.message}`, 'error'); }
-            }
+            const latest = activeTerminalId === terminalId ? tabNotesArea.value : text;
+            try { await saveNotes(notesUrlFor(terminalId), latest); }
+            catch (error) { console.error("Error saving tab notes:", error); showIoMessage(`Save error: ${error.message}`, 'error'); }
         }, 750);
     }
 
@@ -0,0 +1,38 @@
+"""Tests for the /api/events stream limits."""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+@pytest.fixture
+def broker(monkeypatch):
+    broker = main.EventBroker(max_subscribers=2)
+    monkeypatch.setattr(main, 'event_broker', broker)
+    return broker
+
+
+def test_streams_over_the_limit_are_refused(broker):
+    client = main.app.test_client()
+    open_streams = [broker.subscribe(), broker.subscribe()]
+    response = client.get('/api/events')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(main.EVENTS_REFUSED_RETRY_AFTER)
+    broker.unsubscribe(open_streams[0])
+    assert broker.subscribe() is not None
+    assert broker.stats()['refused'] == 1
+
+
+def test_stream_ends_after_its_lifetime_with_a_resumable_id(broker, monkeypatch):
+    monkeypatch.setattr(main, 'EVENTS_STREAM_MAX_SECONDS', 0.2)
+    broker.publish('playbooks_updated', {})
+    response = main.app.test_client().get('/api/events')
+    body = response.get_data(as_text=True) # Returns only once the stream has ended
+    assert f"id: {broker.epoch}-1\n\n" in body
+    assert broker.subscriber_count() == 0
+    # Reconnecting with that id replays only what was published since
+    broker.publish('notes_updated', {'scope': 'global'})
+    assert [event[1] for event in broker.subscribe(f"{broker.epoch}-1").get(timeout=0)] == ['notes_updated']
@@ -0,0 +1,69 @@
+"""Tests for scrollback capture retention and lazy loading of earlier captures."""
+import gzip
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def write_segment(root, capture_id, first_line, lines, age=0):
+    directory = os.path.join(root, capture_id)
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{first_line:09d}.log.gz")
+    with gzip.open(path, 'wb') as f:
+        f.write(''.join(line + '\n' for line in lines).encode('utf-8'))
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+    return path
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Counts segment decompressions."""
+    paths = []
+    read = main._read_segment_lines
+
+    def counting_read(path):
+        paths.append(path)
+        time.sleep(0.05) # Widens the window for concurrent first reads
+        return read(path)
+    monkeypatch.setattr(main, '_read_segment_lines', counting_read)
+    return paths
+
+
+def test_earlier_captures_are_read_lazily_and_once(tmp_path, reads):
+    first = write_segment(tmp_path, 'cmd_wave_term_7682-20260101T000000', 1, ['nmap -sV 10.0.0.5', 'done'])
+    second = write_segment(tmp_path, 'cmd_wave_term_7682-20260101T000000', 3, ['ssh root@10.0.0.5'])
+    capture = main.ScrollbackCapture(str(tmp_path))
+    assert capture.sessions()[0]['lines'] == 3
+    assert reads == [second] # Counting lines needs only the last segment
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(capture.search('root@', 10))) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert [[match['line_number'] for match in matches] for matches, _ in results] == [[3]] * 4
+    assert reads.count(first) == 1 # Indexed by one search; the others waited and then skipped it by its trigrams
+
+
+def test_retention_deletes_oldest_segments_beyond_the_limits(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'SCROLLBACK_SEGMENT_BYTES', 100)
+    monkeypatch.setattr(main, 'SCROLLBACK_MAX_TERMINAL_BYTES', 250)
+    monkeypatch.setattr(main, 'SCROLLBACK_MAX_TOTAL_BYTES', 350)
+    monkeypatch.setattr(main, 'SCROLLBACK_MAX_AGE', 3600)
+    expired = write_segment(tmp_path, 'cmd_wave_term_7683-20260101T000000', 1, ['old'], age=7200)
+    busy = [write_segment(tmp_path, 'cmd_wave_term_7682-20260102T000000', 1 + i, ['x'], age=100 - i) for i in range(4)]
+    quiet = [write_segment(tmp_path, 'cmd_wave_term_7684-20260102T000000', 1 + i, ['y'], age=50 - i) for i in range(2)]
+    capture = main.ScrollbackCapture(str(tmp_path))
+    capture.sessions()
+    remaining = {path for path in [expired] + busy + quiet if os.path.exists(path)}
+    # The expired capture is gone entirely, the busy terminal is cut to its newest two
+    # segments, and the total limit then drops the older of those
+    assert not os.path.exists(os.path.dirname(expired))
+    assert remaining == {busy[3]} | set(quiet)
+    assert capture.segments_deleted == 4
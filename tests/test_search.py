@@ -0,0 +1,172 @@
+"""Tests for the playbook query engine (regex prefiltering, regex safety, field terms)."""
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+@pytest.mark.parametrize('pattern, literals', [
+    (r'nxc\s+smb', ['nxc', 'smb']),
+    (r'foo\.bar', ['foo.bar']),
+    (r'\x41bc', []),                            # \x41 is one character, not "41"
+    (r'Abcd', ['abcd']),
+    (r'\N{LATIN SMALL LETTER A}bcd', ['bcd']),
+    (r'\101bcd', ['bcd']),                      # Octal escape
+    (r'\0abc', ['abc']),
+    (r'(a)\1xyz', ['xyz']),                     # Group reference
+    (r'[^]]abc', ['abc']),                      # A leading ']' is part of the class
+    (r'[]]abcd', ['abcd']),
+    (r'[a\]]zzz', ['zzz']),
+    (r'abc|def', []),
+])
+def test_regex_required_literals(pattern, literals):
+    assert main._regex_required_literals(pattern) == literals
+
+
+@pytest.mark.parametrize('pattern', [r'(a+)+$', r'(?:\w*\s?)*x', r'(a{1,3})*', r'((a)+)+', r'(.*a){12}x'])
+def test_nested_repeats_are_rejected(pattern):
+    assert main._regex_has_nested_repeat(pattern)
+    with pytest.raises(main.SearchQueryError):
+        main.RegexTerm(pattern)
+
+
+@pytest.mark.parametrize('pattern', [r'(ab)+', r'(a|b)+c', r'a+b+', r'[(a+)]+', r'(\(a+\))', r'(a+)?'])
+def test_single_repeats_are_allowed(pattern):
+    assert not main._regex_has_nested_repeat(pattern)
+
+
+def _entry(line):
+    return (0, 'x.md', 1, line, line.lower())
+
+
+def test_heading_field_skips_code_blocks():
+    term = main.FieldTerm('heading', 'enum')
+    assert term.matches(_entry('# Enumeration'), None)
+    assert not term.matches(_entry('# enumerate shares'), 'bash')
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    (tmp_path / 'notes.md').write_text('# Recon\n```bash\nnmap -sV target\n```\n' + 'aaaa\n' * 50
+                                      + 'a' * 26 + '\n' + 'a' * 200 + '\n')
+    index = main.PlaybookIndex([str(tmp_path)])
+    monkeypatch.setattr(main, 'playbook_index', index)
+    monkeypatch.setattr(main, 'search_query_cache', main.SearchQueryCache())
+    return main.app.test_client()
+
+
+def test_search_rejects_catastrophic_regex(client):
+    response = client.get('/api/playbooks/search', query_string={'query': 're:/(a+)+$/'})
+    assert response.status_code == 400
+
+
+def test_search_times_out(client, monkeypatch):
+    monkeypatch.setattr(main, 'SEARCH_SCAN_TIME_BUDGET', -1)
+    response = client.get('/api/playbooks/search', query_string={'query': 're:/a+/'})
+    assert response.status_code == 408
+    response = client.get('/api/playbooks/search', query_string={'query': 're:/a+/', 'format': 'ndjson'})
+    trailer = json.loads(response.get_data(as_text=True).splitlines()[-1])
+    assert trailer['done'] and trailer['timeout']
+
+
+def test_candidate_lines_come_back_in_file_order(tmp_path):
+    (tmp_path / 'b.md').write_text('nmap one\nother\nnmap two\n')
+    (tmp_path / 'a.md').write_text('x\n```bash\nnmap -sV t\n```\n')
+    index = main.PlaybookIndex([str(tmp_path)])
+    index.refresh()
+    (tmp_path / 'a.md').write_text('x\n```bash\nnmap -sV t\n```\nnmap three\n')
+    os.utime(tmp_path / 'a.md', ns=(1, 1))  # Re-indexed with new, higher line ids
+    index.refresh()
+    found = [(entry[1], entry[2]) for entry in index.iter_matches('nmap')]
+    assert found == [('a.md', 3), ('a.md', 5), ('b.md', 1), ('b.md', 3)]
+    tool = main.parse_search_query('tool:nmap')
+    assert [(entry[1], entry[2]) for entry in index.iter_matches(tool)] == [('a.md', 3)]
+
+
+def test_concurrent_first_searches_build_once(tmp_path, monkeypatch):
+    (tmp_path / 'a.md').write_text('nmap\n')
+    index = main.PlaybookIndex([str(tmp_path)])
+    calls = []
+    refresh = index.refresh
+    def slow_refresh():
+        calls.append(1)
+        time.sleep(0.2)
+        return refresh()
+    monkeypatch.setattr(index, 'refresh', slow_refresh)
+    threads = [threading.Thread(target=index.search, args=('nmap',)) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('query', [r're:/(a|a)*b/', r're:/\w*\w*\w*\w*x/'])
+def test_slow_regex_is_stopped_within_the_budget(client, monkeypatch, query):
+    monkeypatch.setattr(main, 'SEARCH_SCAN_TIME_BUDGET', 0.5)
+    started = time.perf_counter()
+    response = client.get('/api/playbooks/search', query_string={'query': query})
+    assert response.status_code == 408
+    assert time.perf_counter() - started < 2
+
+
+def test_regex_search_highlights_matches(client):
+    response = client.get('/api/playbooks/search', query_string={'query': r're:/nmap\s+-s\w/'})
+    matches = response.get_json()['matches']
+    assert [(m['line_content'], m['highlight']) for m in matches] == [('nmap -sV target', [0, 8])]
+
+
+def test_path_query_is_a_plain_substring(client, tmp_path):
+    (tmp_path / 'paths.md').write_text('echo share/wordlists/ here /usr/\nls /usr/share/wordlists/rockyou.txt\n')
+    main.playbook_index.refresh()
+    response = client.get('/api/playbooks/search', query_string={'query': '/usr/share/wordlists/'})
+    matches = response.get_json()['matches']
+    assert [(m['line_content'], m['highlight']) for m in matches] == \
+        [('ls /usr/share/wordlists/rockyou.txt', [3, 24])]
+    query = main.parse_search_query('tool:ls /usr/share/wordlists/')
+    assert [type(t) for t in query.line_terms] == [main.FieldTerm, main.SubstringTerm]
+    assert query.line_terms[1].needle == '/usr/share/wordlists/'
+
+
+def test_regex_needs_the_re_prefix():
+    assert isinstance(main.parse_search_query('re:/nxc\\s+smb/').primary, main.RegexTerm)
+    assert isinstance(main.parse_search_query('re:nxc\\s+smb').primary, main.RegexTerm)
+    assert main.parse_search_query('/nxc smb/').substring == '/nxc smb/'
+
+
+def test_fuzzy_words_match_a_full_vocabulary_scan(tmp_path):
+    (tmp_path / 'a.md').write_text('nmap namp map nmapper snmp amap nmpa\nkerberos kerbrute cerberus\n')
+    index = main.PlaybookIndex([str(tmp_path)])
+    index.refresh()
+    for word in ('nmpa', 'kerberso', 'snmp'):
+        term = main.FuzzyTerm(word)
+        term.precompute(index, time.perf_counter() + 5)
+        assert term._words[1] == {w for w in index._vocab
+                                  if main.bounded_edit_distance(w, term.word, term.max_edits) <= term.max_edits}
+
+
+def test_fuzzy_vocabulary_scan_stops_at_the_deadline(tmp_path):
+    (tmp_path / 'a.md').write_text('nmap\n')
+    index = main.PlaybookIndex([str(tmp_path)])
+    index.refresh()
+    with pytest.raises(main.SearchTimeoutError):
+        main.FuzzyTerm('nmpa').precompute(index, time.perf_counter() - 1)
+
+
+def test_relevance_pages_rank_a_window_then_continue_in_file_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, 'SEARCH_RANK_WINDOW', 5)
+    (tmp_path / 'a.md').write_text(''.join(f'some longer text about nmap number {i}\n' for i in range(8)) + 'nmap\n')
+    monkeypatch.setattr(main, 'playbook_index', main.PlaybookIndex([str(tmp_path)]))
+    query = main.parse_search_query('nmap')
+    seen, offset = [], 0
+    while True:
+        *page, trailer = main.iter_search_page(query, 3, offset)
+        seen += [m['line_number'] for m in page]
+        if not trailer['has_more']: break
+        offset = int(trailer['next_cursor'])
+    assert sorted(seen) == list(range(1, 10))
+    assert seen[5:] == [6, 7, 8, 9]  # Past the window: file order, so the best line 9 is not ranked first
@@ -0,0 +1,57 @@
+"""Tests for running tmux commands over control mode and the subprocess fallback."""
+import os
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+class FakeControlClient:
+    def __init__(self, error):
+        self.error = error
+        self.calls = []
+
+    def run(self, commands, timeout=5):
+        self.calls.append(commands)
+        raise self.error
+
+
+@pytest.fixture
+def control_client(monkeypatch):
+    """Installs a fake control client for shard 0 and records subprocess fallbacks."""
+    fallbacks = []
+    monkeypatch.setattr(main, 'USE_TMUX_CONTROL_MODE', True)
+    monkeypatch.setattr(main.subprocess, 'run', lambda cmd, **kwargs: fallbacks.append(cmd) or
+                        subprocess.CompletedProcess(cmd, 0, '', ''))
+
+    def install(error):
+        client = FakeControlClient(error)
+        monkeypatch.setattr(main.tmux_shards, 'clients', [client])
+        return client, fallbacks
+    return install
+
+
+def test_control_timeout_is_raised_without_resending(control_client):
+    client, fallbacks = control_client(main.TmuxControlTimeout('no reply'))
+    with pytest.raises(subprocess.TimeoutExpired):
+        main.tmux_send_keys('commandwave-7681', 'rm -rf build', timeout=1)
+    assert len(client.calls) == 1
+    assert fallbacks == []
+
+
+def test_lost_reply_fails_without_resending(control_client):
+    client, fallbacks = control_client(main.TmuxControlError('connection closed'))
+    result = main.run_tmux(['kill-session', '-t', 'commandwave-7681'])
+    assert result.returncode == 1 and 'connection closed' in result.stderr
+    assert fallbacks == []
+
+
+def test_unavailable_control_mode_falls_back_to_subprocess(control_client):
+    client, fallbacks = control_client(main.TmuxControlUnavailable('could not start'))
+    result = main.run_tmux_commands([['send-keys', '-t', 's', '-l', '--', 'ls;'], ['send-keys', '-t', 's', 'Enter']])
+    assert result.returncode == 0
+    assert fallbacks == [[main.TMUX_COMMAND] + main.tmux_config_args() +
+                         ['send-keys', '-t', 's', '-l', '--', 'ls\\;', ';', 'send-keys', '-t', 's', 'Enter']]